@@ -2,43 +2,1048 @@
 import re
 import imaplib
 import email
-from email.header import decode_header
-import telebot
+import email.message
+import email.policy
+import base64
+import quopri
+from email.parser import BytesFeedParser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import json
-from typing import Dict, List, Optional
+import random
+import hashlib
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
 import time
+import functools
+import heapq
+import itertools
 import logging
+import logging.handlers
 import os
-from dotenv import load_dotenv
+import atexit
+from dotenv import dotenv_values, find_dotenv, load_dotenv
 import threading
+import weakref
+import queue
+import asyncio
+import signal
+import select
+import socket
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from html.parser import HTMLParser
+from email.utils import parsedate_to_datetime
+
+# aiohttp нужен только в режиме asyncio и импортируется при первом обращении
+# (AsyncHTTPClient.available()), telebot - только при настроенном токене бота:
+# вместе они удваивали время запуска процесса
+aiohttp = None
+# requests и email.* импортируются сразу: HTTPClient клиентов Pyrus и Green API
+# создается при запуске бота, StreamedPart наследует email.message.Message, а
+# письма разбираются с первой проверки почты - отложенный импорт лишь перенес
+# бы те же ~110 мс (requests) и ~13 мс (email.*) из импорта в конструктор бота
+
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-log_level = logging.DEBUG if os.getenv('DEBUG') else logging.INFO
-logging.basicConfig(
-    level=log_level,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+class JSONLogFormatter(logging.Formatter):
+    """
+    Запись лога - одна строка JSON: время, уровень, поток, сообщение и поля,
+    переданные через extra (category, key, tenant, ...). Сообщение собирается
+    здесь, в потоке записи, а не в потоке, который вызвал logger.info().
+    """
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in self.RESERVED and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogSampler(logging.Filter):
+    """
+    Прореживание частых сообщений по категориям (extra={'category': ...}):
+    при доле 0.1 проходит каждое десятое сообщение категории. Предупреждения,
+    ошибки и сообщения без категории проходят всегда. В записи остается
+    sample_rate, чтобы при подсчете по логам можно было восстановить итог.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.counters = {category: itertools.count(1) for category in rates}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, 'category', None)
+        rate = self.rates.get(category, 1.0)
+        if rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        if rate <= 0.0:
+            return False
+        # next() у itertools.count атомарен в CPython - блокировка не нужна
+        number = next(self.counters[category])
+        if int(number * rate) == int((number - 1) * rate):
+            return False
+        record.sample_rate = rate
+        return True
+
+    @staticmethod
+    def parse(spec: str) -> Dict[str, float]:
+        """'application=0.1,delivery=0.5' -> {'application': 0.1, 'delivery': 0.5}"""
+        rates = {}
+        for item in filter(None, (part.strip() for part in spec.split(','))):
+            category, _, rate = item.partition('=')
+            rates[category.strip()] = float(rate)
+        return rates
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """Файл лога с ротацией и по размеру, и по времени (раз в rotate_interval секунд)"""
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, rotate_interval: float):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.rotate_interval = rotate_interval
+        self.rotate_at = time.time() + rotate_interval if rotate_interval else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rotate_at and record.created >= self.rotate_at:
+            return True
+        # Базовый класс форматирует запись ради ее длины - второй раз за запись.
+        # Достаточно текущего размера: файл превысит предел не больше чем на строку
+        if not self.maxBytes:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.maxBytes
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rotate_interval:
+            self.rotate_at = time.time() + self.rotate_interval
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Постановка записи в очередь без форматирования: сообщение соберет поток
+    QueueListener. Аргументы-словари копируются, чтобы в лог попало их
+    состояние на момент вызова. При переполнении очереди запись
+    отбрасывается и учитывается в метрике, а не блокирует рабочий поток.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if isinstance(record.args, dict):
+            # logger.info("%s", data) с единственным словарем: logging хранит сам словарь
+            record.args = dict(record.args)
+        elif isinstance(record.args, tuple):
+            record.args = tuple(dict(arg) if isinstance(arg, dict) else arg for arg in record.args)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LogPipeline.dropped += 1
+
+class LogQueueListener(logging.handlers.QueueListener):
+    """Поток записи лога: сообщение собирается один раз для консоли и файла"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+class LogPipeline:
+    """
+    Неблокирующее логирование: рабочие потоки только кладут записи в очередь,
+    а консоль и файл logs/bot.log (JSON, ротация по размеру и времени)
+    пишет отдельный поток QueueListener. Настраивается переменными LOG_*.
+    """
+
+    TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    dropped = 0
+    listener = None
+
+    @classmethod
+    def setup(cls, log_dir: str = 'logs'):
+        """Настраивает корневой логгер; повторный вызов заменяет прежнюю настройку"""
+        cls.shutdown()
+        directory = Path(os.getenv('LOG_DIR', log_dir))
+        directory.mkdir(parents=True, exist_ok=True)
+        level = logging.DEBUG if os.getenv('DEBUG', 'false').lower() == 'true' else logging.INFO
+
+        file_handler = RotatingLogFileHandler(
+            str(directory / 'bot.log'),
+            max_bytes=int(float(os.getenv('LOG_MAX_MB', '20')) * 1024 * 1024),
+            backup_count=int(os.getenv('LOG_BACKUP_COUNT', '10')),
+            rotate_interval=float(os.getenv('LOG_ROTATE_HOURS', '24')) * 3600
+        )
+        if os.getenv('LOG_FORMAT', 'json').lower() == 'json':
+            file_handler.setFormatter(JSONLogFormatter())
+        else:
+            file_handler.setFormatter(logging.Formatter(cls.TEXT_FORMAT))
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(cls.TEXT_FORMAT))
+
+        log_queue = queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', '10000')))
+        queue_handler = LogQueueHandler(log_queue)
+        queue_handler.addFilter(LogSampler(LogSampler.parse(os.getenv('LOG_SAMPLE', ''))))
+
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(queue_handler)
+        cls.listener = LogQueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+        cls.listener.start()
+        atexit.register(cls.shutdown)
+        metrics.counter('autoresponder_log_dropped_total', 'Записей лога, отброшенных при переполнении очереди'
+                        ).set_function(lambda: cls.dropped)
+
+    @classmethod
+    def shutdown(cls):
+        """Дописывает очередь и закрывает файлы лога"""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, LogQueueHandler):
+                root.removeHandler(handler)
+        if cls.listener:
+            cls.listener.stop()
+            for handler in cls.listener.handlers:
+                handler.close()
+            cls.listener = None
+
+
+class LatencyHistogram:
+    """Потокобезопасная гистограмма задержек с фиксированными границами (секунды)"""
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        """Добавляет одно измерение"""
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> Dict:
+        """Накопленные значения корзин, количество и сумма измерений"""
+        with self._lock:
+            counts = list(self.counts)
+            total, total_sum = self.count, self.sum
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': total, 'sum': total_sum}
+
+class Metric:
+    """Базовый класс метрики с набором меток"""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Optional[Dict] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        return []
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    metric_type = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, func, **labels):
+        """Значение берется из внешнего источника (например, StatsCore)"""
+        with self._lock:
+            self._values[self._key(labels)] = func
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            value = self._values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        return [
+            f"{self.name}{self._labels(key)} {value() if callable(value) else value:g}"
+            for key, value in items
+        ]
+
+class Gauge(Metric):
+    """Текущее значение; может вычисляться функцией в момент чтения"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, func, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = func
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            value = self._values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = []
+        for key, value in items:
+            try:
+                value = value() if callable(value) else value
+            except Exception as e:
+                logger.debug("Не удалось вычислить метрику %s: %s", self.name, e)
+                continue
+            lines.append(f"{self.name}{self._labels(key)} {value:g}")
+        return lines
+
+class Histogram(Metric):
+    """Гистограмма задержек: по одной LatencyHistogram на набор меток"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._children = {}
+
+    def child(self, **labels) -> LatencyHistogram:
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = LatencyHistogram()
+            return self._children[key]
+
+    def observe(self, seconds: float, **labels):
+        self.child(**labels).observe(seconds)
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._children.items())
+        lines = []
+        for key, histogram in items:
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot['buckets']:
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{self._labels(key, {'le': le})} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {snapshot['sum']:g}")
+            lines.append(f"{self.name}_count{self._labels(key)} {snapshot['count']}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Реестр метрик процесса. Из него формируются и ответ /metrics в формате
+    Prometheus, и команда /stats в Telegram.
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name: str, help_text: str, labelnames: Tuple[str, ...]):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, help_text, labelnames)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Метрика {name} уже зарегистрирована с другим типом")
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, labelnames)
+
+    def stage_latency(self, stage: str) -> LatencyHistogram:
+        return self.histogram(
+            'autoresponder_stage_seconds', 'Длительность этапов обработки заявки', ('stage',)
+        ).child(stage=stage)
+
+    def stage_error(self, stage: str):
+        self.counter('autoresponder_stage_errors_total', 'Ошибки по этапам обработки', ('stage',)).inc(stage=stage)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Замеряет длительность этапа; исключение считается ошибкой этапа"""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.stage_error(stage)
+            raise
+        finally:
+            self.stage_latency(stage).observe(time.monotonic() - started)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+class MetricsServer:
+    """Небольшой HTTP-сервер для /metrics и других служебных эндпоинтов"""
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = metrics):
+        self.routes = {
+            '/metrics': lambda: (200, 'text/plain; version=0.0.4; charset=utf-8', registry.render())
+        }
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                route = routes.get(self.path.split('?', 1)[0])
+                if route is None:
+                    status, content_type, body = 404, 'text/plain; charset=utf-8', 'not found\n'
+                else:
+                    status, content_type, body = route()
+                payload = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logger.debug("HTTP %s " + format, self.address_string(), *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class StatsCore:
+    """
+    Счетчики без блокировок на горячем пути: каждый поток пишет только в свою
+    ячейку, а чтение суммирует ячейки всех потоков. Кроме итогов ведутся
+    кольцевые буферы для скользящих окон (минута, час, сутки). Ячейка
+    завершившегося потока вливается в общую базовую ячейку, так что число
+    ячеек не растет от короткоживущих потоков.
+    """
+
+    class _Owner:
+        """Хранится в thread-local потока: исчезает вместе с потоком"""
+        __slots__ = ('__weakref__',)
+
+    # Окно -> (ширина корзины в секундах, число корзин)
+    WINDOWS = {
+        '1m': (1, 60),
+        '1h': (60, 60),
+        '24h': (3600, 24)
+    }
+
+    def __init__(self, names: Tuple[str, ...]):
+        self.names = tuple(names)
+        self._cells = []
+        self._cells_lock = threading.Lock()
+        self._local = threading.local()
+        # Сумма ячеек завершившихся потоков (меняется только под _cells_lock)
+        self._base = self._new_cell()
+
+    def _new_cell(self) -> Dict:
+        return {
+            'totals': dict.fromkeys(self.names, 0),
+            'rings': {
+                name: {window: [[-1, 0] for _ in range(size)] for window, (_, size) in self.WINDOWS.items()}
+                for name in self.names
+            }
+        }
+
+    def _cell(self) -> Dict:
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = self._new_cell()
+            # Блокировка нужна только при первой записи из нового потока
+            with self._cells_lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+            self._local.owner = self._Owner()
+            weakref.finalize(self._local.owner, self._retire, cell)
+        return cell
+
+    def _retire(self, cell: Dict):
+        """Поток завершился: его ячейка вливается в базовую"""
+        with self._cells_lock:
+            for name in self.names:
+                self._base['totals'][name] += cell['totals'][name]
+                for window, ring in cell['rings'][name].items():
+                    base_ring = self._base['rings'][name][window]
+                    for position, (index, count) in enumerate(ring):
+                        slot = base_ring[position]
+                        if index > slot[0]:
+                            slot[0], slot[1] = index, count
+                        elif index == slot[0]:
+                            slot[1] += count
+            self._cells.remove(cell)
+
+    def inc(self, name: str, amount: int = 1):
+        """Увеличивает счетчик в ячейке текущего потока"""
+        cell = self._cell()
+        cell['totals'][name] += amount
+        now = time.time()
+        rings = cell['rings'][name]
+        for window, (width, size) in self.WINDOWS.items():
+            index = int(now // width)
+            slot = rings[window][index % size]
+            if slot[0] != index:
+                slot[0], slot[1] = index, 0
+            slot[1] += amount
+
+    def total(self, name: str) -> int:
+        """Значение счетчика за все время"""
+        with self._cells_lock:
+            cells = list(self._cells)
+            base = self._base['totals'][name]
+        return base + sum(cell['totals'][name] for cell in cells)
+
+    def window(self, name: str, window: str) -> int:
+        """Сумма за скользящее окно ('1m', '1h', '24h') с точностью до ширины корзины"""
+        width, size = self.WINDOWS[window]
+        oldest = int(time.time() // width) - size + 1
+        with self._cells_lock:
+            cells = list(self._cells)
+            rings = [[tuple(slot) for slot in self._base['rings'][name][window]]]
+        rings.extend(list(cell['rings'][name][window]) for cell in cells)
+        total = 0
+        for ring in rings:
+            for index, count in ring:
+                if index >= oldest:
+                    total += count
+        return total
+
+    def snapshot(self) -> Dict[str, int]:
+        """Итоговые значения всех счетчиков"""
+        return {name: self.total(name) for name in self.names}
+
+class BotStats:
+    """Счетчики бота поверх StatsCore; чтение stats['имя'] возвращает текущее значение"""
+
+    NAMES = {
+        'processed_applications': 'Полностью обработанные заявки',
+        'sent_whatsapp': 'Отправленные сообщения WhatsApp',
+        'sent_telegram': 'Отправленные сообщения Telegram',
+        'created_crm_tasks': 'Созданные задачи в Pyrus CRM',
+        'errors': 'Ошибки обработки'
+    }
+
+    def __init__(self, registry: MetricsRegistry = metrics):
+        self.core = StatsCore(tuple(self.NAMES))
+        recent = registry.gauge(
+            'autoresponder_recent_events', 'События за скользящее окно', ('event', 'window')
+        )
+        for name, help_text in self.NAMES.items():
+            registry.counter(f'autoresponder_{name}_total', help_text).set_function(
+                lambda name=name: self.core.total(name)
+            )
+            for window in StatsCore.WINDOWS:
+                recent.set_function(
+                    lambda name=name, window=window: self.core.window(name, window),
+                    event=name, window=window
+                )
+
+    def inc(self, name: str, amount: int = 1):
+        self.core.inc(name, amount)
+
+    def __getitem__(self, name: str) -> int:
+        return self.core.total(name)
+
+    def recent(self, name: str, window: str) -> int:
+        return self.core.window(name, window)
+
+    def snapshot(self) -> Dict[str, int]:
+        return self.core.snapshot()
+
+    def __repr__(self):
+        return repr(self.snapshot())
+
+class HTTPClient:
+    """
+    HTTP-клиент одного внешнего API: пул keep-alive соединений, таймауты по
+    умолчанию, повторы с экспоненциальной задержкой и джиттером (с учетом
+    Retry-After) и гистограммы задержек по каждому эндпоинту.
+    """
+
+    # 500 не повторяем: запрос мог быть выполнен, повтор привел бы к дублю
+    RETRY_STATUSES = (429, 502, 503, 504)
+    # 502/504 - прокси мог успеть передать запрос серверу: для неидемпотентных
+    # запросов повторяются только отказы, после которых запрос точно не выполнялся
+    UNSENT_STATUSES = (429, 503)
+
+    def __init__(self, name: str, pool_size: int = 10, connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency = {}
+        self._latency_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, endpoint: str, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', endpoint, url, idempotent=True, **kwargs)
+
+    def post(self, endpoint: str, url: str, idempotent: bool = False, **kwargs) -> requests.Response:
+        return self.request('POST', endpoint, url, idempotent=idempotent, **kwargs)
+
+    def request(self, method: str, endpoint: str, url: str, idempotent: bool = False,
+                **kwargs) -> requests.Response:
+        """
+        Выполняет запрос с повторами. Идемпотентный запрос повторяется после
+        любой ошибки соединения и ответов 429/502/503/504; неидемпотентный -
+        только если он не дошел до сервера: неудачное подключение, 429 и 503.
+        observer(status_code или None, длительность) вызывается после каждой попытки.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        observer = kwargs.pop('observer', None)
+        histogram = self.endpoint_latency(endpoint)
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                histogram.observe(time.monotonic() - started)
+                if observer:
+                    observer(None, time.monotonic() - started)
+                if not (idempotent or self.not_connected(e)) or attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                reason = type(e).__name__
+            else:
+                histogram.observe(time.monotonic() - started)
+                if observer:
+                    observer(response.status_code, time.monotonic() - started)
+                if not self.retry_status(response.status_code, idempotent) or attempt == self.max_retries:
+                    return response
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                reason = f"HTTP {response.status_code}"
+
+            logger.warning("🔁 %s %s: %s, повтор %d/%d через %.1f с", self.name, endpoint, reason, attempt + 1,
+                           self.max_retries, delay)
+            time.sleep(delay)
+
+    def retry_status(self, status_code: int, idempotent: bool) -> bool:
+        """Повторять ли запрос после ответа с этим кодом"""
+        return status_code in (self.RETRY_STATUSES if idempotent else self.UNSENT_STATUSES)
+
+    @staticmethod
+    def not_connected(error: Exception) -> bool:
+        """
+        Ошибка до отправки запроса: соединение не установлено. Обрыв уже
+        установленного соединения ("Connection aborted") сюда не относится -
+        сервер мог получить запрос.
+        """
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    async def arequest(self, method: str, endpoint: str, url: str, idempotent: bool = False, **kwargs):
+        """Асинхронный вариант request(): синхронный запрос в пуле потоков"""
+        return await asyncio.to_thread(self.request, method, endpoint, url, idempotent, **kwargs)
+
+    async def aclose(self):
+        self.session.close()
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def retry_after(self, response: requests.Response) -> Optional[float]:
+        """Задержка из заголовка Retry-After (секунды или HTTP-дата)"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+                delay = (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0.0), self.backoff_max)
+
+    def endpoint_latency(self, endpoint: str) -> LatencyHistogram:
+        """Гистограмма задержек эндпоинта (создается при первом обращении)"""
+        with self._latency_lock:
+            if endpoint not in self.latency:
+                self.latency[endpoint] = metrics.histogram(
+                    'autoresponder_http_request_seconds', 'Длительность HTTP-запросов к внешним API',
+                    ('client', 'endpoint')
+                ).child(client=self.name, endpoint=endpoint)
+            return self.latency[endpoint]
+
+    def latency_summary(self) -> List[str]:
+        """Строки вида 'эндпоинт: N запросов, p50 ≤ x с, p95 ≤ y с'"""
+        with self._latency_lock:
+            items = sorted(self.latency.items())
+        return [
+            f"{self.name} {endpoint}: {histogram.count} запросов, "
+            f"p50 ≤ {histogram.quantile(0.5):g} с, p95 ≤ {histogram.quantile(0.95):g} с"
+            for endpoint, histogram in items
+        ]
+
+class AsyncResponse:
+    """Ответ aiohttp с тем же интерфейсом, что у requests.Response"""
+
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncHTTPClient(HTTPClient):
+    """
+    HTTPClient для asyncio: arequest() выполняет запрос через aiohttp на цикле
+    событий с теми же правилами повторов. Синхронный request() по-прежнему
+    доступен (им пользуются редкие вызовы вроде обновления токена).
+    """
+
+    def __init__(self, name: str, pool_size: int = 10, **kwargs):
+        super().__init__(name, pool_size=pool_size, **kwargs)
+        self.pool_size = pool_size
+        self._async_session = None
+        self.available()
+
+    @staticmethod
+    def available() -> bool:
+        """Импортирует aiohttp; False - не установлен (асинхронный режим работает через пул потоков)"""
+        global aiohttp
+        if aiohttp is None:
+            try:
+                import aiohttp as aiohttp_module
+            except ImportError:
+                return False
+            aiohttp = aiohttp_module
+        return True
+
+    def async_session(self):
+        """Сессия aiohttp создается внутри работающего цикла событий"""
+        if self._async_session is None or self._async_session.closed:
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size)
+            )
+        return self._async_session
+
+    async def arequest(self, method: str, endpoint: str, url: str, idempotent: bool = False,
+                       **kwargs) -> AsyncResponse:
+        """
+        Асинхронный запрос с повторами по тем же правилам, что у request():
+        неидемпотентный запрос повторяется, только если он не дошел до сервера.
+        """
+        if aiohttp is None:
+            return await super().arequest(method, endpoint, url, idempotent, **kwargs)
+
+        connect_timeout, read_timeout = kwargs.pop('timeout', self.timeout)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        observer = kwargs.pop('observer', None)
+        histogram = self.endpoint_latency(endpoint)
+        session = self.async_session()
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                async with session.request(method, url, timeout=timeout, **kwargs) as raw:
+                    response = AsyncResponse(raw.status, raw.headers, await raw.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                histogram.observe(time.monotonic() - started)
+                if observer:
+                    observer(None, time.monotonic() - started)
+                not_connected = isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+                if not (idempotent or not_connected) or attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                reason = type(e).__name__
+            else:
+                histogram.observe(time.monotonic() - started)
+                if observer:
+                    observer(response.status_code, time.monotonic() - started)
+                if not self.retry_status(response.status_code, idempotent) or attempt == self.max_retries:
+                    return response
+                delay = self.retry_after(response)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                reason = f"HTTP {response.status_code}"
+
+            logger.warning("🔁 %s %s: %s, повтор %d/%d через %.1f с", self.name, endpoint, reason, attempt + 1,
+                           self.max_retries, delay)
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        if self._async_session is not None:
+            await self._async_session.close()
+        await super().aclose()
+
+class CircuitOpenError(Exception):
+    """Операция не выполнялась: выключатель разомкнут"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name}: выключатель разомкнут, повтор через {retry_in:.0f} с")
+        self.name = name
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    Выключатель операции внешнего API. Замкнут (closed) - вызовы проходят;
+    после failure_threshold неудач подряд размыкается (open), и вызовы сразу
+    получают CircuitOpenError вместо ожидания таймаутов. Через reset_timeout
+    пропускает half_open_calls пробных вызовов (half_open): успех замыкает
+    его, неудача снова размыкает с удвоенной паузой (до max_reset_timeout).
+    failure_threshold=0 - выключатель никогда не размыкается.
+    """
+
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 max_reset_timeout: float = 300.0, half_open_calls: int = 1, on_close=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+        self.half_open_calls = max(1, half_open_calls)
+        # on_close() вызывается при замыкании: отложенные вызовы можно выполнять
+        self.on_close = on_close
+        self.state = 'closed'
+        self.failures = 0
+        self.open_timeout = reset_timeout
+        self.open_until = 0.0
+        self.trials = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        metrics.gauge('autoresponder_circuit_state', 'Состояние выключателя: 0 - замкнут, 1 - пробные вызовы, '
+                      '2 - разомкнут', ('breaker',)).set_function(lambda: self.STATES[self.state], breaker=name)
+        self.rejections = metrics.counter('autoresponder_circuit_rejected_total',
+                                          'Вызовы, отклоненные разомкнутым выключателем', ('breaker',))
+
+    def available(self) -> bool:
+        """Пропустит ли выключатель вызов сейчас (пробный слот не занимается)"""
+        with self._lock:
+            if self.state == 'open':
+                return time.monotonic() >= self.open_until
+            return self.state == 'closed' or self.trials < self.half_open_calls
+
+    def retry_in(self) -> float:
+        """Сколько секунд до пробного вызова (0 - вызовы уже пропускаются)"""
+        with self._lock:
+            return max(0.0, self.open_until - time.monotonic()) if self.state == 'open' else 0.0
+
+    def check(self):
+        """Разрешение на вызов; CircuitOpenError, если выключатель разомкнут или пробные слоты заняты"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open' and now >= self.open_until:
+                self.state = 'half_open'
+                self.trials = 0
+                logger.info(f"🔌 {self.name}: пробный вызов после {self.open_timeout:.0f} с паузы")
+            if self.state == 'closed':
+                return
+            if self.state == 'half_open' and self.trials < self.half_open_calls:
+                self.trials += 1
+                return
+            self.rejected += 1
+            retry_in = max(0.0, self.open_until - now)
+        self.rejections.inc(breaker=self.name)
+        raise CircuitOpenError(self.name, retry_in)
+
+    def record(self, success: Optional[bool]):
+        """Исход вызова, пропущенного check(); None - вызов не состоялся (например, отказал ограничитель)"""
+        with self._lock:
+            previous = self.state
+            if self.state == 'half_open':
+                self.trials = max(0, self.trials - 1)
+            if success:
+                self.failures = 0
+                self.state = 'closed'
+                self.open_timeout = self.reset_timeout
+            elif success is not None:
+                self.failures += 1
+                if self.state == 'half_open':
+                    self.open_timeout = min(self.open_timeout * 2, self.max_reset_timeout)
+                if self.state == 'half_open' or (self.state == 'closed' and self.failure_threshold and
+                                                 self.failures >= self.failure_threshold):
+                    self.state = 'open'
+                    self.open_until = time.monotonic() + self.open_timeout
+            state = self.state
+
+        if state == 'open' and previous != 'open':
+            logger.warning(f"🔌 {self.name}: {self.failures} неудач подряд, выключатель разомкнут на "
+                           f"{self.open_timeout:.0f} с")
+        elif state == 'closed' and previous != 'closed':
+            logger.info(f"🔌 {self.name}: выключатель замкнут")
+            if self.on_close:
+                self.on_close()
+
+    def snapshot(self) -> Dict:
+        """Состояние для /health"""
+        with self._lock:
+            return {
+                'name': self.name,
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'retry_in_seconds': round(max(0.0, self.open_until - time.monotonic()), 1)
+                if self.state == 'open' else None,
+                'rejected': self.rejected
+            }
+
 class PyrusAPI:
     """Класс для работы с Pyrus CRM API"""
 
-    def __init__(self, login: str, security_key: str):
+    def __init__(self, login: str, security_key: str, http: Optional[HTTPClient] = None,
+                 base_url: str = "https://api.pyrus.com/v4", token_ttl: int = 3600,
+                 refresh_margin: int = 60, breakers: Optional[Dict[str, CircuitBreaker]] = None):
         self.login = login
         self.security_key = security_key
-        self.base_url = "https://api.pyrus.com/v4"
+        self.base_url = base_url.rstrip('/')
+        self.http = http or HTTPClient('pyrus')
+        # Токен запрашивается при первом обращении, а не при запуске бота
         self.auth_token = None
-        self.authenticate()
+        self.token_expires_at = 0.0
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self._token_lock = threading.Condition()
+        self._refresh_in_flight = False
+        # Выключатели операций create_task и form_register (CircuitBreaker)
+        self.breakers = breakers or {}
+
+    def get_token(self, stale_token: Optional[str] = None) -> Optional[str]:
+        """
+        Возвращает действующий токен, при необходимости обновляя его.
+        stale_token - токен, который сервер отклонил с 401: обновление
+        выполняется, только если никто еще не заменил его новым.
+        Одновременные вызовы ждут одно общее обращение к /auth.
+        """
+        with self._token_lock:
+            token_fresh = time.monotonic() < self.token_expires_at - self.refresh_margin
+            if self.auth_token and self.auth_token != stale_token and token_fresh:
+                return self.auth_token
+            if self._refresh_in_flight:
+                # Обновление уже идет в другом потоке - берем его результат
+                while self._refresh_in_flight:
+                    self._token_lock.wait()
+                return self.auth_token
+            self._refresh_in_flight = True
+
+        try:
+            self.authenticate()
+        finally:
+            with self._token_lock:
+                self._refresh_in_flight = False
+                self._token_lock.notify_all()
+
+        return self.auth_token
 
     def authenticate(self):
         """Аутентификация в Pyrus API"""
@@ -49,11 +1054,12 @@ class PyrusAPI:
                 "security_key": self.security_key
             }
 
-            response = requests.post(auth_url, json=auth_data)
+            response = self.http.post('auth', auth_url, idempotent=True, json=auth_data)
 
             if response.status_code == 200:
                 data = response.json()
                 self.auth_token = data.get('access_token')
+                self.token_expires_at = time.monotonic() + float(data.get('expires_in') or self.token_ttl)
                 logger.info("✅ Успешная аутентификация в Pyrus CRM")
                 return True
             else:
@@ -64,226 +1070,3384 @@ class PyrusAPI:
             logger.error(f"❌ Исключение при аутентификации в Pyrus: {e}")
             return False
 
+    async def aget_token(self, stale_token: Optional[str] = None) -> Optional[str]:
+        """Асинхронный get_token(): обновление выполняется в потоке с общим single-flight"""
+        token_fresh = time.monotonic() < self.token_expires_at - self.refresh_margin
+        if self.auth_token and self.auth_token != stale_token and token_fresh:
+            return self.auth_token
+        return await asyncio.to_thread(self.get_token, stale_token)
+
     def create_task(self, form_id: int, task_data: Dict) -> Optional[str]:
-        """Создает задачу в Pyrus CRM"""
+        """Создает задачу в Pyrus CRM. CircuitOpenError - Pyrus недоступен, вызов не выполнялся"""
+        breaker = self.breakers.get('create_task')
+        if breaker:
+            breaker.check()
+        task_id = None
         try:
-            if not self.auth_token:
+            token = self.get_token()
+            if not token:
                 logger.error("❌ Нет токена аутентификации для Pyrus")
                 return None
 
             create_url = f"{self.base_url}/tasks"
-            headers = {
-                'Authorization': f'Bearer {self.auth_token}',
-                'Content-Type': 'application/json'
-            }
+            task_payload = self.task_payload(form_id, task_data)
 
-            # Формируем данные для создания задачи
-            task_payload = {
-                "form_id": form_id,
-                "text": f"Новая заявка с сайта от {datetime.now().strftime('%d.%m.%Y %H:%M')}",
-                "fields": []
-            }
+            response = self.http.post('tasks', create_url, json=task_payload, headers=self.auth_headers(token))
 
-            # Добавляем поля из данных заявки
-            for field_name, value in task_data.items():
-                task_payload["fields"].append({
-                    "name": field_name,
-                    "value": str(value)
-                })
+            if response.status_code == 401:
+                # Токен истек или отозван: обновляем один раз и повторяем запрос
+                logger.warning("🔑 Pyrus отклонил токен, обновляем")
+                token = self.get_token(stale_token=token)
+                if not token:
+                    logger.error("❌ Не удалось обновить токен Pyrus")
+                    return None
+                response = self.http.post('tasks', create_url, json=task_payload, headers=self.auth_headers(token))
 
-            response = requests.post(create_url, json=task_payload, headers=headers)
+            task_id = self.task_id_from_response(response)
+            return task_id
 
-            if response.status_code == 200:
-                data = response.json()
-                task_id = data.get('task', {}).get('id')
-                logger.info(f"✅ Создана задача в Pyrus CRM: {task_id}")
-                return str(task_id)
-            else:
-                logger.error(f"❌ Ошибка создания задачи в Pyrus: {response.status_code} - {response.text}")
+        except Exception as e:
+            logger.error(f"❌ Исключение при создании задачи в Pyrus: {e}")
+            return None
+        finally:
+            if breaker:
+                breaker.record(task_id is not None)
+
+    async def acreate_task(self, form_id: int, task_data: Dict) -> Optional[str]:
+        """Асинхронный вариант create_task()"""
+        breaker = self.breakers.get('create_task')
+        if breaker:
+            breaker.check()
+        task_id = None
+        try:
+            token = await self.aget_token()
+            if not token:
+                logger.error("❌ Нет токена аутентификации для Pyrus")
                 return None
 
+            create_url = f"{self.base_url}/tasks"
+            task_payload = self.task_payload(form_id, task_data)
+
+            response = await self.http.arequest('POST', 'tasks', create_url, json=task_payload,
+                                                headers=self.auth_headers(token))
+
+            if response.status_code == 401:
+                logger.warning("🔑 Pyrus отклонил токен, обновляем")
+                token = await self.aget_token(stale_token=token)
+                if not token:
+                    logger.error("❌ Не удалось обновить токен Pyrus")
+                    return None
+                response = await self.http.arequest('POST', 'tasks', create_url, json=task_payload,
+                                                    headers=self.auth_headers(token))
+
+            task_id = self.task_id_from_response(response)
+            return task_id
+
+        except asyncio.CancelledError:
+            # Прерван при остановке: исход неизвестен
+            if breaker:
+                breaker.record(None)
+                breaker = None
+            raise
         except Exception as e:
             logger.error(f"❌ Исключение при создании задачи в Pyrus: {e}")
             return None
+        finally:
+            if breaker:
+                breaker.record(task_id is not None)
+
+    def form_register(self, form_id: int, created_after: Optional[datetime] = None) -> Optional[List[Dict]]:
+        """Задачи формы (реестр), созданные после created_after; None - реестр недоступен"""
+        breaker = self.breakers.get('form_register')
+        if breaker:
+            breaker.check()
+        tasks = None
+        try:
+            token = self.get_token()
+            if not token:
+                logger.error("❌ Нет токена аутентификации для Pyrus")
+                return None
+
+            register_url = f"{self.base_url}/forms/{form_id}/register"
+            params = {'include_archived': 'y'}
+            if created_after:
+                params['created_after'] = created_after.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+            response = self.http.get('register', register_url, params=params, headers=self.auth_headers(token))
+            if response.status_code == 401:
+                logger.warning("🔑 Pyrus отклонил токен, обновляем")
+                token = self.get_token(stale_token=token)
+                if not token:
+                    logger.error("❌ Не удалось обновить токен Pyrus")
+                    return None
+                response = self.http.get('register', register_url, params=params, headers=self.auth_headers(token))
+
+            if response.status_code == 200:
+                tasks = response.json().get('tasks', [])
+                return tasks
+            logger.error(f"❌ Ошибка чтения реестра формы Pyrus: {response.status_code} - {response.text}")
+            return None
+
+        except Exception as e:
+            logger.error(f"❌ Исключение при чтении реестра формы Pyrus: {e}")
+            return None
+        finally:
+            if breaker:
+                breaker.record(tasks is not None)
+
+    def check_access(self, form_id: int) -> bool:
+        """Проверка для мониторинга: токен действителен и форма доступна на чтение"""
+        token = self.get_token()
+        if not token or not form_id:
+            return token is not None
+        form_url = f"{self.base_url}/forms/{form_id}"
+        response = self.http.get('form', form_url, headers=self.auth_headers(token))
+        if response.status_code == 401:
+            token = self.get_token(stale_token=token)
+            if not token:
+                return False
+            response = self.http.get('form', form_url, headers=self.auth_headers(token))
+        if response.status_code != 200:
+            raise RuntimeError(f"форма {form_id}: HTTP {response.status_code}")
+        return True
+
+    @staticmethod
+    def task_fields(task: Dict) -> Dict[str, str]:
+        """Значения полей задачи из реестра по названию поля"""
+        return {
+            field.get('name', ''): str(field.get('value') or '')
+            for field in task.get('fields', [])
+        }
+
+    @staticmethod
+    def task_payload(form_id: int, task_data: Dict) -> Dict:
+        """Формирует данные для создания задачи"""
+        return {
+            "form_id": form_id,
+            "text": f"Новая заявка с сайта от {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+            "fields": [
+                {"name": field_name, "value": str(value)}
+                for field_name, value in task_data.items()
+            ]
+        }
+
+    @staticmethod
+    def task_id_from_response(response) -> Optional[str]:
+        """ID созданной задачи из ответа Pyrus или None"""
+        if response.status_code == 200:
+            data = response.json()
+            task_id = data.get('task', {}).get('id')
+            logger.info("✅ Создана задача в Pyrus CRM: %s", task_id, extra={'category': 'delivery'})
+            return str(task_id)
+        logger.error(f"❌ Ошибка создания задачи в Pyrus: {response.status_code} - {response.text}")
+        return None
+
+    @staticmethod
+    def auth_headers(token: str) -> Dict:
+        return {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+
+class Priority:
+    """Приоритеты исходящих отправок: меньше значение - раньше выполнение"""
+
+    HIGH = 0      # ручные проверки (/test_whatsapp)
+    NORMAL = 1    # свежие заявки
+    BULK = 2      # повторная доставка из outbox
+
+    NAMES = {HIGH: 'high', NORMAL: 'normal', BULK: 'bulk'}
+
+
+class SendRateLimiter:
+    """
+    Ограничитель отправок одного инстанса Green API. Сочетает ведро токенов
+    (rate сообщений в секунду, не больше burst подряд), лимит за скользящие
+    сутки и адаптивный предел одновременных запросов (AIMD): ответ 429/502/
+    503/504, ошибка соединения или ответ дольше slow_threshold уменьшают
+    предел вдвое, каждый быстрый успешный ответ увеличивает его на 1/предел.
+    Слоты выдаются по приоритету (Priority), при равном - по очереди.
+    """
+
+    CONGESTION_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, name: str, rate: float = 1.0, burst: int = 5, daily_limit: int = 0,
+                 max_concurrency: int = 4, min_concurrency: int = 1, slow_threshold: float = 5.0):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.daily_limit = daily_limit
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.slow_threshold = slow_threshold
+
+        self.tokens = float(self.burst)
+        self.refilled_at = time.monotonic()
+        self.limit = float(self.max_concurrency)
+        self.active = 0
+        self.decreased_at = 0.0
+        self._waiters = []
+        # Асинхронные ожидающие: билет -> (цикл событий, Future пробуждения)
+        self._async_waiters = {}
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.events = StatsCore(('granted',))
+
+        self.sends = metrics.counter(
+            'autoresponder_whatsapp_limiter_total', 'Решения ограничителя отправок WhatsApp', ('instance', 'result')
+        )
+        self.queue_delay = metrics.histogram(
+            'autoresponder_whatsapp_queue_seconds', 'Ожидание слота отправки WhatsApp', ('instance', 'priority')
+        )
+        metrics.gauge('autoresponder_whatsapp_send_rate', 'Отправок WhatsApp в секунду за последнюю минуту',
+                      ('instance',)).set_function(self.send_rate, instance=name)
+        metrics.gauge('autoresponder_whatsapp_concurrency_limit', 'Текущий предел одновременных отправок WhatsApp',
+                      ('instance',)).set_function(lambda: int(self.limit), instance=name)
+        metrics.gauge('autoresponder_whatsapp_waiting', 'Отправок WhatsApp в ожидании слота',
+                      ('instance',)).set_function(lambda: len(self._waiters), instance=name)
+
+    def send_rate(self) -> float:
+        """Фактическая скорость отправки за последнюю минуту, сообщений в секунду"""
+        return self.events.window('granted', '1m') / 60
+
+    def acquire(self, priority: int = Priority.NORMAL, timeout: Optional[float] = None) -> bool:
+        """Ждет слот отправки. False - суточный лимит исчерпан или истек timeout"""
+        started = time.monotonic()
+        ticket = (priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    wait = self._try_take(ticket)
+                    if wait is None:
+                        break
+                    if wait is False:
+                        return False
+                    if timeout is not None:
+                        remaining = started + timeout - time.monotonic()
+                        if remaining <= 0:
+                            self._forget(ticket)
+                            return False
+                        wait = min(wait, remaining) if wait else remaining
+                    self._cond.wait(wait or None)
+            except BaseException:
+                self._forget(ticket)
+                raise
+        self._granted(priority, started)
+        return True
+
+    async def aacquire(self, priority: int = Priority.NORMAL) -> bool:
+        """
+        Асинхронный вариант acquire(): ждет, не блокируя цикл событий. Освободившийся
+        слот будит первого в очереди через его Future; по таймеру ждется только
+        пополнение ведра токенов.
+        """
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        ticket = (priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(ticket)
+                    if wait is None:
+                        break
+                    if wait is False:
+                        return False
+                    woken = loop.create_future()
+                    self._async_waiters[ticket] = (loop, woken)
+                await asyncio.wait((woken,), timeout=wait or None)
+        except BaseException:
+            with self._cond:
+                self._forget(ticket)
+            raise
+        finally:
+            with self._cond:
+                self._async_waiters.pop(ticket, None)
+        self._granted(priority, started)
+        return True
+
+    def release(self):
+        """Возвращает слот после завершения запроса"""
+        with self._cond:
+            self.active -= 1
+            self._notify()
+
+    def observe(self, status_code: Optional[int], latency: float):
+        """
+        Результат одной попытки запроса (наблюдатель HTTPClient): перегрузка
+        уменьшает предел одновременных запросов, быстрый успех - увеличивает.
+        """
+        congested = status_code is None or status_code in self.CONGESTION_STATUSES
+        slow = latency > self.slow_threshold
+        with self._cond:
+            now = time.monotonic()
+            if congested or slow:
+                # Ответы на запросы, отправленные до прошлого снижения, повторно предел не снижают
+                if now - latency >= self.decreased_at:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self.decreased_at = now
+                    logger.warning(f"🐢 WhatsApp {self.name}: {'ответ ' + str(status_code) if status_code else 'ошибка соединения'}"
+                                   f"{', медленно' if slow else ''} - до {int(self.limit)} одновременных отправок")
+                if status_code == 429:
+                    # Инстанс просит притормозить: новые отправки ждут следующий токен
+                    self.tokens = min(self.tokens, 0.0)
+            elif status_code < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._notify()
+        result = 'throttled' if status_code == 429 else 'congested' if congested else 'slow' if slow else 'ok'
+        self.sends.inc(instance=self.name, result=result)
+
+    def _try_take(self, ticket):
+        """
+        Под блокировкой: выдает слот первому в очереди. Возвращает None - слот
+        выдан, False - отказ, иначе сколько ждать (0 - до освобождения слота).
+        """
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+        if self.daily_limit and self.events.window('granted', '24h') >= self.daily_limit:
+            self._forget(ticket)
+            self.sends.inc(instance=self.name, result='refused')
+            logger.warning(f"⛔ WhatsApp {self.name}: исчерпан суточный лимит ({self.daily_limit} сообщений)")
+            return False
+        if self._waiters[0] != ticket or self.active >= int(self.limit):
+            return 0
+        if self.rate > 0 and self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+
+        heapq.heappop(self._waiters)
+        if self.rate > 0:
+            self.tokens -= 1
+        self.active += 1
+        # Следующий в очереди мог ждать только нас
+        self._notify()
+        return None
+
+    def _forget(self, ticket):
+        if ticket in self._waiters:
+            self._waiters.remove(ticket)
+            heapq.heapify(self._waiters)
+            self._notify()
+
+    def _notify(self):
+        """Под блокировкой: будит синхронных ожидающих и первого в очереди, если он асинхронный"""
+        self._cond.notify_all()
+        if self._waiters and self._waiters[0] in self._async_waiters:
+            loop, woken = self._async_waiters[self._waiters[0]]
+            loop.call_soon_threadsafe(self._wake, woken)
+
+    @staticmethod
+    def _wake(woken: asyncio.Future):
+        if not woken.done():
+            woken.set_result(None)
+
+    def _granted(self, priority: int, started: float):
+        self.events.inc('granted')
+        self.sends.inc(instance=self.name, result='granted')
+        self.queue_delay.observe(time.monotonic() - started, instance=self.name,
+                                 priority=Priority.NAMES.get(priority, str(priority)))
+
 
 class GreenAPI:
     """Класс для работы с Green API WhatsApp"""
 
-    def __init__(self, instance_id: str, api_token: str):
+    def __init__(self, instance_id: str, api_token: str, http: Optional[HTTPClient] = None,
+                 api_url: str = "https://api.green-api.com", limiter: Optional[SendRateLimiter] = None,
+                 breakers: Optional[Dict[str, CircuitBreaker]] = None):
         self.instance_id = instance_id
         self.api_token = api_token
-        self.base_url = f"https://api.green-api.com/waInstance{instance_id}"
+        self.base_url = f"{api_url.rstrip('/')}/waInstance{instance_id}"
+        self.http = http or HTTPClient('green-api')
+        self.limiter = limiter
+        # Выключатель операции send_message (CircuitBreaker)
+        self.breakers = breakers or {}
 
     def get_state_instance(self) -> bool:
         """Проверяет состояние инстанса WhatsApp"""
         try:
             url = f"{self.base_url}/getStateInstance/{self.api_token}"
-            response = requests.get(url, timeout=30)
+            response = self.http.get('getStateInstance', url)
 
             if response.status_code == 200:
                 data = response.json()
                 state = data.get('stateInstance')
-                logger.info(f"📱 Состояние WhatsApp инстанса: {state}")
+                logger.debug("📱 Состояние WhatsApp инстанса: %s", state)
                 return state == 'authorized'
             else:
                 logger.error(f"❌ Ошибка проверки состояния WhatsApp: {response.status_code}")
                 return False
 
-        except Exception as e:
-            logger.error(f"❌ Исключение при проверке состояния WhatsApp: {e}")
-            return False
+        except Exception as e:
+            logger.error(f"❌ Исключение при проверке состояния WhatsApp: {e}")
+            return False
+
+    def send_message(self, phone: str, message: str, priority: int = Priority.NORMAL) -> bool:
+        """
+        Отправляет сообщение через WhatsApp (с учетом ограничителя инстанса).
+        CircuitOpenError - Green API недоступен, отправка не выполнялась.
+        """
+        breaker = self.breakers.get('send_message')
+        if breaker:
+            breaker.check()
+        if self.limiter and not self.limiter.acquire(priority):
+            if breaker:
+                breaker.record(None)
+            return False
+        sent = False
+        try:
+            url = f"{self.base_url}/sendMessage/{self.api_token}"
+            response = self.http.post('sendMessage', url, json=self.message_payload(phone, message),
+                                      observer=self.limiter.observe if self.limiter else None)
+            sent = self.sent_from_response(phone, response)
+            return sent
+
+        except Exception as e:
+            logger.error(f"❌ Исключение при отправке WhatsApp сообщения: {e}")
+            return False
+        finally:
+            if breaker:
+                breaker.record(sent)
+            if self.limiter:
+                self.limiter.release()
+
+    async def asend_message(self, phone: str, message: str, priority: int = Priority.NORMAL) -> bool:
+        """Асинхронный вариант send_message()"""
+        breaker = self.breakers.get('send_message')
+        if breaker:
+            breaker.check()
+        if self.limiter and not await self.limiter.aacquire(priority):
+            if breaker:
+                breaker.record(None)
+            return False
+        sent = False
+        try:
+            url = f"{self.base_url}/sendMessage/{self.api_token}"
+            response = await self.http.arequest('POST', 'sendMessage', url, json=self.message_payload(phone, message),
+                                                observer=self.limiter.observe if self.limiter else None)
+            sent = self.sent_from_response(phone, response)
+            return sent
+
+        except asyncio.CancelledError:
+            # Прерван при остановке: исход неизвестен
+            if breaker:
+                breaker.record(None)
+                breaker = None
+            raise
+        except Exception as e:
+            logger.error(f"❌ Исключение при отправке WhatsApp сообщения: {e}")
+            return False
+        finally:
+            if breaker:
+                breaker.record(sent)
+            if self.limiter:
+                self.limiter.release()
+
+    def message_payload(self, phone: str, message: str) -> Dict:
+        """Тело запроса sendMessage (номер приводится к формату Green API)"""
+        return {
+            "chatId": f"{self.format_phone_number(phone)}@c.us",
+            "message": message
+        }
+
+    @staticmethod
+    def sent_from_response(phone: str, response) -> bool:
+        """Разбирает ответ sendMessage"""
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('idMessage'):
+                logger.info("✅ WhatsApp сообщение отправлено на %s", phone, extra={'category': 'delivery'})
+                return True
+            logger.error(f"❌ Не удалось отправить WhatsApp сообщение: {data}")
+            return False
+        logger.error(f"❌ Ошибка Green API: {response.status_code} - {response.text}")
+        return False
+
+    @staticmethod
+    def format_phone_number(phone: str) -> str:
+        """Форматирует номер телефона для Green API"""
+        # Удаляем все лишние символы
+        cleaned = re.sub(r'[^\d+]', '', phone)
+
+        # Если номер начинается с 8, заменяем на 7
+        if cleaned.startswith('8'):
+            cleaned = '7' + cleaned[1:]
+        elif cleaned.startswith('+7'):
+            cleaned = cleaned[1:]
+        elif cleaned.startswith('+'):
+            cleaned = cleaned[1:]
+        elif not cleaned.startswith('7'):
+            cleaned = '7' + cleaned
+
+        return cleaned
+
+class IMAPIdleListener:
+    """
+    Долгоживущая IMAP-сессия: ждет новые письма через IDLE, а если сервер
+    его не поддерживает - опрашивает ящик командой NOOP. Сама переподключается
+    при обрывах и передает управление в on_new_mail(imap) при каждом событии.
+    """
+
+    def __init__(self, server: str, username: str, password: str, on_new_mail,
+                 port: int = 993, use_ssl: bool = True, mailbox: str = "INBOX",
+                 idle_timeout: int = 300, poll_interval: int = 60):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.on_new_mail = on_new_mail
+        self.port = port
+        self.use_ssl = use_ssl
+        self.mailbox = mailbox
+        # RFC 2177 требует перезапускать IDLE не реже чем раз в 29 минут
+        self.idle_timeout = min(idle_timeout, 29 * 60)
+        self.poll_interval = poll_interval
+        self.imap = None
+        self.supports_idle = False
+        # Последняя ошибка подключения или сессии (None после успешного входа)
+        self.last_error = None
+        self._stop = threading.Event()
+
+    def connect(self):
+        """Открывает соединение, логинится и выбирает ящик"""
+        imap_class = imaplib.IMAP4_SSL if self.use_ssl else imaplib.IMAP4
+        with metrics.timer('imap_connect'):
+            imap = imap_class(self.server, self.port)
+            imap.login(self.username, self.password)
+            imap.select(self.mailbox)
+        self.imap = imap
+        self.last_error = None
+        self.supports_idle = 'IDLE' in imap.capabilities
+        mode = "IDLE" if self.supports_idle else f"NOOP каждые {self.poll_interval} с"
+        logger.info(f"📧 IMAP сессия открыта ({self.server}, режим {mode})")
+
+    def disconnect(self):
+        """Закрывает соединение, не выбрасывая исключений"""
+        if not self.imap:
+            return
+        try:
+            self.imap.logout()
+        except Exception:
+            pass
+        self.imap = None
+
+    def stop(self):
+        """Останавливает цикл ожидания писем"""
+        self._stop.set()
+
+    def run(self):
+        """Основной цикл: подключение, обработка ящика, ожидание новых писем"""
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                if not self.imap:
+                    self.connect()
+                    backoff = 1
+                    # Забираем письма, пришедшие пока соединения не было
+                    self.take_news()
+                    self.on_new_mail(self.imap)
+
+                if self.wait_for_mail():
+                    self.take_news()
+                    self.on_new_mail(self.imap)
+
+            except Exception as e:
+                logger.error(f"❌ Ошибка IMAP сессии, переподключение через {backoff} с: {e}")
+                self.last_error = str(e) or type(e).__name__
+                self.disconnect()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+        self.disconnect()
+
+    def take_news(self) -> bool:
+        """
+        Забирает накопленные imaplib уведомления EXISTS/RECENT. Сервер присылает
+        их в ответах на любые команды, в том числе пока обрабатывались письма.
+        """
+        exists = self.imap.untagged_responses.pop('EXISTS', None)
+        recent = self.imap.untagged_responses.pop('RECENT', None)
+        return bool(exists or recent)
+
+    def wait_for_mail(self) -> bool:
+        """Ждет уведомления о новых письмах. Возвращает True, если ящик изменился"""
+        if self.take_news():
+            # Письмо пришло во время обработки предыдущих - IDLE о нем уже не сообщит
+            return True
+        if self.supports_idle:
+            return self._idle(self.idle_timeout)
+
+        if self._stop.wait(self.poll_interval):
+            return False
+        status, data = self.imap.noop()
+        if status != "OK":
+            raise imaplib.IMAP4.abort(f"NOOP вернул {status}")
+        # При поллинге всегда перепроверяем UNSEEN: поиск дешевле, чем разбор ответов NOOP
+        return True
+
+    def has_buffered_data(self) -> bool:
+        """
+        Есть ли уже принятые, но не разобранные строки. select() их не видит:
+        сервер может прислать EXISTS в одном пакете с "+ idling", и imaplib
+        заберет его в буфер файла вместе с продолжением.
+        """
+        sock = self.imap.sock
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(self.imap.file.peek(1))
+        except OSError:
+            # Для SSL неблокирующее чтение без данных дает SSLWantReadError
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def _idle(self, timeout: float) -> bool:
+        """Выполняет одну команду IDLE длительностью до timeout секунд"""
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.send(tag + b" IDLE\r\n")
+
+        response = imap.readline()
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.abort(f"Сервер отклонил IDLE: {response!r}")
+
+        has_news = False
+        deadline = time.monotonic() + timeout
+        sock = imap.sock
+        try:
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                # Ждем данные короткими интервалами, чтобы вовремя реагировать на stop()
+                if not self.has_buffered_data() and not select.select([sock], [], [], 1.0)[0]:
+                    continue
+
+                line = imap.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Сервер закрыл соединение во время IDLE")
+                if line.startswith(b"* BYE"):
+                    raise imaplib.IMAP4.abort(f"Сервер завершил сессию: {line!r}")
+                if line.rstrip().endswith((b"EXISTS", b"RECENT")):
+                    has_news = True
+                    break
+        finally:
+            imap.send(b"DONE\r\n")
+
+        # Дочитываем ответы до завершения команды IDLE
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Сервер закрыл соединение после IDLE")
+            if line.startswith(tag):
+                break
+            if line.rstrip().endswith((b"EXISTS", b"RECENT")):
+                has_news = True
+
+        return has_news
+
+class HTMLTextExtractor(HTMLParser):
+    """Быстрое преобразование HTML письма в текст: без скриптов и стилей, блоки - с новой строки"""
+
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+    BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'blockquote'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        lines = (' '.join(line.split()) for line in ''.join(self.parts).splitlines())
+        return '\n'.join(line for line in lines if line)
+
+    @classmethod
+    def convert(cls, html: str) -> str:
+        parser = cls()
+        parser.feed(html)
+        parser.close()
+        return parser.text()
+
+
+class StreamedPart(email.message.Message):
+    """Часть письма для MIMETextExtractor: о завершении сообщает извлекателю, ненужное содержимое не хранит"""
+
+    def __init__(self, policy=email.policy.compat32, on_complete=None):
+        super().__init__(policy)
+        self.on_complete = on_complete
+
+    def set_payload(self, payload, charset=None):
+        # FeedParser задает содержимое части, дочитав ее до конца
+        if self.on_complete is not None and not self.on_complete(self, payload):
+            payload = ''
+        super().set_payload(payload, charset)
+
+
+class MIMETextExtractor:
+    """
+    Потоковое извлечение текста письма на BytesFeedParser. Письмо подается
+    кусками; разбор останавливается, как только дочитана первая text/plain
+    часть. Содержимое вложений не сохраняется в дереве письма, текст
+    декодируется по объявленной кодировке, а при отсутствии text/plain
+    используется text/html, преобразованный в текст.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    # Без объявленной кодировки русские письма чаще всего в windows-1251 или KOI8-R
+    FALLBACK_CHARSETS = ('utf-8', 'cp1251', 'koi8-r')
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.text_part = None
+        self.html_part = None
+        self.skipped_bytes = 0
+
+    def extract(self, data: bytes) -> str:
+        """Текст письма из байтов RFC822"""
+        return self.extract_chunks(data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size))
+
+    def extract_chunks(self, chunks: Iterable[bytes]) -> str:
+        """Текст письма из последовательности кусков (например, чтения из файла или сокета)"""
+        parser = BytesFeedParser(_factory=functools.partial(StreamedPart, on_complete=self.part_complete))
+        for chunk in chunks:
+            parser.feed(chunk)
+            if self.text_part is not None:
+                # Остаток письма (обычно вложения) не читаем
+                break
+        else:
+            # Последняя часть завершается только концом данных
+            parser.close()
+
+        if self.text_part is not None:
+            return self.part_text(self.text_part)
+        if self.html_part is not None:
+            return HTMLTextExtractor.convert(self.part_text(self.html_part))
+        return ""
+
+    def part_complete(self, part: StreamedPart, payload) -> bool:
+        """Колбэк StreamedPart: True - сохранить содержимое части"""
+        if part.get_content_disposition() == 'attachment':
+            self.skipped_bytes += len(payload) if isinstance(payload, str) else 0
+            return False
+        content_type = part.get_content_type()
+        if content_type == 'text/plain':
+            if self.text_part is None:
+                self.text_part = part
+            return True
+        if content_type == 'text/html' and self.html_part is None:
+            self.html_part = part
+            return True
+        if part.get_content_maintype() == 'multipart':
+            # Преамбула multipart без границ - сохраняем как есть
+            return True
+        self.skipped_bytes += len(payload) if isinstance(payload, str) else 0
+        return False
+
+    @classmethod
+    def part_text(cls, part: email.message.Message) -> str:
+        payload = part.get_payload(decode=True)
+        if not isinstance(payload, bytes):
+            return ""
+        return cls.decode_text(payload, part.get_content_charset())
+
+    @classmethod
+    def decode_text(cls, payload: bytes, charset: Optional[str] = None) -> str:
+        """Декодирует текст по объявленной кодировке, иначе подбирает ее из FALLBACK_CHARSETS"""
+        if charset:
+            try:
+                return payload.decode(charset)
+            except (LookupError, UnicodeDecodeError):
+                pass
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        # В windows-1251 строчные буквы занимают 0xE0-0xFF, в KOI8-R - 0xC0-0xDF;
+        # в обычном тексте строчных больше, чем прописных
+        cp1251_lower = len(payload) - len(payload.translate(None, bytes(range(0xE0, 0x100))))
+        koi8_lower = len(payload) - len(payload.translate(None, bytes(range(0xC0, 0xE0))))
+        guessed = 'koi8-r' if koi8_lower > cp1251_lower else 'cp1251'
+        return payload.decode(guessed, errors='replace')
+
+
+class IMAPBatchFetcher:
+    """
+    Пакетная выборка писем по UID. Для каждой пачки сначала запрашиваются
+    BODYSTRUCTURE и тема, затем одной командой - только нужная текстовая
+    часть (BODY.PEEK, без вложений), а флаг Seen ставится одним STORE.
+    """
+
+    # Токены ответа FETCH: скобки, строки в кавычках, атомы вида BODY[1.2]
+    TOKEN_PATTERN = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?')
+    LITERAL_PATTERN = re.compile(rb'\{(\d+)\}$')
+    OPEN, CLOSE = object(), object()
+
+    def __init__(self, imap, body_extractor, batch_size: int = 50):
+        self.imap = imap
+        self.body_extractor = body_extractor
+        self.batch_size = max(1, batch_size)
+
+    def search_unseen(self) -> List[int]:
+        """Возвращает UID непрочитанных писем"""
+        status, data = self.imap.uid('SEARCH', None, 'UNSEEN')
+        if status != "OK" or not data or not data[0]:
+            return []
+        return sorted(int(uid) for uid in data[0].split())
+
+    def batches(self, uids: List[int]) -> List[List[int]]:
+        """Делит список UID на пачки по batch_size"""
+        return [uids[i:i + self.batch_size] for i in range(0, len(uids), self.batch_size)]
+
+    def fetch_texts(self, uids: List[int]) -> List[Tuple[int, str, str]]:
+        """Возвращает [(uid, тема, текст письма)] для пачки UID"""
+        return [(uid, subject, self.message_text(payload, part)) for uid, subject, payload, part in self.fetch_messages(uids)]
+
+    def fetch_messages(self, uids: List[int]) -> List[Tuple[int, str, bytes, Optional[Tuple]]]:
+        """
+        Забирает пачку писем без разбора: [(uid, тема, содержимое, часть)], где
+        часть - результат find_text_part или None, если получено письмо целиком.
+        Разбор выполняет message_text(), в том числе в другом потоке.
+        """
+        status, data = self.imap.uid(
+            'FETCH', self.message_set(uids),
+            '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])'
+        )
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"FETCH BODYSTRUCTURE вернул {status}")
+
+        subjects = {}
+        sections = {}
+        for uid, items in self.parse_fetch_response(data).items():
+            header = next((value for key, value in items.items() if key.startswith('BODY[HEADER')), None)
+            subjects[uid] = email.message_from_bytes(header).get("Subject", "") if header else ""
+            structure = items.get('BODYSTRUCTURE')
+            if isinstance(structure, list):
+                # Без text/plain берем text/html и переводим в текст
+                sections[uid] = self.find_text_part(structure) or self.find_text_part(structure, subtype='html')
+            else:
+                sections[uid] = None
+
+        # Группируем письма по номеру секции, чтобы забрать их одной командой
+        groups = {}
+        for uid, part in sections.items():
+            key = part[0] if part else ''
+            groups.setdefault(key, []).append(uid)
+
+        payloads = {}
+        for section, group in groups.items():
+            status, data = self.imap.uid('FETCH', self.message_set(group), f'(BODY.PEEK[{section}])')
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"FETCH BODY[{section}] вернул {status}")
+            for uid, items in self.parse_fetch_response(data).items():
+                payloads[uid] = items.get(f'BODY[{section}]') or b''
+
+        return [
+            (uid, subjects.get(uid, ""), payloads.get(uid, b''), sections[uid])
+            for uid in uids if uid in sections
+        ]
+
+    def message_text(self, payload: bytes, part: Optional[Tuple]) -> str:
+        """Текст письма из результата fetch_messages()"""
+        with metrics.timer('mime_extract'):
+            if part is None:
+                # Текстовой части не нашлось - потоково разбираем письмо целиком
+                return self.body_extractor(payload)
+            _, encoding, charset, content_type = part
+            text = self.decode_payload(payload, encoding, charset)
+            if content_type == 'text/html':
+                text = HTMLTextExtractor.convert(text)
+            return text
+
+    def mark_seen(self, uids: List[int]):
+        """Помечает пачку писем прочитанными одной командой"""
+        if uids:
+            self.imap.uid('STORE', self.message_set(uids), '+FLAGS.SILENT', '(\\Seen)')
+
+    @staticmethod
+    def message_set(uids: List[int]) -> str:
+        """Сворачивает список UID в диапазоны: [1, 2, 3, 7] -> '1:3,7'"""
+        ranges = []
+        for uid in sorted(set(uids)):
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+    @staticmethod
+    def decode_payload(payload: bytes, encoding: str, charset: str) -> str:
+        """Снимает transfer-encoding с содержимого секции и декодирует текст по charset"""
+        encoding = (encoding or '').lower()
+        if encoding == 'base64':
+            payload = base64.b64decode(payload)
+        elif encoding == 'quoted-printable':
+            payload = quopri.decodestring(payload)
+        return MIMETextExtractor.decode_text(payload, charset)
+
+    @classmethod
+    def find_text_part(cls, structure: list, prefix: str = '',
+                       subtype: str = 'plain') -> Optional[Tuple[str, str, str, str]]:
+        """Ищет в BODYSTRUCTURE первую text/<subtype> часть: (секция, кодировка, charset, тип)"""
+        if structure and isinstance(structure[0], list):
+            # multipart: дочерние части идут списками, затем подтип
+            for index, child in enumerate(structure, start=1):
+                if not isinstance(child, list):
+                    break
+                found = cls.find_text_part(child, f"{prefix}{index}.", subtype)
+                if found:
+                    return found
+            return None
+
+        if len(structure) < 7:
+            return None
+
+        content_type = f"{cls._text(structure[0])}/{cls._text(structure[1])}".lower()
+        params = structure[2] if isinstance(structure[2], list) else []
+        charset = ''
+        for key, value in zip(params[::2], params[1::2]):
+            if cls._text(key).lower() == 'charset':
+                charset = cls._text(value)
+        encoding = cls._text(structure[5])
+
+        if not prefix:
+            # Письмо из одной части: берем его текст целиком, как get_email_body
+            return '1', encoding, charset, content_type
+
+        disposition = structure[9] if content_type.startswith('text/') and len(structure) > 9 else None
+        is_attachment = isinstance(disposition, list) and cls._text(disposition[0]).lower() == 'attachment'
+        if content_type == f'text/{subtype}' and not is_attachment:
+            return prefix.rstrip('.'), encoding, charset, content_type
+        return None
+
+    @classmethod
+    def parse_fetch_response(cls, data: list) -> Dict[int, Dict]:
+        """Разбирает ответ imaplib на FETCH в {uid: {ключ: значение}}"""
+        tokens = []
+        for item in data:
+            if isinstance(item, tuple):
+                head, literal = item
+                tokens.extend(cls._tokenize(cls.LITERAL_PATTERN.sub(b'', head.rstrip())))
+                tokens.append(bytearray(literal))
+            elif item:
+                tokens.extend(cls._tokenize(item))
+
+        stack = [[]]
+        for token in tokens:
+            if token is cls.OPEN:
+                stack.append([])
+            elif token is cls.CLOSE and len(stack) > 1:
+                closed = stack.pop()
+                stack[-1].append(closed)
+            elif token is not cls.CLOSE:
+                stack[-1].append(token)
+
+        result = {}
+        for element in stack[0]:
+            if not isinstance(element, list):
+                continue
+            items = {}
+            for key, value in zip(element[::2], element[1::2]):
+                items[cls._text(key).upper()] = bytes(value) if isinstance(value, bytearray) else value
+            if 'UID' in items:
+                result[int(items['UID'])] = items
+        return result
+
+    @classmethod
+    def _tokenize(cls, data: bytes) -> list:
+        tokens = []
+        for match in cls.TOKEN_PATTERN.finditer(data):
+            token = match.group()
+            if token == b'(':
+                tokens.append(cls.OPEN)
+            elif token == b')':
+                tokens.append(cls.CLOSE)
+            elif token.startswith(b'"'):
+                tokens.append(bytearray(re.sub(rb'\\(.)', rb'\1', token[1:-1])))
+            elif token.upper() == b'NIL':
+                tokens.append(None)
+            else:
+                tokens.append(token)
+        return tokens
+
+    @staticmethod
+    def _text(value) -> str:
+        if value is None:
+            return ''
+        return bytes(value).decode('utf-8', errors='ignore')
+
+class ApplicationParser:
+    """
+    Распознавание заявок с предкомпилированными шаблонами. classify() считает
+    признаки заявки, extract() извлекает поля отдельными поисками по тексту;
+    совпадения номера, формы и телефона, найденные классификатором, парсер
+    не ищет повторно.
+    """
+
+    # Признаки заявки (достаточно двух совпадений)
+    APPLICATION_NUMBER = re.compile(r"Новая заявка № (\d+)", re.IGNORECASE)
+    FORM_NAME = re.compile(r"Название формы: (Application|Заявка)", re.IGNORECASE)
+    FORM_DATA = re.compile(r"Данные формы:", re.IGNORECASE)
+    PHONE = re.compile(r"Телефон: ([+\d\s\(\)\-]+)", re.IGNORECASE)
+    PRICE_DESTINATION = re.compile(r"Куда отправить расчет стоимости", re.IGNORECASE)
+    MIN_SCORE = 2
+
+    # Поля заявки
+    APPLICATION_NUMBER_EXACT = re.compile(r"Новая заявка № (\d+)")
+    EXTRA_PHONES = (
+        re.compile(r"тел[\.:][\s]*([+\d\s\(\)\-]+)", re.IGNORECASE),
+        re.compile(r"телефон[\.:][\s]*([+\d\s\(\)\-]+)", re.IGNORECASE)
+    )
+    NAME = re.compile(r"^(?:Имя|Ваше имя|ФИО|Как к Вам обращаться)[^:\n]*:[ \t]*([^\n]+)",
+                      re.IGNORECASE | re.MULTILINE)
+    AREA = re.compile(r"Площадь строения: ([^\n]+)")
+    BUDGET = re.compile(r"бюджет[^:]*: ([^\n]+)", re.IGNORECASE)
+    LAND = re.compile(r"земельный участок[^:]*: ([^\n]+)", re.IGNORECASE)
+    # Способы связи в порядке приоритета: обычно поиск заканчивается на первом
+    CONTACT_METHODS = (
+        (re.compile(r"whatsapp", re.IGNORECASE), 'whatsapp'),
+        (re.compile(r"telegram", re.IGNORECASE), 'telegram'),
+        (re.compile(r"озвучить по телефону|позвонить", re.IGNORECASE), 'phone_call')
+    )
+
+    HOUSE_KEYWORDS = ('дом', 'коттедж', 'домик', 'house')
+    BATH_KEYWORDS = ('бан', 'сауна', 'парилка', 'bath', 'sauna')
+
+    def analyze(self, text: str) -> Tuple[int, Optional[Dict]]:
+        """Возвращает (число признаков заявки, поля заявки или None, если это не заявка)"""
+        score, matches = self.classify(text)
+        if score < self.MIN_SCORE:
+            return score, None
+        return score, self.extract(text, *matches)
+
+    def classify(self, text: str) -> Tuple[int, tuple]:
+        """Считает признаки заявки; совпадения номера, формы и телефона передаются в extract()"""
+        if not text:
+            return 0, (None, None, None)
+
+        number_match = self.APPLICATION_NUMBER.search(text)
+        form_match = self.FORM_NAME.search(text)
+        phone_match = self.PHONE.search(text)
+
+        score = sum(1 for match in (number_match, form_match, phone_match) if match)
+        if score < self.MIN_SCORE and self.FORM_DATA.search(text):
+            score += 1
+        if score < self.MIN_SCORE and self.PRICE_DESTINATION.search(text):
+            score += 1
+
+        return score, (number_match, form_match, phone_match)
+
+    def extract(self, text: str, number_match=None, form_match=None, phone_match=None) -> Dict:
+        """Извлекает поля заявки. Готовые совпадения признаков используются повторно"""
+        data = {}
+
+        # Номер заявки ищется с учетом регистра: первое совпадение без учета
+        # регистра годится, только если оно записано точно так же
+        if number_match is None or not number_match.group(0).startswith("Новая заявка № "):
+            number_match = self.APPLICATION_NUMBER_EXACT.search(text)
+        if number_match:
+            data['application_number'] = number_match.group(1)
+
+        # Номер телефона
+        if phone_match is None:
+            phone_match = self.PHONE.search(text)
+        if phone_match is None:
+            for pattern in self.EXTRA_PHONES:
+                phone_match = pattern.search(text)
+                if phone_match:
+                    break
+        if phone_match:
+            data['phone'] = phone_match.group(1).strip()
+
+        # Тип объекта (дом или баня), по умолчанию дом
+        text_lower = text.lower()
+        if not any(keyword in text_lower for keyword in self.HOUSE_KEYWORDS) and \
+                any(keyword in text_lower for keyword in self.BATH_KEYWORDS):
+            data['object_type'] = 'bath'
+            data['object_description'] = 'баня'
+        else:
+            data['object_type'] = 'house'
+            data['object_description'] = 'дом'
+
+        name_match = self.NAME.search(text)
+        if name_match:
+            data['name'] = name_match.group(1).strip()
+
+        area_match = self.AREA.search(text)
+        if area_match:
+            data['area'] = area_match.group(1).strip()
+
+        budget_match = self.BUDGET.search(text)
+        if budget_match:
+            data['budget'] = budget_match.group(1).strip()
+
+        land_match = self.LAND.search(text)
+        if land_match:
+            data['has_land'] = land_match.group(1).strip()
+
+        # Способ связи: первый найденный по приоритету
+        data['contact_method'] = next(
+            (method for pattern, method in self.CONTACT_METHODS if pattern.search(text)),
+            'whatsapp'  # по умолчанию WhatsApp
+        )
+
+        # Тип формы
+        if form_match is None:
+            form_match = self.FORM_NAME.search(text)
+        data['form_type'] = form_match.group(1).lower() if form_match else 'application'
+
+        data['created_at'] = datetime.now().isoformat()
+        return data
+
+class DispatchQueue:
+    """
+    Ограниченная очередь исходящих вызовов одной интеграции с пулом рабочих
+    потоков. Обработчики входящих заявок только ставят задачи в очередь;
+    если очередь заполнена, submit() ждет put_timeout секунд и отказывает.
+    Задачи выполняются по приоритету (Priority), при равном - по порядку.
+    """
+
+    def __init__(self, name: str, workers: int = 2, maxsize: int = 100, put_timeout: float = 5.0):
+        self.name = name
+        self.workers = max(1, workers)
+        self.put_timeout = put_timeout
+        self.queue = queue.PriorityQueue(maxsize=maxsize)
+        self._sequence = itertools.count()
+        self._threads = []
+        self._started_at = time.monotonic()
+        self.jobs = metrics.counter('autoresponder_queue_jobs_total', 'Задачи очередей отправки', ('queue', 'result'))
+        metrics.gauge('autoresponder_queue_depth', 'Задач в очереди отправки', ('queue',)).set_function(
+            self.queue.qsize, queue=name
+        )
+
+    def start(self):
+        """Запускает рабочие потоки"""
+        self._started_at = time.monotonic()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"{self.name}-{index + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, put_timeout: Optional[float] = -1, priority: int = Priority.NORMAL,
+               **kwargs) -> Future:
+        """
+        Ставит вызов в очередь. Бросает queue.Full, если очередь переполнена.
+        put_timeout: -1 - значение очереди по умолчанию, 0 - не ждать, None - ждать сколько угодно.
+        """
+        if put_timeout == -1:
+            put_timeout = self.put_timeout
+        future = Future()
+        item = (priority, next(self._sequence), (future, func, args, kwargs))
+        try:
+            if put_timeout == 0:
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=put_timeout)
+        except queue.Full:
+            self._count('rejected')
+            logger.error(f"❌ Очередь {self.name} переполнена ({self.queue.maxsize} задач)")
+            raise
+        self._count('submitted')
+        return future
+
+    def stop(self, timeout: float = 30.0):
+        """Дожидается выполнения поставленных задач и останавливает потоки"""
+        for _ in self._threads:
+            # Маркер остановки - после всех задач любого приоритета
+            self.queue.put((float('inf'), next(self._sequence), None))
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def stats(self) -> Dict:
+        """Глубина очереди, счетчики и пропускная способность (задач в минуту)"""
+        counters = {
+            result: int(self.jobs.value(queue=self.name, result=result))
+            for result in ('submitted', 'completed', 'failed', 'rejected')
+        }
+        elapsed = max(time.monotonic() - self._started_at, 1e-6)
+        counters.update({
+            'depth': self.queue.qsize(),
+            'maxsize': self.queue.maxsize,
+            'workers': self.workers,
+            'per_minute': counters['completed'] * 60 / elapsed
+        })
+        return counters
+
+    def _count(self, result: str):
+        self.jobs.inc(queue=self.name, result=result)
+
+    def _worker(self):
+        while True:
+            _, _, job = self.queue.get()
+            if job is None:
+                break
+            future, func, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+                self._count('completed')
+            except Exception as e:
+                logger.error(f"❌ Ошибка в задаче очереди {self.name}: {e}")
+                self._count('failed')
+                future.set_exception(e)
+
+class AsyncDispatchQueue:
+    """
+    Аналог DispatchQueue для asyncio: задачи - корутины на общем цикле событий,
+    одновременно выполняется не больше concurrency из них, ожидающие получают
+    место по приоритету. submit() можно вызывать из любого потока; интерфейс
+    и счетчики те же, что у DispatchQueue.
+    """
+
+    def __init__(self, name: str, concurrency: int = 50, maxsize: int = 100, put_timeout: float = 5.0):
+        self.name = name
+        self.workers = max(1, concurrency)
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        self.loop = None
+        self._closed = False
+        # Место в очереди: ожидающие плюс выполняющиеся задачи
+        self._slots = threading.Semaphore(maxsize + self.workers)
+        # Места выполнения: занятые и ожидающие по приоритету (только в потоке цикла событий)
+        self._running = 0
+        self._run_waiters = []
+        self._sequence = itertools.count()
+        self._tasks = set()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self.jobs = metrics.counter('autoresponder_queue_jobs_total', 'Задачи очередей отправки', ('queue', 'result'))
+        metrics.gauge('autoresponder_queue_depth', 'Задач в очереди отправки', ('queue',)).set_function(
+            lambda: self._waiting, queue=name
+        )
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Привязывает очередь к работающему циклу событий"""
+        self.loop = loop
+        self._started_at = time.monotonic()
+
+    def submit(self, func, *args, put_timeout: Optional[float] = -1, priority: int = Priority.NORMAL,
+               **kwargs) -> Future:
+        """
+        Ставит корутинную функцию в очередь. Бросает queue.Full, если очередь
+        переполнена или остановлена. put_timeout - как у DispatchQueue.submit().
+        """
+        if put_timeout == -1:
+            put_timeout = self.put_timeout
+        if self._in_loop():
+            # Ждать места в самом цикле событий нельзя - это остановило бы выполнение задач
+            put_timeout = 0
+        acquired = self._slots.acquire(blocking=put_timeout != 0, timeout=put_timeout or None)
+        if acquired and (self._closed or self.loop is None):
+            self._slots.release()
+            acquired = False
+        if not acquired:
+            self._count('rejected')
+            logger.error(f"❌ Очередь {self.name} переполнена или остановлена ({self.maxsize} задач)")
+            raise queue.Full
+
+        self._count('submitted')
+        with self._lock:
+            self._waiting += 1
+        return asyncio.run_coroutine_threadsafe(self._run(func, args, kwargs, priority), self.loop)
+
+    async def drain(self, timeout: float = 30.0):
+        """
+        Перестает принимать задачи и ждет выполняющиеся. Не успевшие за timeout
+        отменяются: их шаги остаются незавершенными в outbox и будут повторены.
+        """
+        self._closed = True
+        tasks = set(self._tasks)
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"⏹️ Очередь {self.name}: отменено {len(pending)} незавершенных задач")
+            await asyncio.wait(pending)
+
+    def stop(self, timeout: float = 30.0):
+        """Синхронная остановка из другого потока (см. drain())"""
+        if self.loop is None or self.loop.is_closed() or self._in_loop():
+            self._closed = True
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.drain(timeout), self.loop).result(timeout + 5)
+        except Exception as e:
+            logger.error(f"❌ Ошибка остановки очереди {self.name}: {e}")
+
+    def stats(self) -> Dict:
+        """Глубина очереди, счетчики и пропускная способность (задач в минуту)"""
+        counters = {
+            result: int(self.jobs.value(queue=self.name, result=result))
+            for result in ('submitted', 'completed', 'failed', 'rejected')
+        }
+        elapsed = max(time.monotonic() - self._started_at, 1e-6)
+        counters.update({
+            'depth': self._waiting,
+            'maxsize': self.maxsize,
+            'workers': self.workers,
+            'per_minute': counters['completed'] * 60 / elapsed
+        })
+        return counters
+
+    def _in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _count(self, result: str):
+        self.jobs.inc(queue=self.name, result=result)
+
+    async def _acquire_run_slot(self, priority: int):
+        if self._running < self.workers and not self._run_waiters:
+            self._running += 1
+            return
+        waiter = self.loop.create_future()
+        heapq.heappush(self._run_waiters, (priority, next(self._sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Место уже передано этой задаче - отдаем следующей
+                self._release_run_slot()
+            raise
+
+    def _release_run_slot(self):
+        while self._run_waiters:
+            _, _, waiter = heapq.heappop(self._run_waiters)
+            if not waiter.done():
+                # Место переходит ожидающему, счетчик занятых не меняется
+                waiter.set_result(None)
+                return
+        self._running -= 1
+
+    async def _run(self, func, args, kwargs, priority: int = Priority.NORMAL):
+        self._tasks.add(asyncio.current_task())
+        started = False
+        try:
+            await self._acquire_run_slot(priority)
+            try:
+                started = True
+                with self._lock:
+                    self._waiting -= 1
+                result = await func(*args, **kwargs)
+            finally:
+                self._release_run_slot()
+            self._count('completed')
+            return result
+        except asyncio.CancelledError:
+            self._count('cancelled')
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка в задаче очереди {self.name}: {e}")
+            self._count('failed')
+            raise
+        finally:
+            if not started:
+                with self._lock:
+                    self._waiting -= 1
+            self._tasks.discard(asyncio.current_task())
+            self._slots.release()
+
+class ApplicationOutbox:
+    """
+    Журнал заявок на диске (SQLite в режиме WAL). Заявка записывается до того,
+    как письмо помечается прочитанным, и остается в журнале, пока все шаги
+    доставки (задача в CRM, ответ клиенту) не завершатся. Все записи идут через
+    один поток, который объединяет накопившиеся операции в одну транзакцию.
+    """
+
+    STEPS = ('crm', 'message')
+
+    def __init__(self, path: str = "data/outbox.db", max_attempts: int = 10,
+                 retry_delay: float = 60.0, batch_size: int = 500, node: str = ''):
+        self.path = path
+        # Процесс кластера, принявший заявку: повторную доставку ведет он же
+        self.node = node
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self._writes = queue.Queue()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        connection = self._connect()
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                crm_status TEXT NOT NULL,
+                message_status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                completed INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (completed, id);
+            CREATE INDEX IF NOT EXISTS outbox_crm ON outbox (crm_status, id);
+        """)
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(outbox)")}
+        if 'node' not in columns:
+            try:
+                connection.execute("ALTER TABLE outbox ADD COLUMN node TEXT NOT NULL DEFAULT ''")
+            except sqlite3.OperationalError as e:
+                # Столбец успел добавить другой процесс кластера
+                if 'duplicate column' not in str(e):
+                    raise
+        connection.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="outbox-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL NORMAL не теряет зафиксированные транзакции при падении процесса
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        """Ключ идемпотентности: одна и та же заявка дает один и тот же ключ"""
+        return hashlib.sha256(text.encode('utf-8', errors='ignore')).hexdigest()
+
+    def add(self, key: str, data: Dict, steps: Dict[str, str]) -> Future:
+        """
+        Записывает заявку. Future завершается после фиксации транзакции;
+        результат - True для новой записи и False, если ключ уже был в журнале.
+        """
+        now = time.time()
+        completed = 0 if 'pending' in steps.values() else 1
+        row = (key, json.dumps(data, ensure_ascii=False), steps['crm'], steps['message'], completed, now, now,
+               self.node)
+        return self._submit('add', row)
+
+    def complete_step(self, key: str, step: str, data: Dict, success: bool, error: str = "") -> Future:
+        """
+        Отмечает результат шага доставки; неудачный шаг планируется на повтор.
+        Результат Future: 0 - заявка еще не доставлена, 1 - доставлена, 2 - попытки исчерпаны.
+        """
+        if step not in self.STEPS:
+            raise ValueError(f"Неизвестный шаг доставки: {step}")
+        return self._submit('step', (key, step, json.dumps(data, ensure_ascii=False), success, error))
+
+    def pending(self, limit: int = 1000, after_id: int = 0,
+                node: Optional[str] = None) -> List[Tuple[int, str, Dict, Dict[str, str]]]:
+        """
+        Незавершенные заявки, которым пора повторить доставку: [(id, ключ, данные, шаги)].
+        node - только заявки этого процесса кластера.
+        """
+        query = ("SELECT id, idempotency_key, payload, crm_status, message_status FROM outbox "
+                 "WHERE completed = 0 AND id > ? AND next_attempt_at <= ?")
+        args = [after_id, time.time()]
+        if node is not None:
+            query += " AND node = ?"
+            args.append(node)
+        connection = self._connect()
+        try:
+            rows = connection.execute(query + " ORDER BY id LIMIT ?", (*args, limit)).fetchall()
+        finally:
+            connection.close()
+        return [
+            (row_id, key, json.loads(payload), {'crm': crm_status, 'message': message_status})
+            for row_id, key, payload, crm_status, message_status in rows
+        ]
+
+    def step_pending(self, key: str, step: str) -> bool:
+        """Ждет ли шаг выполнения (по зафиксированному состоянию журнала)"""
+        if step not in self.STEPS:
+            raise ValueError(f"Неизвестный шаг доставки: {step}")
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                f"SELECT {step}_status FROM outbox WHERE idempotency_key = ?", (key,)
+            ).fetchone()
+        finally:
+            connection.close()
+        return bool(row) and row[0] == 'pending'
+
+    def step_rows(self, step: str, statuses: Tuple[str, ...], created_after: float = 0.0, due_only: bool = False,
+                  limit: int = 1000, after_id: int = 0) -> List[Tuple[int, str, Dict, str, float]]:
+        """Заявки с шагом step в одном из состояний statuses: [(id, ключ, данные, состояние шага, время записи)]"""
+        if step not in self.STEPS:
+            raise ValueError(f"Неизвестный шаг доставки: {step}")
+        query = (f"SELECT id, idempotency_key, payload, {step}_status, created_at FROM outbox "
+                 f"WHERE {step}_status IN ({', '.join('?' * len(statuses))}) AND id > ? AND created_at >= ?")
+        args = [*statuses, after_id, created_after]
+        if due_only:
+            query += " AND next_attempt_at <= ?"
+            args.append(time.time())
+        connection = self._connect()
+        try:
+            rows = connection.execute(query + " ORDER BY id LIMIT ?", (*args, limit)).fetchall()
+        finally:
+            connection.close()
+        return [
+            (row_id, key, json.loads(payload), status, created_at)
+            for row_id, key, payload, status, created_at in rows
+        ]
+
+    def step_backlog(self, step: str) -> Tuple[int, Optional[float]]:
+        """Сколько заявок ждут шага step и время записи самой старой из них"""
+        if step not in self.STEPS:
+            raise ValueError(f"Неизвестный шаг доставки: {step}")
+        connection = self._connect()
+        try:
+            count, oldest = connection.execute(
+                f"SELECT COUNT(*), MIN(created_at) FROM outbox WHERE {step}_status = 'pending'"
+            ).fetchone()
+        finally:
+            connection.close()
+        return count, oldest
+
+    def reset_step(self, key: str, step: str, data: Dict) -> Future:
+        """
+        Возвращает шаг в ожидание с новым счетчиком попыток (например, задача
+        пропала из CRM или попытки исчерпаны во время сбоя). Результат Future -
+        True, если заявка есть в журнале.
+        """
+        if step not in self.STEPS:
+            raise ValueError(f"Неизвестный шаг доставки: {step}")
+        return self._submit('reset', (key, step, json.dumps(data, ensure_ascii=False)))
+
+    def adopt(self, live_nodes: List[str]) -> Future:
+        """
+        Забирает незавершенные заявки процессов, которых нет среди live_nodes
+        (процесс упал или вышел из кластера). Результат Future - число заявок.
+        """
+        return self._submit('adopt', (self.node, tuple(live_nodes)))
+
+    def status(self, key: str) -> Optional[int]:
+        """Состояние заявки: 0 - доставляется, 1 - доставлена, 2 - попытки исчерпаны, None - нет в журнале"""
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT completed FROM outbox WHERE idempotency_key = ?", (key,)).fetchone()
+        finally:
+            connection.close()
+        return row[0] if row else None
+
+    def counts(self) -> Dict[str, int]:
+        """Количество незавершенных, доставленных и проваленных заявок"""
+        connection = self._connect()
+        try:
+            pending, = connection.execute("SELECT COUNT(*) FROM outbox WHERE completed = 0").fetchone()
+            delivered, = connection.execute("SELECT COUNT(*) FROM outbox WHERE completed = 1").fetchone()
+            failed, = connection.execute("SELECT COUNT(*) FROM outbox WHERE completed = 2").fetchone()
+        finally:
+            connection.close()
+        return {'pending': pending, 'delivered': delivered, 'failed': failed}
+
+    def close(self):
+        """Дописывает очередь операций и останавливает поток записи"""
+        self._writes.put(None)
+        self._writer.join(timeout=30)
+
+    def _submit(self, operation: str, args: tuple) -> Future:
+        future = Future()
+        self._writes.put((operation, args, future))
+        return future
+
+    def _write_loop(self):
+        connection = self._connect()
+        while True:
+            job = self._writes.get()
+            if job is None:
+                break
+
+            # Групповая фиксация: все, что накопилось, пишем одной транзакцией
+            batch = [job]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+
+            self._commit(connection, batch)
+            if stop:
+                break
+        connection.close()
+
+    def _commit(self, connection: sqlite3.Connection, batch: List[Tuple[str, tuple, Future]]):
+        """
+        Выполняет пачку операций одной транзакцией. Если транзакция откатилась,
+        операции повторяются по одной: ошибку получает только та, что ее вызвала,
+        а остальные заявки пачки записываются.
+        """
+        try:
+            with connection:
+                results = [self._apply(connection, operation, args) for operation, args, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"❌ Ошибка записи в outbox: {e}")
+                batch[0][2].set_exception(e)
+                return
+            logger.warning(f"⚠️ Пачка из {len(batch)} операций outbox не записана ({e}), записываем по одной")
+            for job in batch:
+                self._commit(connection, [job])
+            return
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _apply(self, connection: sqlite3.Connection, operation: str, args: tuple):
+        if operation == 'add':
+            return self._insert(connection, args)
+        if operation == 'reset':
+            return self._reset_step(connection, args)
+        if operation == 'adopt':
+            return self._adopt(connection, args)
+        return self._update_step(connection, args)
+
+    def _insert(self, connection: sqlite3.Connection, row: tuple) -> bool:
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO outbox (idempotency_key, payload, crm_status, message_status, "
+            "completed, created_at, updated_at, node) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row
+        )
+        return cursor.rowcount == 1
+
+    def _adopt(self, connection: sqlite3.Connection, args: tuple) -> int:
+        node, live_nodes = args
+        cursor = connection.execute(
+            f"UPDATE outbox SET node = ?, next_attempt_at = 0 WHERE completed = 0 "
+            f"AND node NOT IN ({', '.join('?' * len(live_nodes))})",
+            (node, *live_nodes)
+        )
+        return cursor.rowcount
+
+    def _reset_step(self, connection: sqlite3.Connection, args: tuple) -> bool:
+        key, step, payload = args
+        cursor = connection.execute(
+            f"UPDATE outbox SET payload = ?, {step}_status = 'pending', attempts = 0, next_attempt_at = 0, "
+            f"last_error = NULL, completed = 0, updated_at = ? WHERE idempotency_key = ?",
+            (payload, time.time(), key)
+        )
+        return cursor.rowcount == 1
+
+    def _update_step(self, connection: sqlite3.Connection, args: tuple) -> int:
+        key, step, payload, success, error = args
+        row = connection.execute(
+            "SELECT crm_status, message_status, attempts FROM outbox WHERE idempotency_key = ?", (key,)
+        ).fetchone()
+        if not row:
+            return 0
+
+        statuses = {'crm': row[0], 'message': row[1]}
+        attempts = row[2]
+        now = time.time()
+        next_attempt_at = 0.0
+        if success:
+            statuses[step] = 'done'
+        else:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                statuses[step] = 'failed'
+            else:
+                next_attempt_at = now + self.retry_delay * min(2 ** (attempts - 1), 60)
+
+        if any(status == 'pending' for status in statuses.values()):
+            completed = 0
+        elif any(status == 'failed' for status in statuses.values()):
+            completed = 2
+        else:
+            completed = 1
+
+        connection.execute(
+            "UPDATE outbox SET payload = ?, crm_status = ?, message_status = ?, attempts = ?, "
+            "next_attempt_at = MAX(next_attempt_at, ?), last_error = ?, completed = ?, updated_at = ? "
+            "WHERE idempotency_key = ?",
+            (payload, statuses['crm'], statuses['message'], attempts, next_attempt_at,
+             error or None, completed, now, key)
+        )
+        return completed
+
+class DedupIndex:
+    """
+    Индекс уже принятых заявок по номеру заявки и нормализованному телефону.
+    Проверка идет по LRU-кэшу в памяти с TTL (окно дедупликации), а ключи
+    дублируются в компактную таблицу SQLite, чтобы индекс пережил перезапуск.
+    """
+
+    def __init__(self, path: str = "data/dedup.db", window: float = 3600.0, max_entries: int = 100000,
+                 shared: bool = False):
+        self.window = window
+        self.max_entries = max_entries
+        # Таблицу пополняют и другие процессы кластера: промах в памяти проверяется по ней
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._inserts_since_prune = 0
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, seen_at REAL NOT NULL) WITHOUT ROWID")
+        self._prune()
+
+        # Поднимаем в память ключи, попадающие в окно, от старых к новым
+        rows = self._db.execute(
+            "SELECT key, seen_at FROM dedup WHERE seen_at > ? ORDER BY seen_at DESC LIMIT ?",
+            (time.time() - self.window, self.max_entries)
+        ).fetchall()
+        for key, seen_at in reversed(rows):
+            self.entries[key] = seen_at
+
+    @staticmethod
+    def keys_for(data: Dict) -> List[str]:
+        """Ключи заявки: номер заявки и телефон в формате Green API (в пределах арендатора)"""
+        keys = []
+        if data.get('application_number'):
+            keys.append(f"number:{data['application_number']}")
+        if data.get('phone'):
+            keys.append(f"phone:{GreenAPI.format_phone_number(data['phone'])}")
+        # Номера заявок разных брендов независимы
+        tenant = data.get('tenant', 'default')
+        if tenant != 'default':
+            keys = [f"{tenant}:{key}" for key in keys]
+        return keys
+
+    def check_and_add(self, keys: List[str]) -> Optional[str]:
+        """
+        Возвращает совпавший ключ, если заявка уже встречалась в пределах окна.
+        Иначе запоминает все ключи и возвращает None.
+        """
+        if not keys:
+            return None
+
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                seen_at = self.entries.get(key)
+                if seen_at is not None and now - seen_at < self.window:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return key
+            if self.shared:
+                placeholders = ', '.join('?' * len(keys))
+                row = self._db.execute(
+                    f"SELECT key FROM dedup WHERE key IN ({placeholders}) AND seen_at > ? LIMIT 1",
+                    (*keys, now - self.window)
+                ).fetchone()
+                if row:
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            for key in keys:
+                self.entries[key] = now
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO dedup (key, seen_at) VALUES (?, ?)",
+                                     [(key, now) for key in keys])
+            self._inserts_since_prune += 1
+            if self._inserts_since_prune >= 1000:
+                self._prune()
+        return None
+
+    def forget(self, keys: List[str]):
+        """Удаляет ключи (например, если заявку не удалось сохранить)"""
+        with self._lock:
+            for key in keys:
+                self.entries.pop(key, None)
+            with self._db:
+                self._db.executemany("DELETE FROM dedup WHERE key = ?", [(key,) for key in keys])
+
+    def _prune(self):
+        with self._db:
+            self._db.execute("DELETE FROM dedup WHERE seen_at <= ?", (time.time() - self.window,))
+        self._inserts_since_prune = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class LeaseTable:
+    """
+    Аренды ресурсов между процессами бота (CLUSTER_PATH): общая таблица SQLite
+    на одном хосте или на общем томе. Ресурс (ящики арендатора, прием Telegram,
+    роль лидера) принадлежит процессу, пока тот продлевает аренду; аренды
+    процесса, не отметившегося ttl секунд, освобождаются. Процесс того же
+    хоста, завершившийся аварийно, распознается по PID сразу, не дожидаясь ttl.
+    """
+
+    def __init__(self, path: str, node: str, ttl: float = 10.0):
+        self.path = path
+        self.node = node
+        self.ttl = ttl
+        self.host = socket.gethostname()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Журнал отката, а не WAL: WAL не работает на сетевых томах
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                node TEXT PRIMARY KEY,
+                host TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                seen_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                node TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                acquired_at REAL NOT NULL
+            );
+        """)
+        self.heartbeat()
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой записи с самого начала: проверка и захват аренды атомарны"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def heartbeat(self) -> List[str]:
+        """
+        Отмечает процесс живым, удаляет умершие процессы вместе с их арендами
+        и возвращает живые процессы (по имени).
+        """
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO nodes (node, host, pid, seen_at) VALUES (?, ?, ?, ?)",
+                       (self.node, self.host, os.getpid(), now))
+            dead = [
+                node for node, host, pid, seen_at in db.execute("SELECT node, host, pid, seen_at FROM nodes")
+                if node != self.node and (seen_at < now - self.ttl or (host == self.host and not self.pid_alive(pid)))
+            ]
+            for node in dead:
+                db.execute("DELETE FROM nodes WHERE node = ?", (node,))
+                db.execute("DELETE FROM leases WHERE node = ?", (node,))
+            db.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            live = [row[0] for row in db.execute("SELECT node FROM nodes ORDER BY node")]
+        for node in dead:
+            logger.warning(f"⚠️ Кластер: процесс {node} не отвечает, его аренды освобождены")
+        return live
+
+    @staticmethod
+    def pid_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def acquire(self, name: str) -> bool:
+        """Берет свободную или просроченную аренду (или продлевает свою). True - ресурс наш"""
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute("SELECT node, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != self.node and row[1] >= now:
+                return False
+            acquired_at = now if not row or row[0] != self.node else None
+            db.execute("INSERT INTO leases (name, node, expires_at, acquired_at) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT(name) DO UPDATE SET node = excluded.node, expires_at = excluded.expires_at, "
+                       "acquired_at = COALESCE(?, acquired_at)",
+                       (name, self.node, now + self.ttl, now, acquired_at))
+        return True
+
+    def renew(self) -> set:
+        """Продлевает все аренды процесса; возвращает ресурсы, которые все еще за ним"""
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("UPDATE leases SET expires_at = ? WHERE node = ?", (now + self.ttl, self.node))
+            return {row[0] for row in db.execute("SELECT name FROM leases WHERE node = ?", (self.node,))}
+
+    def release(self, name: str):
+        with self.transaction() as db:
+            db.execute("DELETE FROM leases WHERE name = ? AND node = ?", (name, self.node))
+
+    def owners(self) -> Dict[str, str]:
+        """Владельцы ресурсов: имя ресурса -> процесс"""
+        with self._lock:
+            return dict(self._db.execute("SELECT name, node FROM leases WHERE expires_at >= ?", (time.time(),)))
+
+    def leave(self):
+        """Выход из кластера: аренды и запись процесса удаляются, незавершенные заявки забирает лидер"""
+        with self.transaction() as db:
+            db.execute("DELETE FROM leases WHERE node = ?", (self.node,))
+            db.execute("DELETE FROM nodes WHERE node = ?", (self.node,))
+        with self._lock:
+            self._db.close()
+
+class CRMSync:
+    """
+    Пакетная синхронизация заявок с Pyrus. sync() забирает из outbox заявки с
+    незавершенным шагом crm и создает задачи пачками по batch_size, выполняя
+    до concurrency запросов параллельно; проход прерывается, если пачка не
+    прошла целиком (Pyrus недоступен). reconcile() сверяет журнал за window
+    секунд с реестром задач формы: задачи, созданные без записи в журнал
+    (потерян ответ), привязываются к заявкам, а пропавшие из формы и
+    заявки с исчерпанными попытками возвращаются на создание. После
+    неудачного прохода следующий начинается с одной пробной задачи.
+    """
+
+    # Задача в реестре ищется по этим полям, если ее ID неизвестен или устарел
+    FINGERPRINT_FIELDS = ('Номер заявки', 'Телефон')
+
+    def __init__(self, outbox: ApplicationOutbox, tenants, create_step, task_fields, in_flight=None,
+                 batch_size: int = 50, concurrency: int = 4, window: float = 48 * 3600):
+        self.outbox = outbox
+        # tenants() - текущие арендаторы; create_step(ключ, данные) создает задачу и записывает результат шага
+        self.tenants = tenants
+        self.create_step = create_step
+        self.task_fields = task_fields
+        self.in_flight = in_flight or (lambda key: False)
+        self.batch_size = max(1, batch_size)
+        self.window = window
+        self.pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='crm-sync')
+        # Проходы синхронизации и сверки не пересекаются
+        self._pass_lock = threading.Lock()
+        self.failed_passes = 0
+        self.last_sync = {}
+        self.last_reconcile = {}
+
+        self.results = metrics.counter('autoresponder_crm_sync_total', 'Результаты синхронизации с Pyrus', ('result',))
+        metrics.gauge('autoresponder_crm_sync_backlog', 'Заявок без задачи в CRM').set_function(
+            lambda: self.outbox.step_backlog('crm')[0]
+        )
+        metrics.gauge('autoresponder_crm_sync_lag_seconds', 'Возраст самой старой заявки без задачи в CRM').set_function(
+            self.lag
+        )
+        metrics.gauge('autoresponder_crm_sync_rate', 'Задач CRM в секунду за последний проход').set_function(
+            lambda: self.last_sync.get('rate', 0.0)
+        )
+
+    def lag(self) -> float:
+        """Сколько секунд ждет задачу в CRM самая старая заявка"""
+        _, oldest = self.outbox.step_backlog('crm')
+        return max(0.0, time.time() - oldest) if oldest else 0.0
+
+    def sync(self, stop: Optional[threading.Event] = None) -> Dict:
+        """Один проход пакетного создания задач; возвращает итоги прохода"""
+        with self._pass_lock:
+            started = time.monotonic()
+            total, _ = self.outbox.step_backlog('crm')
+            created = failed = 0
+            after_id = 0
+            # Пока Pyrus не ответил успешно, не расходуем попытки целой пачки
+            batch_size = 1 if self.failed_passes else self.batch_size
+            while not (stop and stop.is_set()):
+                rows = self.outbox.step_rows('crm', ('pending',), due_only=True, limit=batch_size,
+                                             after_id=after_id)
+                rows = [row for row in rows if not self.in_flight(row[1])]
+                if not rows:
+                    break
+                futures = [self.pool.submit(self.create_step, key, data) for _, key, data, _, _ in rows]
+                batch_created = sum(1 for future in futures if self._result(future))
+                created += batch_created
+                failed += len(rows) - batch_created
+                after_id = rows[-1][0]
+
+                elapsed = max(time.monotonic() - started, 1e-6)
+                logger.info(f"🔄 Pyrus: {created + failed}/{total} заявок, создано {created} "
+                            f"({created / elapsed:.1f} задач/с), отставание {self.lag():.0f} с")
+                if not batch_created:
+                    # Ни одна задача пачки не создана: не тратим попытки остальных заявок
+                    self.failed_passes += 1
+                    if self.failed_passes == 1:
+                        logger.warning("⚠️ Pyrus не принимает задачи, синхронизация продолжится пробными запросами")
+                    break
+                if self.failed_passes:
+                    logger.info(f"✅ Pyrus снова принимает задачи после {self.failed_passes} неудачных проходов")
+                self.failed_passes = 0
+                batch_size = self.batch_size
+
+            elapsed = time.monotonic() - started
+            self.results.inc(created, result='created')
+            self.results.inc(failed, result='failed')
+            if created or failed:
+                self.last_sync = {
+                    'created': created, 'failed': failed, 'seconds': elapsed,
+                    'rate': created / max(elapsed, 1e-6), 'finished_at': time.time()
+                }
+            return {'created': created, 'failed': failed, 'seconds': elapsed}
+
+    def reconcile(self) -> Dict:
+        """Сверка журнала с реестрами форм всех арендаторов"""
+        with self._pass_lock:
+            started = time.monotonic()
+            since = time.time() - self.window
+            rows_by_tenant = {}
+            after_id = 0
+            while True:
+                rows = self.outbox.step_rows('crm', ('done', 'failed', 'pending'), created_after=since,
+                                             after_id=after_id)
+                if not rows:
+                    break
+                for row in rows:
+                    rows_by_tenant.setdefault(row[2].get('tenant', 'default'), []).append(row)
+                after_id = rows[-1][0]
+
+            totals = {'verified': 0, 'relinked': 0, 'backfilled': 0, 'unreachable': 0}
+            for tenant_id, rows in rows_by_tenant.items():
+                tenant = self.tenants().get(tenant_id)
+                if not tenant or not tenant.pyrus_api or not tenant.pyrus_form_id:
+                    continue
+                # Запас на расхождение часов с Pyrus
+                created_after = datetime.fromtimestamp(since - 3600, timezone.utc)
+                try:
+                    register = tenant.pyrus_api.form_register(tenant.pyrus_form_id, created_after=created_after)
+                except CircuitOpenError as e:
+                    logger.info(f"⏸️ Сверка арендатора {tenant_id} отложена: {e}")
+                    register = None
+                if register is None:
+                    totals['unreachable'] += len(rows)
+                    continue
+                for result, count in self.reconcile_rows(rows, register).items():
+                    totals[result] += count
+
+            for result in ('verified', 'relinked', 'backfilled'):
+                self.results.inc(totals[result], result=result)
+            totals['seconds'] = time.monotonic() - started
+            totals['finished_at'] = time.time()
+            self.last_reconcile = totals
+            logger.info(f"🧾 Сверка с Pyrus: подтверждено {totals['verified']}, привязано {totals['relinked']}, "
+                        f"возвращено на создание {totals['backfilled']}, без ответа Pyrus {totals['unreachable']} "
+                        f"за {totals['seconds']:.1f} с")
+            return totals
+
+    def reconcile_rows(self, rows: List[Tuple[int, str, Dict, str, float]], register: List[Dict]) -> Dict[str, int]:
+        """Сверяет заявки одного арендатора с реестром его формы"""
+        task_ids = {str(task.get('id')) for task in register}
+        by_fingerprint = {}
+        for task in register:
+            fingerprint = self.fingerprint(PyrusAPI.task_fields(task))
+            if fingerprint:
+                by_fingerprint.setdefault(fingerprint, str(task.get('id')))
+
+        counts = {'verified': 0, 'relinked': 0, 'backfilled': 0}
+        for _, key, data, status, _ in rows:
+            if self.in_flight(key):
+                continue
+            pending = status == 'pending'
+            task_id = data.get('crm_task_id')
+            if not pending and task_id and task_id in task_ids:
+                counts['verified'] += 1
+                continue
+
+            found = self.fingerprint(self.task_fields(data))
+            found = by_fingerprint.get(found) if found else None
+            if found:
+                # Задача есть в форме: записываем ее ID вместо повторного создания
+                data['crm_task_id'] = found
+                self.outbox.complete_step(key, 'crm', data, True)
+                counts['relinked'] += 1
+            elif pending:
+                # Еще не создана: ее создаст обычная доставка
+                continue
+            else:
+                data.pop('crm_task_id', None)
+                self.outbox.reset_step(key, 'crm', data)
+                counts['backfilled'] += 1
+        return counts
+
+    @classmethod
+    def fingerprint(cls, fields: Dict[str, str]) -> Optional[str]:
+        """Признак заявки в задаче: номер заявки и телефон в формате Green API"""
+        number, phone = (str(fields.get(name) or '') for name in cls.FINGERPRINT_FIELDS)
+        if not number and not phone:
+            return None
+        return f"{number}|{GreenAPI.format_phone_number(phone) if phone else ''}"
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    @staticmethod
+    def _result(future: Future):
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error(f"❌ Ошибка синхронизации заявки с Pyrus: {e}")
+            return None
+
+class ChatUpdateDispatcher:
+    """
+    Параллельная обработка апдейтов Telegram. Апдейты одного чата всегда
+    попадают в одну и ту же очередь (по хэшу chat_id), поэтому внутри чата
+    порядок сохраняется, а разные чаты обрабатываются одновременно.
+    """
+
+    def __init__(self, handler, workers: int = 4, maxsize: int = 1000, put_timeout: float = 1.0):
+        self.handler = handler
+        self.put_timeout = put_timeout
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(max(1, workers))]
+        self._threads = []
+        self.updates = metrics.counter('autoresponder_telegram_updates_total', 'Апдейты Telegram', ('result',))
+        metrics.gauge('autoresponder_telegram_update_queue', 'Апдейтов Telegram в очереди').set_function(
+            lambda: sum(update_queue.qsize() for update_queue in self.queues)
+        )
+
+    def start(self):
+        for index, update_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(update_queue,),
+                                      name=f"telegram-{index + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10.0):
+        for update_queue in self.queues:
+            update_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    @staticmethod
+    def chat_id(update) -> int:
+        """Чат, к которому относится апдейт (0, если чата нет)"""
+        for attribute in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+            message = getattr(update, attribute, None)
+            if message is not None:
+                return message.chat.id
+        callback_query = getattr(update, 'callback_query', None)
+        if callback_query is not None and callback_query.message is not None:
+            return callback_query.message.chat.id
+        return 0
+
+    def dispatch(self, update) -> bool:
+        """Ставит апдейт в очередь его чата. False - очередь переполнена"""
+        update_queue = self.queues[hash(self.chat_id(update)) % len(self.queues)]
+        try:
+            update_queue.put((time.monotonic(), update), timeout=self.put_timeout)
+        except queue.Full:
+            self.updates.inc(result='rejected')
+            logger.warning("⚠️ Очередь апдейтов Telegram переполнена")
+            return False
+        return True
+
+    def _worker(self, update_queue: queue.Queue):
+        while True:
+            item = update_queue.get()
+            if item is None:
+                break
+            queued_at, update = item
+            metrics.stage_latency('telegram_queue').observe(time.monotonic() - queued_at)
+            try:
+                with metrics.timer('telegram_update'):
+                    self.handler([update])
+                self.updates.inc(result='handled')
+            except Exception as e:
+                self.updates.inc(result='failed')
+                logger.error(f"❌ Ошибка обработки апдейта Telegram: {e}")
+
+class TelegramWebhookServer:
+    """Локальный HTTP-сервер, принимающий апдейты Telegram в режиме webhook"""
+
+    def __init__(self, host: str, port: int, path: str, secret: str, dispatcher: ChatUpdateDispatcher):
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != path:
+                    self._reply(404)
+                    return
+                if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                    self._reply(403)
+                    return
+                try:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    from telebot.types import Update
+                    update = Update.de_json(body.decode('utf-8'))
+                except Exception as e:
+                    logger.error(f"❌ Некорректный апдейт Telegram: {e}")
+                    self._reply(400)
+                    return
+                # 503 - Telegram повторит доставку позже
+                self._reply(200 if dispatcher.dispatch(update) else 503)
+
+            def _reply(self, status: int):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug("Webhook %s " + format, self.address_string(), *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="telegram-webhook", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class DependencyProbe:
+    """
+    Фоновая проверка внешней зависимости (Pyrus, инстанс Green API, вход в
+    почтовый ящик) по расписанию: успешная повторяется через interval
+    (±20%, чтобы проверки разных арендаторов не совпадали), неудачная -
+    с удвоением паузы от retry_delay до max_delay. Результат последней
+    проверки хранится в объекте: /health и /ready читают его, не обращаясь
+    к сети. Запуск бота проверок не ждет: до первой успешной проверки шаги
+    доставки через зависимость не выполняются и ждут в outbox.
+    """
 
-    def send_message(self, phone: str, message: str) -> bool:
-        """Отправляет сообщение через WhatsApp"""
+    JITTER = 0.2
+
+    def __init__(self, name: str, check, kind: str = '', target: str = '', interval: float = 60.0,
+                 retry_delay: float = 5.0, max_delay: float = 60.0):
+        self.name = name
+        # check() -> True/False; None - проверить сейчас нельзя, прежний результат сохраняется
+        self.check = check
+        self.kind = kind
+        self.target = target
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.ready = threading.Event()
+        self.state = 'unknown'
+        self.failures = 0
+        self.latency = None
+        self.error = ''
+        self.checked_at = None
+        self.last_success_at = None
+        self.next_check_at = 0.0
+
+        labels = {'dependency': kind, 'target': target}
+        metrics.gauge('autoresponder_dependency_up', 'Результат последней проверки зависимости (1 - доступна)',
+                      ('dependency', 'target')).set_function(lambda: 1 if self.state == 'healthy' else 0, **labels)
+        metrics.gauge('autoresponder_dependency_check_seconds', 'Длительность последней проверки зависимости',
+                      ('dependency', 'target')).set_function(lambda: self.latency or 0.0, **labels)
+        metrics.gauge('autoresponder_dependency_failures', 'Неудачных проверок зависимости подряд',
+                      ('dependency', 'target')).set_function(lambda: self.failures, **labels)
+
+    def due(self) -> bool:
+        return time.monotonic() >= self.next_check_at
+
+    def run(self) -> Optional[bool]:
+        """Одна проверка; True - зависимость доступна, None - проверка пропущена"""
+        started = time.monotonic()
+        error = ''
         try:
-            url = f"{self.base_url}/sendMessage/{self.api_token}"
+            result = self.check()
+        except Exception as e:
+            result, error = False, str(e) or type(e).__name__
+        latency = time.monotonic() - started
 
-            # Форматируем номер телефона для Green API
-            formatted_phone = self.format_phone_number(phone)
+        if result is None:
+            self.next_check_at = time.monotonic() + self.jittered(self.interval)
+            return None
 
-            payload = {
-                "chatId": f"{formatted_phone}@c.us",
-                "message": message
-            }
+        previous = self.state
+        self.latency = latency
+        self.checked_at = time.time()
+        if result:
+            self.state = 'healthy'
+            self.failures = 0
+            self.error = ''
+            self.last_success_at = self.checked_at
+            self.ready.set()
+            self.next_check_at = time.monotonic() + self.jittered(self.interval)
+            if previous != 'healthy':
+                logger.info(f"✅ {self.name} доступен (проверка {latency:.2f} с)")
+        else:
+            self.state = 'unhealthy'
+            self.failures += 1
+            self.error = error or "проверка не пройдена"
+            delay = min(self.retry_delay * 2 ** (self.failures - 1), self.max_delay)
+            self.next_check_at = time.monotonic() + delay
+            if previous != 'unhealthy':
+                postponed = "" if self.ready.is_set() else ", доставка через него отложена"
+                logger.warning(f"⚠️ {self.name} недоступен ({self.error}){postponed}; "
+                               f"повторная проверка через {delay:.0f} с")
+        return bool(result)
+
+    def jittered(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    def snapshot(self) -> Dict:
+        """Кэшированный результат последней проверки"""
+        now = time.time()
+        return {
+            'name': self.name,
+            'dependency': self.kind,
+            'target': self.target,
+            'state': self.state,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'consecutive_failures': self.failures,
+            'checked_seconds_ago': round(now - self.checked_at, 1) if self.checked_at else None,
+            'last_success_seconds_ago': round(now - self.last_success_at, 1) if self.last_success_at else None,
+            'error': self.error
+        }
 
-            response = requests.post(url, json=payload, timeout=30)
+class FieldName(str):
+    """Подстановка в разобранном шаблоне (отличается от текста типом)"""
 
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('idMessage'):
-                    logger.info(f"✅ WhatsApp сообщение отправлено на {phone}")
-                    return True
+class MessageTemplate:
+    """
+    Шаблон ответа, разобранный один раз при загрузке. Подстановки - {name},
+    {area}, {budget}, {application_number} и другие поля заявки; фрагмент
+    в [[...]] выводится, только если все его подстановки непустые
+    ("Здравствуйте[[, {name}]]!"). {{ и }} - буквальные фигурные скобки.
+    """
+
+    FIELDS = ('name', 'area', 'budget', 'application_number', 'object_description',
+              'object_type', 'has_land', 'form_type', 'contact_method', 'phone')
+    TOKEN = re.compile(r"\[\[|\]\]|\{\{|\}\}|\{([^{}]*)\}")
+    # Значения приходят из формы на сайте: одна строка разумной длины
+    MAX_VALUE_LENGTH = 100
+
+    def __init__(self, name: str, source: str):
+        self.name = name
+        self.source = source
+        self.parts = self.compile(source)
+        # Поля, от которых зависит текст: их значения - вариант шаблона
+        self.fields = tuple(dict.fromkeys(
+            field for part in self.parts if not isinstance(part, str)
+            for field in (part[1] if isinstance(part, tuple) else (part,))
+        ))
+
+    def compile(self, source: str) -> list:
+        """Текст -> список частей: строка, поле (FieldName) или (части, поля) для [[...]]"""
+        parts, optional, position = [], None, 0
+        for match in self.TOKEN.finditer(source):
+            target = optional[0] if optional is not None else parts
+            if match.start() > position:
+                target.append(source[position:match.start()])
+            position = match.end()
+            token = match.group(0)
+            if token in ('{{', '}}'):
+                target.append(token[0])
+            elif token == '[[':
+                if optional is not None:
+                    raise ValueError(f"шаблон {self.name}: вложенные [[...]] не поддерживаются")
+                optional = ([], [])
+            elif token == ']]':
+                if optional is None:
+                    raise ValueError(f"шаблон {self.name}: ]] без [[")
+                if optional[1]:
+                    parts.append((self.merge(optional[0]), tuple(optional[1])))
                 else:
-                    logger.error(f"❌ Не удалось отправить WhatsApp сообщение: {data}")
-                    return False
+                    # Без подстановок условию нечего проверять: фрагмент выводится всегда
+                    parts.extend(optional[0])
+                optional = None
             else:
-                logger.error(f"❌ Ошибка Green API: {response.status_code} - {response.text}")
-                return False
+                field = match.group(1).strip()
+                if field not in self.FIELDS:
+                    raise ValueError(f"шаблон {self.name}: неизвестное поле {{{field}}}")
+                target.append(FieldName(field))
+                if optional is not None:
+                    optional[1].append(field)
+        if optional is not None:
+            raise ValueError(f"шаблон {self.name}: [[ без ]]")
+        if position < len(source):
+            parts.append(source[position:])
+        return self.merge(parts)
+
+    @staticmethod
+    def merge(parts: list) -> list:
+        """Склеивает соседние строки, чтобы при подстановке было меньше частей"""
+        merged = []
+        for part in parts:
+            if type(part) is str and merged and type(merged[-1]) is str:
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return merged
+
+    def variant(self, data: Dict) -> Tuple[str, ...]:
+        """Значения полей заявки, от которых зависит текст"""
+        variant = []
+        for field in self.fields:
+            value = data.get(field)
+            value = ' '.join(str(value).split())[:self.MAX_VALUE_LENGTH] if value else ''
+            variant.append(value)
+        return tuple(variant)
+
+    def render(self, variant: Tuple[str, ...]) -> str:
+        """Текст для значений полей variant (в порядке self.fields)"""
+        if not self.fields:
+            return ''.join(self.parts)
+        values = dict(zip(self.fields, variant))
+        chunks = []
+        for part in self.parts:
+            if type(part) is str:
+                chunks.append(part)
+            elif type(part) is tuple:
+                section, fields = part
+                if all(values[field] for field in fields):
+                    chunks.extend(piece if type(piece) is str else values[piece] for piece in section)
+            else:
+                chunks.append(values[part])
+        return ''.join(chunks)
+
+class TemplateStore:
+    """
+    Шаблоны ответов из каталога TEMPLATES_DIR:
+      *.txt         - общие шаблоны (имя файла - имя шаблона);
+      rules.json    - таблица выбора: [{"when": {"object_type": "bath"}, "template": "bath"}, ...],
+                      первое подходящее правило, последнее - без условий;
+      <арендатор>/  - шаблоны и rules.json арендатора поверх общих.
+    Шаблоны из "templates" в TENANTS_FILE действуют как файлы каталога
+    арендатора. Фоновый поток перечитывает изменившиеся файлы: новый набор
+    собирается целиком и подменяет прежний одной операцией, отправки не ждут.
+    Если файл содержит ошибку, остается прежний набор. Готовые тексты
+    кэшируются по шаблону и варианту (значениям его полей).
+    """
 
+    # Без каталога шаблонов бот отвечает прежними текстами
+    DEFAULT_TEMPLATES = {
+        'house': "Здравствуйте! С Вами на связи строительная компания «Срубим».\nРады будем обсудить Ваши более детальные пожелания по будущему дому здесь или готовы назначить встречу в офисе.",
+        'bath': "Здравствуйте! С Вами на связи строительная компания «Срубим».\nРады будем обсудить Ваши более детальные пожелания по будущей бане здесь или готовы назначить встречу в офисе.",
+        'general_request': "Здравствуйте! С Вами на связи строительная компания «Срубим».\nМы получили Ваше обращение и в ближайшее время вернемся к Вам с ответом."
+    }
+    DEFAULT_RULES = [
+        {'when': {'form_type': 'заявка'}, 'template': 'general_request'},
+        {'when': {'object_type': 'bath'}, 'template': 'bath'},
+        {'template': 'house'}
+    ]
+
+    def __init__(self, directory: str = 'templates', cache_size: int = 1024):
+        self.directory = Path(directory)
+        self.cache_size = cache_size
+        self.inline = {}
+        self.signature = None
+        self.generation = 0
+        # (набор, кэш текстов): набор - арендатор -> (шаблоны по имени, правила).
+        # Пара подменяется одним присваиванием, render() не увидит половину замены
+        self.active = ({}, functools.lru_cache(maxsize=cache_size)(functools.partial(self.render_variant, {})))
+        # Обращения к кэшам прежних наборов
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        metrics.gauge('autoresponder_template_generation', 'Номер загруженного набора шаблонов').set_function(
+            lambda: self.generation
+        )
+        cache_lookups = metrics.counter('autoresponder_template_cache_total', 'Обращения к кэшу готовых текстов',
+                                        ('result',))
+        cache_lookups.set_function(lambda: self.cache_hits + self.active[1].cache_info().hits, result='hit')
+        cache_lookups.set_function(lambda: self.cache_misses + self.active[1].cache_info().misses, result='miss')
+
+    def load(self, inline: Optional[Dict[str, Dict[str, str]]] = None):
+        """
+        Собирает и подменяет набор шаблонов. inline - шаблоны арендаторов из
+        TENANTS_FILE по id арендатора. При ошибке выбрасывает ValueError, а
+        действующий набор не меняется.
+        """
+        if inline is not None:
+            self.inline = inline
+        signature = self.scan()
+        catalog = self.build()
+        info = self.active[1].cache_info()
+        self.cache_hits += info.hits
+        self.cache_misses += info.misses
+        self.active = (catalog, functools.lru_cache(maxsize=self.cache_size)(
+            functools.partial(self.render_variant, catalog)
+        ))
+        self.signature = signature
+        self.generation += 1
+
+    def scan(self) -> tuple:
+        """Имена, размеры и время изменения файлов каталога - признак того, что пора перечитать"""
+        if not self.directory.is_dir():
+            return ()
+        entries = []
+        for path in sorted(self.directory.rglob('*')):
+            if path.suffix in ('.txt', '.json') and path.is_file():
+                stat = path.stat()
+                entries.append((str(path), stat.st_mtime_ns, stat.st_size))
+        return tuple(entries)
+
+    def build(self) -> Dict:
+        if self.directory.is_dir():
+            base_templates, base_rules = self.read_layer(self.directory)
+        else:
+            logger.warning(f"⚠️ Каталог шаблонов {self.directory} не найден, используются встроенные тексты")
+            base_templates, base_rules = {}, None
+        base_templates = dict({name: MessageTemplate(name, text) for name, text in self.DEFAULT_TEMPLATES.items()},
+                              **base_templates)
+        base_rules = base_rules or self.compile_rules(self.DEFAULT_RULES)
+
+        catalog = {}
+        tenant_ids = set(self.inline) | {'default'}
+        if self.directory.is_dir():
+            tenant_ids |= {path.name for path in self.directory.iterdir() if path.is_dir()}
+        for tenant_id in tenant_ids:
+            templates = dict(base_templates)
+            for name, text in self.inline.get(tenant_id, {}).items():
+                templates[name] = MessageTemplate(f"{tenant_id}/{name}", text)
+            rules = base_rules
+            tenant_dir = self.directory / tenant_id
+            if tenant_dir.is_dir():
+                tenant_templates, tenant_rules = self.read_layer(tenant_dir)
+                templates.update(tenant_templates)
+                rules = tenant_rules or rules
+            for _, name in rules:
+                if name not in templates:
+                    raise ValueError(f"правило ссылается на неизвестный шаблон {name} (арендатор {tenant_id})")
+            catalog[tenant_id] = (templates, rules)
+        return catalog
+
+    def read_layer(self, directory: Path) -> Tuple[Dict[str, MessageTemplate], Optional[list]]:
+        """Шаблоны *.txt и правила rules.json одного каталога"""
+        templates = {}
+        for path in sorted(directory.glob('*.txt')):
+            # Перевод строки в конце файла - особенность редактора, а не часть сообщения
+            templates[path.stem] = MessageTemplate(str(path), path.read_text(encoding='utf-8').rstrip('\n'))
+        rules = None
+        rules_path = directory / 'rules.json'
+        if rules_path.exists():
+            with open(rules_path, encoding='utf-8') as f:
+                rules = self.compile_rules(json.load(f))
+        return templates, rules
+
+    @staticmethod
+    def compile_rules(spec: List[Dict]) -> list:
+        """[{"when": {поле: значение или список}, "template": имя}] -> [(условия, имя)]"""
+        rules = []
+        for rule in spec:
+            conditions = tuple(
+                (field, frozenset(value if isinstance(value, list) else [value]))
+                for field, value in rule.get('when', {}).items()
+            )
+            rules.append((conditions, rule['template']))
+        if not rules or rules[-1][0]:
+            raise ValueError("последнее правило выбора шаблона должно быть без условий")
+        return rules
+
+    @staticmethod
+    def select(rules: list, data: Dict) -> str:
+        """Имя шаблона по первому подходящему правилу"""
+        for conditions, name in rules:
+            if all(data.get(field) in values for field, values in conditions):
+                return name
+        return rules[-1][1]
+
+    @staticmethod
+    def render_variant(catalog: Dict, tenant_id: str, name: str, variant: Tuple[str, ...]) -> str:
+        return catalog[tenant_id][0][name].render(variant)
+
+    def render(self, data: Dict, tenant_id: str = 'default') -> str:
+        """Текст ответа на заявку: выбор шаблона по правилам и подстановка полей"""
+        catalog, cached = self.active
+        if tenant_id not in catalog:
+            tenant_id = 'default'
+        templates, rules = catalog[tenant_id]
+        name = self.select(rules, data)
+        return cached(tenant_id, name, templates[name].variant(data))
+
+    def reload_if_changed(self) -> bool:
+        """Перечитывает каталог, если файлы изменились. True - загружен новый набор"""
+        signature = self.scan()
+        if signature == self.signature:
+            return False
+        try:
+            self.load()
         except Exception as e:
-            logger.error(f"❌ Исключение при отправке WhatsApp сообщения: {e}")
+            # Не пытаемся снова, пока файлы не изменятся еще раз
+            self.signature = signature
+            logger.error(f"❌ Шаблоны не перезагружены, действуют прежние: {e}")
+            metrics.counter('autoresponder_template_reloads_total', 'Перезагрузки шаблонов', ('result',)
+                            ).inc(result='error')
             return False
+        logger.info(f"📝 Шаблоны перезагружены (набор {self.generation})")
+        metrics.counter('autoresponder_template_reloads_total', 'Перезагрузки шаблонов', ('result',)).inc(result='ok')
+        return True
 
-    def format_phone_number(self, phone: str) -> str:
-        """Форматирует номер телефона для Green API"""
-        # Удаляем все лишние символы
-        cleaned = re.sub(r'[^\d+]', '', phone)
+    def watch(self, stop: threading.Event, interval: float):
+        """Поток перезагрузки: проверяет каталог раз в interval секунд"""
+        while not stop.wait(interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки каталога шаблонов: {e}")
 
-        # Если номер начинается с 8, заменяем на 7
-        if cleaned.startswith('8'):
-            cleaned = '7' + cleaned[1:]
-        elif cleaned.startswith('+7'):
-            cleaned = cleaned[1:]
-        elif cleaned.startswith('+'):
-            cleaned = cleaned[1:]
-        elif not cleaned.startswith('7'):
-            cleaned = '7' + cleaned
+class Tenant:
+    """
+    Бренд или региональный офис: свои почтовые ящики, инстанс WhatsApp,
+    форма Pyrus и шаблоны ответов. connections ограничивает число
+    одновременных IMAP-соединений арендатора.
+    """
 
-        return cleaned
+    def __init__(self, tenant_id: str, mailboxes: List[Dict], pyrus_api: Optional[PyrusAPI] = None,
+                 pyrus_form_id: int = 0, green_api: Optional[GreenAPI] = None,
+                 templates: Optional[Dict[str, str]] = None, max_connections: int = 2):
+        self.id = tenant_id
+        self.mailboxes = mailboxes
+        self.pyrus_api = pyrus_api
+        self.pyrus_form_id = pyrus_form_id
+        self.green_api = green_api
+        self.templates = templates or {}
+        self.max_connections = max(1, max_connections)
+        self.connections = threading.BoundedSemaphore(self.max_connections)
+
+    @property
+    def use_idle(self) -> bool:
+        """IDLE держит соединение постоянно, поэтому возможен, только если все ящики укладываются в лимит"""
+        return len(self.mailboxes) <= self.max_connections
+
+    @staticmethod
+    def mailbox_configured(mailbox: Dict) -> bool:
+        return all(mailbox.get(key) for key in ('imap_server', 'username', 'password'))
 
 class AutoResponderBot:
     """
     Улучшенный бот автоответчик с интеграцией Pyrus CRM и Green API
     """
 
+    # Настройки .env, при смене которых пересоздается соответствующий клиент
+    PYRUS_KEYS = frozenset({'pyrus_login', 'pyrus_security_key', 'pyrus_api_url', 'pyrus_token_ttl'})
+    GREEN_API_KEYS = frozenset({'green_api_instance_id', 'green_api_token', 'green_api_url'})
+    TELEGRAM_KEYS = frozenset({
+        'telegram_bot_token', 'telegram_api_url', 'telegram_mode', 'telegram_workers', 'telegram_webhook_url',
+        'telegram_webhook_host', 'telegram_webhook_port', 'telegram_webhook_secret'
+    })
+    # Настройки, которые заданы при создании очередей, журналов и пулов: применяются после перезапуска
+    RESTART_KEYS = frozenset({
+        'runtime', 'async_concurrency', 'crm_workers', 'whatsapp_workers', 'dispatch_queue_size',
+        'dispatch_put_timeout', 'outbox_path', 'outbox_max_attempts', 'outbox_retry_delay', 'dedup_path',
+        'dedup_window', 'dedup_max_entries', 'metrics_host', 'metrics_port', 'http_pool_size',
+        'http_connect_timeout', 'http_read_timeout', 'http_max_retries', 'http_backoff', 'whatsapp_rate',
+        'whatsapp_burst', 'whatsapp_daily_limit', 'whatsapp_max_concurrency', 'whatsapp_slow_threshold',
+        'crm_sync_mode', 'crm_sync_batch', 'crm_sync_concurrency', 'crm_reconcile_window', 'tenants_file',
+        'templates_dir', 'template_reload_interval', 'template_cache_size', 'probe_workers',
+        'email_parse_workers', 'email_idle', 'email_max_connections', 'debug', 'config_reload_interval',
+        'cluster_path', 'cluster_node_id', 'cluster_lease_ttl', 'cluster_renew_interval',
+        'circuit_failure_threshold', 'circuit_reset_timeout', 'circuit_max_reset_timeout', 'circuit_half_open_calls'
+    })
+
+    # Ссылка на переменную окружения в TENANTS_FILE
+    ENV_REFERENCE = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
     def __init__(self):
         # Загружаем конфигурацию из переменных окружения
         self.config = self.load_config()
+        # .env перечитывается при изменении файла и по SIGHUP (reload_config)
+        self.env_path = Path(find_dotenv() or '.env')
+        self.env_file_values = dotenv_values(self.env_path) if self.env_path.is_file() else {}
+        self.config_lock = threading.Lock()
+        self.config_reload_requested = threading.Event()
+        # HTTP-клиенты общие для всех арендаторов: пул соединений на каждый API
+        self.http_clients = {}
+        # Ограничители отправок WhatsApp: по одному на инстанс Green API
+        self.send_limiters = {}
+        # Выключатели операций внешних API: по одному на операцию инстанса Green API или логина Pyrus
+        self.circuit_breakers = {}
+
+        # Клиенты Telegram, Pyrus и Green API; при перезагрузке .env пересоздаются по отдельности
+        self.telegram_bot = self.create_telegram_bot(self.config)
+        self.pyrus_api = self.create_pyrus_api(self.config)
+        self.green_api = self.create_green_api(self.config)
 
-        # Инициализация Telegram Bot API
-        if self.config.get('telegram_bot_token'):
-            try:
-                self.telegram_bot = telebot.TeleBot(self.config['telegram_bot_token'])
-                self.setup_telegram_handlers()
-                logger.info("✅ Telegram Bot API инициализирован")
-            except Exception as e:
-                logger.error(f"❌ Ошибка инициализации Telegram Bot: {e}")
-                self.telegram_bot = None
-
-        # Инициализация Pyrus CRM API
-        if self.config.get('pyrus_login') and self.config.get('pyrus_security_key'):
-            try:
-                self.pyrus_api = PyrusAPI(
-                    self.config['pyrus_login'],
-                    self.config['pyrus_security_key']
-                )
-                logger.info("✅ Pyrus CRM API инициализирован")
-            except Exception as e:
-                logger.error(f"❌ Ошибка инициализации Pyrus CRM: {e}")
-                self.pyrus_api = None
-        else:
-            self.pyrus_api = None
-
-        # Инициализация Green API для WhatsApp
-        if self.config.get('green_api_instance_id') and self.config.get('green_api_token'):
-            try:
-                self.green_api = GreenAPI(
-                    self.config['green_api_instance_id'],
-                    self.config['green_api_token']
-                )
+        # Настройки для email
+        self.email_config = self.config.get('email', {})
 
-                # Проверяем состояние WhatsApp инстанса
-                if self.green_api.get_state_instance():
-                    logger.info("✅ Green API WhatsApp инициализирован и авторизован")
-                else:
-                    logger.warning("⚠️ Green API инстанс не авторизован. Требуется сканирование QR-кода")
+        self.application_parser = ApplicationParser()
 
-            except Exception as e:
-                logger.error(f"❌ Ошибка инициализации Green API: {e}")
-                self.green_api = None
+        # Очереди исходящих вызовов: CRM и WhatsApp обрабатываются своими пулами потоков
+        # либо, в режиме asyncio, корутинами на общем цикле событий
+        if self.config.get('runtime') == 'asyncio':
+            self.create_async_queues()
         else:
-            self.green_api = None
-
-        # Настройки для email
-        self.email_config = self.config.get('email', {})
+            self.create_thread_queues()
+
+        # Кластер (CLUSTER_PATH): ящики арендаторов, прием Telegram и роль лидера
+        # распределяются между процессами бота через таблицу аренд
+        self.node_id = self.config.get('cluster_node_id') or f"{socket.gethostname()}-{os.getpid()}"
+        self.leases = None
+        if self.config.get('cluster_path'):
+            self.leases = LeaseTable(self.config['cluster_path'], self.node_id,
+                                     ttl=self.config.get('cluster_lease_ttl', 10.0))
+        self.owned_leases = set()
+        self.cluster_nodes = [self.node_id]
+        self.cluster_lock = threading.Lock()
+        self.cluster_intake = threading.Event()
+        self.cluster_wakeup = threading.Event()
+        self.cluster_stop = threading.Event()
+        self.cluster_thread = None
+        self.cluster_adopted = None
+
+        # Журнал заявок на диске и шаги доставки, выполняющиеся прямо сейчас
+        self.outbox = ApplicationOutbox(
+            self.config.get('outbox_path', 'data/outbox.db'),
+            max_attempts=self.config.get('outbox_max_attempts', 10),
+            retry_delay=self.config.get('outbox_retry_delay', 60.0),
+            node=self.node_id if self.leases else ''
+        )
+        self.dedup = DedupIndex(
+            self.config.get('dedup_path', 'data/dedup.db'),
+            window=self.config.get('dedup_window', 3600),
+            max_entries=self.config.get('dedup_max_entries', 100000),
+            shared=self.leases is not None
+        )
+        self.in_flight_steps = set()
+        self.in_flight_lock = threading.Lock()
+        self.replay_stop = threading.Event()
+        # Будит повторную доставку раньше срока (зависимость стала доступна)
+        self.replay_wakeup = threading.Event()
+        # Фоновые проверки зависимостей: клиент API -> DependencyProbe
+        self.probes = {}
+        self.probe_thread = None
+        # Пакетная синхронизация и сверка задач CRM
+        self.crm_sync = CRMSync(
+            self.outbox,
+            tenants=lambda: self.tenants,
+            create_step=self.sync_crm_step,
+            task_fields=self.crm_fields,
+            in_flight=lambda key: (key, 'crm') in self.in_flight_steps,
+            batch_size=self.config.get('crm_sync_batch', 50),
+            concurrency=self.config.get('crm_sync_concurrency', 4),
+            window=self.config.get('crm_reconcile_window', 48) * 3600
+        )
+        # Ожидающие доставки заявок письма: ключ заявки -> [Future подтверждения]
+        self.delivery_waiters = {}
+        # Заявки, о задержке которых уже сообщено менеджеру, и поток отправки этих сообщений
+        self.fallback_notified = set()
+        self.fallback_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fallback')
+        self.email_parse_pool = ThreadPoolExecutor(
+            max_workers=max(1, self.config.get('email_parse_workers', 2)), thread_name_prefix='email-parse'
+        )
+
+        # Счетчики для статистики (хранятся в реестре метрик)
+        self.stats = BotStats()
+        self.start_time = datetime.now()
+        metrics.gauge('autoresponder_uptime_seconds', 'Время работы бота').set_function(
+            lambda: (datetime.now() - self.start_time).total_seconds()
+        )
+        outbox_rows = metrics.gauge('autoresponder_outbox_rows', 'Заявки в outbox по состоянию', ('state',))
+        for state in ('pending', 'delivered', 'failed'):
+            outbox_rows.set_function(lambda state=state: self.outbox.counts()[state], state=state)
+        dedup_lookups = metrics.gauge('autoresponder_dedup_lookups', 'Проверки индекса дубликатов', ('result',))
+        dedup_lookups.set_function(lambda: self.dedup.hits, result='hit')
+        dedup_lookups.set_function(lambda: self.dedup.misses, result='miss')
+        if self.leases:
+            metrics.gauge('autoresponder_cluster_nodes', 'Живые процессы кластера').set_function(
+                lambda: len(self.cluster_nodes)
+            )
+            metrics.gauge('autoresponder_cluster_leases', 'Аренды ресурсов у этого процесса').set_function(
+                lambda: len(self.owned_leases)
+            )
+
+        # Шаблоны ответов: каталог TEMPLATES_DIR, загружаются вместе с арендаторами
+        self.templates = TemplateStore(self.config.get('templates_dir', 'templates'),
+                                       cache_size=self.config.get('template_cache_size', 1024))
+
+        # Арендаторы: настройки из .env образуют арендатора default, остальные - из TENANTS_FILE
+        self.telegram_tenant = 'default'
+        self.tenants = self.load_tenants()
+        self.templates.load({tenant.id: tenant.templates for tenant in self.tenants.values()})
+        self.intake_stop = threading.Event()
+        self.email_listeners = []
+        # Прием писем по арендаторам: id -> (флаг остановки опроса, IDLE-сессии)
+        self.tenant_intake = {}
+
+    def create_telegram_bot(self, config: Dict):
+        """Экземпляр telebot с обработчиками команд; None, если токен не задан"""
+        if not config.get('telegram_bot_token'):
+            return None
+        try:
+            import telebot
+            if config.get('telegram_api_url'):
+                telebot.apihelper.API_URL = config['telegram_api_url'].rstrip('/') + "/bot{0}/{1}"
+            # Обработчики выполняются в потоках ChatUpdateDispatcher, а не в пуле telebot
+            telegram_bot = telebot.TeleBot(config['telegram_bot_token'], threaded=False)
+            self.setup_telegram_handlers(telegram_bot)
+            logger.info("✅ Telegram Bot API инициализирован")
+            return telegram_bot
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации Telegram Bot: {e}")
+            return None
 
-        # Счетчики для статистики
-        self.stats = {
-            'processed_applications': 0,
-            'sent_whatsapp': 0,
-            'sent_telegram': 0,
-            'created_crm_tasks': 0,
-            'errors': 0
-        }
+    def create_pyrus_api(self, config: Dict) -> Optional[PyrusAPI]:
+        """Клиент Pyrus CRM арендатора default; None, если логин или ключ не заданы"""
+        if not (config.get('pyrus_login') and config.get('pyrus_security_key')):
+            return None
+        try:
+            pyrus_api = PyrusAPI(
+                config['pyrus_login'],
+                config['pyrus_security_key'],
+                http=self.http_client('pyrus'),
+                base_url=config['pyrus_api_url'],
+                token_ttl=config['pyrus_token_ttl'],
+                breakers=self.api_breakers('pyrus', config['pyrus_login'], ('create_task', 'form_register'))
+            )
+            logger.info("✅ Pyrus CRM API инициализирован")
+            return pyrus_api
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации Pyrus CRM: {e}")
+            return None
 
-        # Шаблоны сообщений
-        self.message_templates = {
-            'house': "Здравствуйте! С Вами на связи строительная компания «Срубим».\nРады будем обсудить Ваши более детальные пожелания по будущему дому здесь или готовы назначить встречу в офисе.",
-            'bath': "Здравствуйте! С Вами на связи строительная компания «Срубим».\nРады будем обсудить Ваши более детальные пожелания по будущей бане здесь или готовы назначить встречу в офисе.",
-            'general_request': "Здравствуйте! С Вами на связи строительная компания «Срубим».\nМы получили Ваше обращение и в ближайшее время вернемся к Вам с ответом."
-        }
+    def create_green_api(self, config: Dict) -> Optional[GreenAPI]:
+        """Клиент Green API арендатора default; None, если инстанс или токен не заданы"""
+        if not (config.get('green_api_instance_id') and config.get('green_api_token')):
+            return None
+        try:
+            green_api = GreenAPI(
+                config['green_api_instance_id'],
+                config['green_api_token'],
+                http=self.http_client('green-api'),
+                api_url=config['green_api_url'],
+                limiter=self.send_limiter(config['green_api_instance_id']),
+                breakers=self.api_breakers('green_api', config['green_api_instance_id'], ('send_message',))
+            )
+            # Состояние инстанса проверяется в фоне (start_probes), запуск его не ждет
+            logger.info("✅ Green API WhatsApp инициализирован")
+            return green_api
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации Green API: {e}")
+            return None
 
-    def load_config(self) -> Dict:
-        """Загружает конфигурацию из переменных окружения"""
+    def create_thread_queues(self):
+        """Очереди с пулами рабочих потоков"""
+        self.crm_queue = DispatchQueue(
+            'crm',
+            workers=self.config.get('crm_workers', 2),
+            maxsize=self.config.get('dispatch_queue_size', 100),
+            put_timeout=self.config.get('dispatch_put_timeout', 5.0)
+        )
+        self.whatsapp_queue = DispatchQueue(
+            'whatsapp',
+            workers=self.config.get('whatsapp_workers', 2),
+            maxsize=self.config.get('dispatch_queue_size', 100),
+            put_timeout=self.config.get('dispatch_put_timeout', 5.0)
+        )
+        self.crm_queue.start()
+        self.whatsapp_queue.start()
+
+    def create_async_queues(self):
+        """Очереди корутин; к циклу событий привязываются в run_async()"""
+        self.crm_queue = AsyncDispatchQueue(
+            'crm',
+            concurrency=self.config.get('async_concurrency', 100),
+            maxsize=self.config.get('dispatch_queue_size', 100),
+            put_timeout=self.config.get('dispatch_put_timeout', 5.0)
+        )
+        self.whatsapp_queue = AsyncDispatchQueue(
+            'whatsapp',
+            concurrency=self.config.get('async_concurrency', 100),
+            maxsize=self.config.get('dispatch_queue_size', 100),
+            put_timeout=self.config.get('dispatch_put_timeout', 5.0)
+        )
+
+    def load_config(self, env: Optional[Dict[str, str]] = None) -> Dict:
+        """Загружает конфигурацию из переменных окружения (или из env при перезагрузке)"""
+        getenv = (os.environ if env is None else env).get
         return {
             # Telegram Bot API Token
-            'telegram_bot_token': os.getenv('TELEGRAM_BOT_TOKEN'),
+            'telegram_bot_token': getenv('TELEGRAM_BOT_TOKEN'),
+            'telegram_api_url': getenv('TELEGRAM_API_URL'),
+            'telegram_mode': getenv('TELEGRAM_MODE', 'polling').lower(),
+            'telegram_workers': int(getenv('TELEGRAM_WORKERS', '4')),
+            'telegram_webhook_url': getenv('TELEGRAM_WEBHOOK_URL'),
+            'telegram_webhook_host': getenv('TELEGRAM_WEBHOOK_HOST', '0.0.0.0'),
+            'telegram_webhook_port': int(getenv('TELEGRAM_WEBHOOK_PORT', '8443')),
+            'telegram_webhook_secret': getenv('TELEGRAM_WEBHOOK_SECRET', ''),
 
             # Настройки email
             'email': {
-                'imap_server': os.getenv('EMAIL_IMAP_SERVER', 'imap.gmail.com'),
-                'username': os.getenv('EMAIL_USERNAME'),
-                'password': os.getenv('EMAIL_PASSWORD')
+                'imap_server': getenv('EMAIL_IMAP_SERVER', 'imap.gmail.com'),
+                'username': getenv('EMAIL_USERNAME'),
+                'password': getenv('EMAIL_PASSWORD'),
+                'port': int(getenv('EMAIL_IMAP_PORT', '993')),
+                'use_ssl': getenv('EMAIL_IMAP_SSL', 'true').lower() == 'true'
             },
 
             # Green API настройки для WhatsApp
-            'green_api_instance_id': os.getenv('GREEN_API_INSTANCE_ID'),
-            'green_api_token': os.getenv('GREEN_API_TOKEN'),
+            'green_api_instance_id': getenv('GREEN_API_INSTANCE_ID'),
+            'green_api_token': getenv('GREEN_API_TOKEN'),
+            'green_api_url': getenv('GREEN_API_URL', 'https://api.green-api.com'),
+            # Ограничение отправок на инстанс: сообщений в секунду (0 - без ограничения), подряд, в сутки (0 - без лимита)
+            'whatsapp_rate': float(getenv('WHATSAPP_RATE', '1')),
+            'whatsapp_burst': int(getenv('WHATSAPP_BURST', '5')),
+            'whatsapp_daily_limit': int(getenv('WHATSAPP_DAILY_LIMIT', '0')),
+            # Адаптивный предел одновременных отправок и порог медленного ответа
+            'whatsapp_max_concurrency': int(getenv('WHATSAPP_MAX_CONCURRENCY', '4')),
+            'whatsapp_slow_threshold': float(getenv('WHATSAPP_SLOW_THRESHOLD', '5')),
 
             # Pyrus CRM настройки
-            'pyrus_login': os.getenv('PYRUS_LOGIN'),
-            'pyrus_security_key': os.getenv('PYRUS_SECURITY_KEY'),
-            'pyrus_form_id': int(os.getenv('PYRUS_FORM_ID', '0')),
+            'pyrus_login': getenv('PYRUS_LOGIN'),
+            'pyrus_security_key': getenv('PYRUS_SECURITY_KEY'),
+            'pyrus_form_id': int(getenv('PYRUS_FORM_ID', '0')),
+            'pyrus_api_url': getenv('PYRUS_API_URL', 'https://api.pyrus.com/v4'),
+            'pyrus_token_ttl': int(getenv('PYRUS_TOKEN_TTL', '3600')),
+            # Задачи CRM: inline - по заявке в очереди crm, bulk - пачками фоновой синхронизацией
+            'crm_sync_mode': getenv('CRM_SYNC_MODE', 'inline').lower(),
+            'crm_sync_interval': float(getenv('CRM_SYNC_INTERVAL', '5')),
+            'crm_sync_batch': int(getenv('CRM_SYNC_BATCH', '50')),
+            'crm_sync_concurrency': int(getenv('CRM_SYNC_CONCURRENCY', '4')),
+            # Сверка журнала с реестром формы Pyrus (0 - выключена) и глубина сверки в часах
+            'crm_reconcile_interval': float(getenv('CRM_RECONCILE_INTERVAL', '900')),
+            'crm_reconcile_window': float(getenv('CRM_RECONCILE_WINDOW', '48')),
+
+            # Несколько брендов/офисов в одном процессе (JSON, см. tenants_example.json)
+            'tenants_file': getenv('TENANTS_FILE'),
+
+            # Шаблоны ответов: каталог, период проверки изменений (0 - не перечитывать), размер кэша текстов
+            'templates_dir': getenv('TEMPLATES_DIR', 'templates'),
+            'template_reload_interval': float(getenv('TEMPLATE_RELOAD_INTERVAL', '5')),
+            'template_cache_size': int(getenv('TEMPLATE_CACHE_SIZE', '1024')),
+            'email_max_connections': int(getenv('EMAIL_MAX_CONNECTIONS', '2')),
+
+            # HTTP-клиенты внешних API
+            'http_pool_size': int(getenv('HTTP_POOL_SIZE', '10')),
+            'http_connect_timeout': float(getenv('HTTP_CONNECT_TIMEOUT', '5')),
+            'http_read_timeout': float(getenv('HTTP_READ_TIMEOUT', '30')),
+            'http_max_retries': int(getenv('HTTP_MAX_RETRIES', '3')),
+            'http_backoff': float(getenv('HTTP_BACKOFF', '0.5')),
+            # Выключатели операций Pyrus и Green API: неудач подряд до размыкания (0 - выключены),
+            # пауза до пробного вызова, ее предел при неудачных пробах, число пробных вызовов
+            'circuit_failure_threshold': int(getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+            'circuit_reset_timeout': float(getenv('CIRCUIT_RESET_TIMEOUT', '30')),
+            'circuit_max_reset_timeout': float(getenv('CIRCUIT_MAX_RESET_TIMEOUT', '300')),
+            'circuit_half_open_calls': int(getenv('CIRCUIT_HALF_OPEN_CALLS', '1')),
+            # Чат Telegram, куда сообщается о заявках, отложенных из-за недоступности WhatsApp или Pyrus
+            'manager_chat_id': getenv('MANAGER_CHAT_ID', ''),
+
+            # Фоновая проверка Pyrus, Green API и почтовых ящиков: интервал успешных проверок,
+            # пауза между неудачными, таймаут входа в IMAP
+            'health_check_interval': float(getenv('HEALTH_CHECK_INTERVAL', '60')),
+            'probe_retry_delay': float(getenv('PROBE_RETRY_DELAY', '5')),
+            'probe_max_delay': float(getenv('PROBE_MAX_DELAY', '60')),
+            'probe_timeout': float(getenv('PROBE_TIMEOUT', '10')),
+            'probe_workers': int(getenv('PROBE_WORKERS', '8')),
 
             # Прочие настройки
-            'debug': os.getenv('DEBUG', 'false').lower() == 'true',
-            'check_interval': int(os.getenv('CHECK_INTERVAL', '60'))
+            'debug': getenv('DEBUG', 'false').lower() == 'true',
+            'check_interval': int(getenv('CHECK_INTERVAL', '60')),
+            'email_idle': getenv('EMAIL_USE_IDLE', 'true').lower() == 'true',
+            'email_idle_timeout': int(getenv('EMAIL_IDLE_TIMEOUT', '300')),
+            'email_fetch_batch': int(getenv('EMAIL_FETCH_BATCH', '50')),
+            # Конвейер приема: разбор писем в пуле потоков, Seen - после доставки (delivered) или записи (stored)
+            'email_parse_workers': int(getenv('EMAIL_PARSE_WORKERS', '2')),
+            'email_ack': getenv('EMAIL_ACK', 'delivered').lower(),
+            'email_ack_timeout': float(getenv('EMAIL_ACK_TIMEOUT', '60')),
+            'email_pipeline_window': int(getenv('EMAIL_PIPELINE_WINDOW', '100')),
+
+            # Среда выполнения: threads - пулы потоков, asyncio - корутины на одном цикле событий
+            'runtime': getenv('RUNTIME', 'threads').lower(),
+            'async_concurrency': int(getenv('ASYNC_CONCURRENCY', '100')),
+            'shutdown_timeout': float(getenv('SHUTDOWN_TIMEOUT', '30')),
+
+            # Очереди исходящих вызовов
+            'crm_workers': int(getenv('CRM_WORKERS', '2')),
+            'whatsapp_workers': int(getenv('WHATSAPP_WORKERS', '2')),
+            'dispatch_queue_size': int(getenv('DISPATCH_QUEUE_SIZE', '100')),
+            'dispatch_put_timeout': float(getenv('DISPATCH_PUT_TIMEOUT', '5')),
+
+            # Журнал заявок (outbox)
+            'outbox_path': getenv('OUTBOX_PATH', 'data/outbox.db'),
+            'outbox_max_attempts': int(getenv('OUTBOX_MAX_ATTEMPTS', '10')),
+            'outbox_retry_delay': float(getenv('OUTBOX_RETRY_DELAY', '60')),
+            'outbox_replay_interval': float(getenv('OUTBOX_REPLAY_INTERVAL', '30')),
+
+            # Дедупликация заявок
+            'dedup_path': getenv('DEDUP_PATH', 'data/dedup.db'),
+            'dedup_window': float(getenv('DEDUP_WINDOW', '3600')),
+            'dedup_max_entries': int(getenv('DEDUP_MAX_ENTRIES', '100000')),
+
+            # HTTP-эндпоинт метрик Prometheus (порт 0 - выключен)
+            'metrics_host': getenv('METRICS_HOST', '127.0.0.1'),
+            'metrics_port': int(getenv('METRICS_PORT', '9108')),
+
+            # Период проверки изменений .env, с (0 - перечитывать только по SIGHUP)
+            'config_reload_interval': float(getenv('CONFIG_RELOAD_INTERVAL', '5')),
+
+            # Кластер: таблица аренд, общая для процессов бота (пусто - один процесс),
+            # имя процесса, срок аренды и период ее продления, с
+            'cluster_path': getenv('CLUSTER_PATH', ''),
+            'cluster_node_id': getenv('CLUSTER_NODE_ID') or f"{socket.gethostname()}-{os.getpid()}",
+            'cluster_lease_ttl': float(getenv('CLUSTER_LEASE_TTL', '10')),
+            'cluster_renew_interval': float(getenv('CLUSTER_RENEW_INTERVAL', '2'))
+        }
+
+    def validate_config(self, config: Dict) -> List[str]:
+        """Ошибки новой конфигурации; при любой ошибке действует прежняя"""
+        errors = []
+        positive = ('check_interval', 'outbox_replay_interval', 'health_check_interval', 'probe_retry_delay',
+                    'probe_max_delay', 'probe_timeout', 'crm_sync_interval', 'email_idle_timeout',
+                    'email_ack_timeout', 'shutdown_timeout')
+        for key in positive:
+            if key in config and not config[key] > 0:
+                errors.append(f"{key.upper()} должен быть больше нуля")
+        choices = {
+            'telegram_mode': ('polling', 'webhook'),
+            'email_ack': ('delivered', 'stored'),
+            'crm_sync_mode': ('inline', 'bulk'),
+            'runtime': ('threads', 'asyncio')
+        }
+        for key, allowed in choices.items():
+            if key in config and config[key] not in allowed:
+                errors.append(f"{key.upper()}={config[key]}: допустимо {', '.join(allowed)}")
+        if config.get('pyrus_form_id', 0) < 0:
+            errors.append("PYRUS_FORM_ID не может быть отрицательным")
+        if config.get('circuit_failure_threshold', 5) < 0:
+            errors.append("CIRCUIT_FAILURE_THRESHOLD не может быть отрицательным")
+        if config.get('circuit_reset_timeout', 30.0) <= 0:
+            errors.append("CIRCUIT_RESET_TIMEOUT должен быть положительным")
+        if config.get('manager_chat_id') and not re.fullmatch(r'-?\d+|@\w+', config['manager_chat_id']):
+            errors.append("MANAGER_CHAT_ID: ожидается числовой id чата или @канал")
+        if config.get('cluster_path') and not 0 < config.get('cluster_renew_interval', 2) < config.get('cluster_lease_ttl', 10):
+            errors.append("CLUSTER_RENEW_INTERVAL должен быть больше нуля и меньше CLUSTER_LEASE_TTL")
+
+        # Половина пары учетных данных - обычно недописанный файл, а не намерение
+        pairs = {
+            'Pyrus': (config.get('pyrus_login'), config.get('pyrus_security_key')),
+            'Green API': (config.get('green_api_instance_id'), config.get('green_api_token')),
+            'Email': (config['email'].get('username'), config['email'].get('password'))
+        }
+        for name, values in pairs.items():
+            if any(values) and not all(values):
+                errors.append(f"{name}: учетные данные заполнены не полностью")
+
+        # Отключение интеграции на ходу оставило бы заявки без доставки: только перезапуском
+        if self.pyrus_api and not all(pairs['Pyrus']):
+            errors.append("Pyrus CRM отключается только перезапуском")
+        if self.green_api and not all(pairs['Green API']):
+            errors.append("Green API отключается только перезапуском")
+        if self.email_configured() and not all(pairs['Email']):
+            errors.append("Email IMAP отключается только перезапуском")
+        return errors
+
+    def merged_env(self, file_values: Dict[str, Optional[str]]) -> Dict[str, str]:
+        """
+        Окружение после перечитывания .env. load_dotenv() не перекрывает
+        переменные процесса: из файла берутся только те, что пришли из него
+        при запуске или в прошлую перезагрузку, и новые.
+        """
+        env = dict(os.environ)
+        for key, value in self.env_file_values.items():
+            if key not in file_values and env.get(key) == value:
+                del env[key]
+        for key, value in file_values.items():
+            if value is not None and (key not in os.environ or os.environ[key] == self.env_file_values.get(key)):
+                env[key] = value
+        return env
+
+    def reload_config(self, reason: str) -> bool:
+        """
+        Перечитывает .env, проверяет и подменяет конфигурацию. Пересоздаются
+        только клиенты, чьи настройки изменились; заявки, которые сейчас
+        доставляются, дорабатывают со старыми клиентами. True - конфигурация
+        заменена.
+        """
+        reloads = metrics.counter('autoresponder_config_reloads_total', 'Перезагрузки конфигурации', ('result',))
+        with self.config_lock:
+            try:
+                file_values = dotenv_values(self.env_path) if self.env_path.is_file() else {}
+                env = self.merged_env(file_values)
+                config = self.load_config(env)
+                errors = self.validate_config(config)
+            except Exception as e:
+                errors = [f"не удалось разобрать: {e}"]
+            if errors:
+                logger.error(f"❌ Конфигурация не перезагружена ({reason}), действует прежняя: {'; '.join(errors)}")
+                reloads.inc(result='invalid')
+                return False
+
+            changed = {key for key in set(config) | set(self.config) if config.get(key) != self.config.get(key)}
+            postponed = changed & self.RESTART_KEYS
+            for key in postponed:
+                config[key] = self.config[key]
+            changed -= postponed
+            if postponed:
+                logger.warning(f"⚠️ Вступят в силу после перезапуска: {', '.join(sorted(k.upper() for k in postponed))}")
+            if not changed:
+                self.env_file_values = file_values
+                reloads.inc(result='unchanged')
+                return False
+
+            # Клиенты создаются до подмены: при ошибке остается прежняя конфигурация
+            pyrus_api = self.create_pyrus_api(config) if changed & self.PYRUS_KEYS else self.pyrus_api
+            green_api = self.create_green_api(config) if changed & self.GREEN_API_KEYS else self.green_api
+            if (config.get('pyrus_login') and not pyrus_api) or (config.get('green_api_token') and not green_api):
+                logger.error(f"❌ Конфигурация не перезагружена ({reason}): не удалось создать клиент API")
+                reloads.inc(result='invalid')
+                return False
+
+            self.config = config
+            for key in set(self.env_file_values) | set(file_values):
+                if env.get(key) is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = env[key]
+            self.env_file_values = file_values
+            self.apply_config(changed, pyrus_api, green_api)
+
+        # Значения не пишем: среди них токены и пароли
+        logger.info(f"🔧 Конфигурация перезагружена ({reason}): {', '.join(sorted(k.upper() for k in changed))}")
+        reloads.inc(result='applied')
+        return True
+
+    def apply_config(self, changed: set, pyrus_api: Optional[PyrusAPI], green_api: Optional[GreenAPI]):
+        """Переключает арендатора default, прием писем, проверки и Telegram на новую конфигурацию"""
+        default = self.tenants['default']
+        self.pyrus_api = default.pyrus_api = pyrus_api
+        self.green_api = default.green_api = green_api
+        default.pyrus_form_id = self.config.get('pyrus_form_id', 0)
+
+        if 'email' in changed:
+            self.email_config = self.config['email']
+            default.mailboxes = [dict(self.email_config, mailbox='INBOX')] if self.email_configured() else []
+            if default.id in self.tenant_intake and not self.intake_stop.is_set():
+                # Новая сессия ждет, пока прежняя освободит соединение из лимита арендатора
+                self.stop_tenant_intake(default.id)
+                self.start_tenant_intake(default)
+        for listener in self.email_listeners:
+            listener.poll_interval = self.config.get('check_interval', 60)
+            listener.idle_timeout = min(self.config.get('email_idle_timeout', 300), 29 * 60)
+
+        # До start_services() проверки и Telegram еще не запущены: их запустит он сам
+        if self.probe_thread:
+            self.start_probes()
+        if changed & self.TELEGRAM_KEYS and getattr(self, 'replay_thread', None):
+            self.restart_telegram()
+
+    def env_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = self.env_path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def config_reload_loop(self):
+        """Фоновый поток: перечитывает .env по SIGHUP и при изменении файла"""
+        signature = self.env_signature()
+        while not self.replay_stop.is_set():
+            requested = self.config_reload_requested.wait(self.config.get('config_reload_interval') or 60)
+            if self.replay_stop.is_set():
+                return
+            try:
+                if requested:
+                    self.config_reload_requested.clear()
+                    signature = self.env_signature()
+                    self.reload_config("SIGHUP")
+                    continue
+                current = self.env_signature()
+                if not self.config.get('config_reload_interval') or current == signature:
+                    continue
+                # Редактор мог дописать файл не до конца: ждем, пока он перестанет меняться
+                if self.replay_stop.wait(0.5) or self.env_signature() != current:
+                    continue
+                signature = current
+                self.reload_config(f"изменен {self.env_path.name}")
+            except Exception as e:
+                logger.error(f"❌ Ошибка перезагрузки конфигурации: {e}")
+
+    def create_http_client(self, name: str) -> HTTPClient:
+        """Создает HTTP-клиент внешнего API с настройками из конфигурации"""
+        asyncio_runtime = self.config.get('runtime') == 'asyncio'
+        http_class = AsyncHTTPClient if asyncio_runtime and AsyncHTTPClient.available() else HTTPClient
+        return http_class(
+            name,
+            pool_size=self.config.get('http_pool_size', 10),
+            connect_timeout=self.config.get('http_connect_timeout', 5.0),
+            read_timeout=self.config.get('http_read_timeout', 30.0),
+            max_retries=self.config.get('http_max_retries', 3),
+            backoff_base=self.config.get('http_backoff', 0.5)
+        )
+
+    def http_client(self, name: str) -> HTTPClient:
+        """Общий HTTP-клиент API (создается при первом обращении)"""
+        if name not in self.http_clients:
+            self.http_clients[name] = self.create_http_client(name)
+        return self.http_clients[name]
+
+    def send_limiter(self, instance_id: str, overrides: Optional[Dict] = None) -> SendRateLimiter:
+        """
+        Ограничитель отправок инстанса Green API (общий для всех, кто через него
+        отправляет). Значения из .env можно переопределить для арендатора
+        ключами rate, burst, daily_limit и max_concurrency в green_api.
+        """
+        instance_id = str(instance_id)
+        if instance_id not in self.send_limiters:
+            overrides = overrides or {}
+            self.send_limiters[instance_id] = SendRateLimiter(
+                instance_id,
+                rate=float(overrides.get('rate', self.config.get('whatsapp_rate', 1.0))),
+                burst=int(overrides.get('burst', self.config.get('whatsapp_burst', 5))),
+                daily_limit=int(overrides.get('daily_limit', self.config.get('whatsapp_daily_limit', 0))),
+                max_concurrency=int(overrides.get('max_concurrency', self.config.get('whatsapp_max_concurrency', 4))),
+                slow_threshold=self.config.get('whatsapp_slow_threshold', 5.0)
+            )
+        return self.send_limiters[instance_id]
+
+    def api_breakers(self, kind: str, account: str, operations: Tuple[str, ...]) -> Dict[str, CircuitBreaker]:
+        """
+        Выключатели операций клиента API. Общие для всех клиентов одного инстанса
+        Green API или логина Pyrus: после перезагрузки .env состояние сохраняется.
+        """
+        breakers = {}
+        for operation in operations:
+            name = f"{kind}:{account}:{operation}"
+            if name not in self.circuit_breakers:
+                self.circuit_breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=self.config.get('circuit_failure_threshold', 5),
+                    reset_timeout=self.config.get('circuit_reset_timeout', 30.0),
+                    max_reset_timeout=self.config.get('circuit_max_reset_timeout', 300.0),
+                    half_open_calls=self.config.get('circuit_half_open_calls', 1),
+                    # Отложенные шаги доставки выполняются сразу после восстановления
+                    on_close=lambda: self.replay_wakeup.set()
+                )
+            breakers[operation] = self.circuit_breakers[name]
+        return breakers
+
+    def email_configured(self) -> bool:
+        """Проверяет, заполнены ли учетные данные почтового ящика"""
+        return Tenant.mailbox_configured(self.email_config)
+
+    def load_tenants(self) -> Dict[str, Tenant]:
+        """Арендатор default из .env плюс арендаторы из TENANTS_FILE"""
+        mailboxes = [dict(self.email_config, mailbox='INBOX')] if self.email_configured() else []
+        tenants = {
+            'default': Tenant(
+                'default', mailboxes,
+                pyrus_api=self.pyrus_api,
+                pyrus_form_id=self.config.get('pyrus_form_id', 0),
+                green_api=self.green_api,
+                max_connections=self.config.get('email_max_connections', 2)
+            )
         }
 
-    def setup_telegram_handlers(self):
+        path = self.config.get('tenants_file')
+        if not path:
+            return tenants
+
+        with open(path, encoding='utf-8') as f:
+            spec = json.load(f)
+        for item in spec.get('tenants', []):
+            tenant = self.create_tenant(item)
+            tenants[tenant.id] = tenant
+        self.telegram_tenant = spec.get('telegram_tenant', 'default')
+        if self.telegram_tenant not in tenants:
+            raise ValueError(f"telegram_tenant '{self.telegram_tenant}' не описан в {path}")
+
+        mailbox_count = sum(len(tenant.mailboxes) for tenant in tenants.values())
+        logger.info(f"🏢 Загружено арендаторов: {len(tenants)}, почтовых ящиков: {mailbox_count}")
+        return tenants
+
+    @classmethod
+    def expand_env(cls, value, where: str):
+        """
+        Подставляет ${VAR} из окружения в строки описания арендатора (вложенные
+        словари и списки обходятся, остальные значения не меняются). Незаданная
+        переменная - ошибка конфигурации, а не пароль "${VAR}".
+        """
+        if isinstance(value, dict):
+            return {key: cls.expand_env(item, where) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls.expand_env(item, where) for item in value]
+        if not isinstance(value, str):
+            return value
+
+        def substitute(match):
+            name = match.group(1)
+            if name not in os.environ:
+                raise ValueError(f"{where}: переменная окружения {name} не задана")
+            return os.environ[name]
+
+        return cls.ENV_REFERENCE.sub(substitute, value)
+
+    def create_tenant(self, item: Dict) -> Tenant:
+        """
+        Создает арендатора из описания в TENANTS_FILE. Строки вида ${VAR}
+        подставляются из окружения, чтобы не хранить пароли в файле.
+        """
+        item = self.expand_env(item, f"Арендатор {item.get('id', '?')}")
+        tenant_id = item['id']
+
+        mailboxes = []
+        for mailbox in item.get('mailboxes', []):
+            mailbox = {
+                'imap_server': mailbox.get('imap_server'),
+                'username': mailbox.get('username'),
+                'password': mailbox.get('password'),
+                'port': int(mailbox.get('port', 993)),
+                'use_ssl': bool(mailbox.get('use_ssl', True)),
+                'mailbox': mailbox.get('mailbox', 'INBOX')
+            }
+            if not Tenant.mailbox_configured(mailbox):
+                raise ValueError(f"Арендатор {tenant_id}: у ящика не заполнены сервер, логин или пароль")
+            mailboxes.append(mailbox)
+
+        pyrus_api = None
+        pyrus = item.get('pyrus')
+        if pyrus:
+            pyrus_api = PyrusAPI(
+                pyrus['login'],
+                pyrus['security_key'],
+                http=self.http_client('pyrus'),
+                base_url=pyrus.get('api_url', self.config['pyrus_api_url']),
+                token_ttl=self.config['pyrus_token_ttl'],
+                breakers=self.api_breakers('pyrus', pyrus['login'], ('create_task', 'form_register'))
+            )
+
+        green_api = None
+        green = item.get('green_api')
+        if green:
+            green_api = GreenAPI(
+                green['instance_id'],
+                green['api_token'],
+                http=self.http_client('green-api'),
+                api_url=green.get('api_url', self.config['green_api_url']),
+                limiter=self.send_limiter(green['instance_id'], green),
+                breakers=self.api_breakers('green_api', green['instance_id'], ('send_message',))
+            )
+
+        return Tenant(
+            tenant_id, mailboxes,
+            pyrus_api=pyrus_api,
+            pyrus_form_id=int((pyrus or {}).get('form_id', 0)),
+            green_api=green_api,
+            # Шаблоны, не заданные арендатором, берутся из общих (TemplateStore)
+            templates=item.get('templates', {}),
+            max_connections=int(item.get('max_connections', self.config.get('email_max_connections', 2)))
+        )
+
+    def tenant_for(self, data: Dict) -> Optional[Tenant]:
+        """Арендатор заявки; None, если он удален из конфигурации"""
+        tenant = self.tenants.get(data.get('tenant', 'default'))
+        if tenant is None:
+            logger.error(f"❌ Неизвестный арендатор заявки: {data.get('tenant')}")
+        return tenant
+
+    def setup_telegram_handlers(self, telegram_bot):
         """Настройка обработчиков для Telegram бота"""
 
-        @self.telegram_bot.message_handler(commands=['start', 'help'])
+        @telegram_bot.message_handler(commands=['start', 'help'])
         def send_welcome(message):
             welcome_text = """
 🤖 Бот автоответчик строительной компании "Срубим"
@@ -300,11 +4464,12 @@ class AutoResponderBot:
 /stats - Статистика работы
 /health - Проверка состояния всех сервисов
 /test_whatsapp <номер> - Тест отправки WhatsApp
+/sync_crm - Сверка заявок с задачами Pyrus
 /help - Эта помощь
             """
-            self.telegram_bot.reply_to(message, welcome_text)
+            telegram_bot.reply_to(message, welcome_text)
 
-        @self.telegram_bot.message_handler(commands=['stats'])
+        @telegram_bot.message_handler(commands=['stats'])
         def send_stats(message):
             stats_text = f"""
 📊 Статистика работы бота:
@@ -314,84 +4479,108 @@ class AutoResponderBot:
 💬 Отправлено Telegram: {self.stats['sent_telegram']}
 📋 Создано задач в CRM: {self.stats['created_crm_tasks']}
 ❌ Ошибок: {self.stats['errors']}
+{self.format_dedup_stats()}
 
 ⏰ Время работы: {self.get_uptime()}
-            """
-            self.telegram_bot.reply_to(message, stats_text)
 
-        @self.telegram_bot.message_handler(commands=['health'])
-        def health_check(message):
-            status = "🟢 Бот работает нормально"
+📈 За последние 1 мин / 1 ч / 24 ч:
+{self.format_recent_stats()}
 
-            # Проверяем доступность сервисов
-            checks = []
+📬 Очереди:
+{self.format_queue_stats()}
+{self.format_outbox_stats()}
+{self.format_crm_sync_stats()}
 
-            # Проверка Green API
-            if self.green_api and self.green_api.get_state_instance():
-                checks.append("✅ Green API WhatsApp - авторизован")
-            elif self.green_api:
-                checks.append("⚠️ Green API WhatsApp - не авторизован")
-            else:
-                checks.append("❌ Green API WhatsApp - не настроен")
+⏱ Задержки API:
+{self.format_latency_stats()}
+            """
+            telegram_bot.reply_to(message, stats_text)
 
-            # Проверка Pyrus CRM
-            if self.pyrus_api and self.pyrus_api.auth_token:
-                checks.append("✅ Pyrus CRM - подключен")
+        @telegram_bot.message_handler(commands=['health'])
+        def health_check(message):
+            # Результаты фоновых проверок: команда не обращается к внешним сервисам
+            snapshot = self.health_snapshot()
+            if snapshot['status'] == 'ok':
+                status = "🟢 Бот работает нормально"
             else:
-                checks.append("❌ Pyrus CRM - не настроен")
+                status = "🟡 Бот работает, есть недоступные сервисы"
 
-            # Проверка Email
-            if all(self.email_config.values()):
-                checks.append("✅ Email IMAP - настроен")
-            else:
+            checks = [self.format_health()] if self.probes else []
+            if not self.green_api:
+                checks.append("❌ Green API WhatsApp - не настроен")
+            if not self.pyrus_api:
+                checks.append("❌ Pyrus CRM - не настроен")
+            if not self.email_configured():
                 checks.append("❌ Email IMAP - не настроен")
 
             health_text = f"{status}\n\n" + "\n".join(checks)
-            self.telegram_bot.reply_to(message, health_text)
-
-        @self.telegram_bot.message_handler(commands=['test_whatsapp'])
+            telegram_bot.reply_to(message, health_text)
+
+        @telegram_bot.message_handler(commands=['sync_crm'])
+        def sync_crm(message):
+            telegram_bot.reply_to(message, "🧾 Сверяем заявки с задачами Pyrus...")
+            totals = self.crm_sync.reconcile()
+            if self.config.get('crm_sync_mode') == 'bulk':
+                self.crm_sync.sync(self.replay_stop)
+            telegram_bot.reply_to(
+                message,
+                f"🧾 Сверка завершена за {totals['seconds']:.1f} с: подтверждено {totals['verified']}, "
+                f"привязано {totals['relinked']}, возвращено на создание {totals['backfilled']}, "
+                f"без ответа Pyrus {totals['unreachable']}\n{self.format_crm_sync_stats()}"
+            )
+
+        @telegram_bot.message_handler(commands=['test_whatsapp'])
         def test_whatsapp(message):
             try:
                 # Извлекаем номер телефона из команды
                 parts = message.text.split(' ', 1)
                 if len(parts) < 2:
-                    self.telegram_bot.reply_to(message, "❌ Укажите номер телефона: /test_whatsapp +79001234567")
+                    telegram_bot.reply_to(message, "❌ Укажите номер телефона: /test_whatsapp +79001234567")
                     return
 
                 phone = parts[1]
                 test_message = "Тестовое сообщение от бота автоответчика компании «Срубим»"
 
                 if self.green_api:
-                    if self.green_api.send_message(phone, test_message):
-                        self.telegram_bot.reply_to(message, f"✅ Тестовое сообщение отправлено на {phone}")
+                    def reply_with_result(future):
+                        if not future.exception() and future.result():
+                            telegram_bot.reply_to(message, f"✅ Тестовое сообщение отправлено на {phone}")
+                        elif future.exception():
+                            telegram_bot.reply_to(message, f"❌ Не удалось отправить сообщение на {phone}: "
+                                                           f"{future.exception()}")
+                        else:
+                            telegram_bot.reply_to(message, f"❌ Не удалось отправить сообщение на {phone}")
+
+                    if isinstance(self.whatsapp_queue, AsyncDispatchQueue):
+                        send = self.green_api.asend_message
                     else:
-                        self.telegram_bot.reply_to(message, f"❌ Не удалось отправить сообщение на {phone}")
+                        send = self.green_api.send_message
+                    future = self.whatsapp_queue.submit(send, phone, test_message, Priority.HIGH, priority=Priority.HIGH)
+                    future.add_done_callback(reply_with_result)
                 else:
-                    self.telegram_bot.reply_to(message, "❌ Green API не настроен")
+                    telegram_bot.reply_to(message, "❌ Green API не настроен")
 
             except Exception as e:
-                self.telegram_bot.reply_to(message, f"❌ Ошибка: {e}")
+                telegram_bot.reply_to(message, f"❌ Ошибка: {e}")
 
-        @self.telegram_bot.message_handler(func=lambda message: True)
+        @telegram_bot.message_handler(func=lambda message: True)
         def handle_message(message):
             # Проверяем, является ли сообщение заявкой
-            if self.is_application_message(message.text):
-                logger.info(f"📨 Получена заявка в Telegram от {message.from_user.username or 'Unknown'}")
-                application_data = self.parse_application(message.text)
+            is_application, application_data = self.recognize_application(message.text, self.telegram_tenant)
+            if is_application:
+                logger.info("📨 Получена заявка в Telegram от %s", message.from_user.username or 'Unknown',
+                            extra={'category': 'application'})
                 if application_data:
-                    success = self.process_application(application_data)
-                    if success:
-                        self.telegram_bot.reply_to(message, "✅ Заявка обработана и отправлен ответ клиенту")
+                    accepted = self.process_application(application_data)
+                    if accepted:
+                        telegram_bot.reply_to(message, "✅ Заявка принята, ответ клиенту отправляется")
                     else:
-                        self.telegram_bot.reply_to(message, "⚠️ Заявка обработана частично")
+                        telegram_bot.reply_to(message, "⚠️ Заявка обработана частично")
                 else:
-                    self.telegram_bot.reply_to(message, "❌ Не удалось обработать заявку")
+                    telegram_bot.reply_to(message, "❌ Не удалось обработать заявку")
 
     def get_uptime(self) -> str:
         """Возвращает время работы бота"""
-        if not hasattr(self, 'start_time'):
-            self.start_time = datetime.now()
-
         uptime = datetime.now() - self.start_time
         days = uptime.days
         hours, remainder = divmod(uptime.seconds, 3600)
@@ -399,259 +4588,944 @@ class AutoResponderBot:
 
         return f"{days}д {hours}ч {minutes}м"
 
+    def format_latency_stats(self) -> str:
+        """Строки /stats с квантилями задержек по эндпоинтам внешних API"""
+        lines = []
+        for client in (self.pyrus_api, self.green_api):
+            if client:
+                lines.extend(f"• {line}" for line in client.http.latency_summary())
+        return "\n".join(lines) or "• запросов еще не было"
+
+    def format_recent_stats(self) -> str:
+        """Строки /stats со значениями за скользящие окна"""
+        rows = (
+            ("✅ Заявок", ('processed_applications',)),
+            ("📤 Отправок", ('sent_whatsapp', 'sent_telegram')),
+            ("❌ Ошибок", ('errors',))
+        )
+        lines = []
+        for title, names in rows:
+            values = [sum(self.stats.recent(name, window) for name in names) for window in StatsCore.WINDOWS]
+            lines.append(f"{title}: {' / '.join(str(value) for value in values)}")
+        return "\n".join(lines)
+
+    def format_dedup_stats(self) -> str:
+        """Строка /stats со счетчиками индекса дубликатов"""
+        return (f"🔁 Дубликаты: отсеяно {self.dedup.hits}, новых заявок {self.dedup.misses}, "
+                f"ключей в индексе {len(self.dedup.entries)}")
+
+    def format_outbox_stats(self) -> str:
+        """Строка /stats с состоянием журнала заявок"""
+        counts = self.outbox.counts()
+        return (f"• outbox: ожидают доставки {counts['pending']}, доставлено {counts['delivered']}, "
+                f"не доставлено {counts['failed']}")
+
+    def format_crm_sync_stats(self) -> str:
+        """Строка /stats с состоянием синхронизации задач CRM"""
+        backlog, _ = self.outbox.step_backlog('crm')
+        line = f"• CRM: без задачи {backlog}, отставание {self.crm_sync.lag():.0f} с"
+        last_sync = self.crm_sync.last_sync
+        if last_sync:
+            line += (f", последний проход: создано {last_sync['created']}, ошибок {last_sync['failed']} "
+                     f"({last_sync['rate']:.1f} задач/с)")
+        last_reconcile = self.crm_sync.last_reconcile
+        if last_reconcile:
+            line += (f", сверка: подтверждено {last_reconcile['verified']}, привязано {last_reconcile['relinked']}, "
+                     f"восстановлено {last_reconcile['backfilled']}")
+        return line
+
+    def format_queue_stats(self) -> str:
+        """Строки /stats с глубиной и пропускной способностью очередей"""
+        lines = []
+        for dispatch_queue in (self.crm_queue, self.whatsapp_queue):
+            stats = dispatch_queue.stats()
+            lines.append(
+                f"• {dispatch_queue.name}: в очереди {stats['depth']}/{stats['maxsize']}, "
+                f"выполнено {stats['completed']} ({stats['per_minute']:.1f}/мин), "
+                f"ошибок {stats['failed']}, отклонено {stats['rejected']}"
+            )
+        return "\n".join(lines)
+
     def is_application_message(self, text: str) -> bool:
         """Проверяет, является ли сообщение заявкой с сайта"""
-        if not text:
-            return False
-
-        patterns = [
-            r"Новая заявка № \d+",
-            r"Название формы: (Application|Заявка)",
-            r"Данные формы:",
-            r"Телефон: [+\d\s\(\)\-]+",
-            r"Куда отправить расчет стоимости"
-        ]
-
-        matches = 0
-        for pattern in patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                matches += 1
-
-        # Считаем заявкой, если совпадает хотя бы 2 паттерна
-        return matches >= 2
+        score, _ = self.application_parser.classify(text)
+        return score >= ApplicationParser.MIN_SCORE
 
     def parse_application(self, text: str) -> Optional[Dict]:
         """Парсит заявку и извлекает нужную информацию"""
         try:
-            data = {}
-
-            # Извлекаем номер заявки
-            application_number_match = re.search(r"Новая заявка № (\d+)", text)
-            if application_number_match:
-                data['application_number'] = application_number_match.group(1)
+            data = self.application_parser.extract(text)
+            data['idempotency_key'] = ApplicationOutbox.make_key(text)
+            logger.info("📋 Распознанные данные заявки: %s", data, extra={'category': 'application'})
+            return data if data.get('phone') else None
 
-            # Извлекаем номер телефона
-            phone_patterns = [
-                r"Телефон: ([+\d\s\(\)\-]+)",
-                r"тел[\.:][\s]*([+\d\s\(\)\-]+)",
-                r"телефон[\.:][\s]*([+\d\s\(\)\-]+)"
-            ]
+        except Exception as e:
+            logger.error(f"❌ Ошибка при парсинге заявки: {e}")
+            self.stats.inc('errors')
+            return None
 
-            for pattern in phone_patterns:
-                phone_match = re.search(pattern, text, re.IGNORECASE)
-                if phone_match:
-                    data['phone'] = phone_match.group(1).strip()
-                    break
+    def recognize_application(self, text: str, tenant_id: str = 'default') -> Tuple[bool, Optional[Dict]]:
+        """
+        (это заявка?, распознанные данные или None). Поля извлекаются только
+        у заявок, а совпадения классификатора переиспользуются парсером.
+        """
+        try:
+            received_at = time.time()
+            with metrics.timer('classify'):
+                score, matches = self.application_parser.classify(text)
+            if score < ApplicationParser.MIN_SCORE:
+                return False, None
+
+            with metrics.timer('parse'):
+                data = self.application_parser.extract(text, *matches)
+            data['received_at'] = received_at
+            data['tenant'] = tenant_id
+            # Одно и то же письмо в ящиках разных брендов - разные заявки
+            data['idempotency_key'] = ApplicationOutbox.make_key(
+                text if tenant_id == 'default' else f"{tenant_id}\n{text}"
+            )
+            logger.info("📋 Распознанные данные заявки: %s", data, extra={'category': 'application'})
+            return True, data if data.get('phone') else None
 
-            # Определяем тип объекта (дом или баня)
-            house_keywords = ['дом', 'коттедж', 'домик', 'house']
-            bath_keywords = ['бан', 'сауна', 'парилка', 'bath', 'sauna']
+        except Exception as e:
+            logger.error(f"❌ Ошибка при парсинге заявки: {e}")
+            self.stats.inc('errors')
+            return False, None
 
-            text_lower = text.lower()
+    def process_application(self, data: Dict) -> bool:
+        """
+        Записывает заявку в журнал и ставит шаги доставки в очереди.
+        Возвращает True, когда заявка надежно сохранена на диске.
+        """
+        future = self.accept_application(data)
+        try:
+            future.result(timeout=30)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Заявка не сохранена в outbox: {e}")
+            return False
 
-            if any(keyword in text_lower for keyword in house_keywords):
-                data['object_type'] = 'house'
-                data['object_description'] = 'дом'
-            elif any(keyword in text_lower for keyword in bath_keywords):
-                data['object_type'] = 'bath'
-                data['object_description'] = 'баня'
+    def accept_application(self, data: Dict) -> Future:
+        """
+        Асинхронно записывает заявку в журнал. Future завершается после фиксации
+        на диске; после этого шаги доставки ставятся в очереди.
+        """
+        # Пропускаем заявки с способом связи "озвучить по телефону"
+        if data.get('contact_method') == 'phone_call':
+            logger.info("⏭️ Пропускаем заявку с способом связи 'озвучить по телефону'", extra={'category': 'application'})
+            future = Future()
+            future.set_result(False)
+            return future
+
+        key = self.application_key(data)
+        steps = self.delivery_steps(data)
+
+        # Одна и та же заявка часто приходит и по почте, и в Telegram
+        dedup_keys = DedupIndex.keys_for(data)
+        duplicate_of = self.dedup.check_and_add(dedup_keys)
+        if duplicate_of:
+            logger.info("🔁 Дубликат заявки (%s), повторно не обрабатываем", duplicate_of, extra={'category': 'duplicate'})
+            future = Future()
+            future.set_result(False)
+            return future
+
+        def on_stored(stored: Future):
+            if stored.exception():
+                # Заявка не сохранена: при повторном получении она не должна считаться дублем
+                self.dedup.forget(dedup_keys)
+                self.stats.inc('errors')
+                return
+            if not stored.result():
+                logger.info("♻️ Заявка %s уже есть в outbox, повторно не отправляем", key[:12],
+                            extra={'category': 'duplicate', 'key': key})
+                return
+            # Не блокируем поток записи: если очередь занята, заявку доставит повторный проход
+            self.deliver(key, data, steps, put_timeout=0)
+
+        future = self.outbox.add(key, data, steps)
+        future.add_done_callback(on_stored)
+        return future
+
+    @staticmethod
+    def application_key(data: Dict) -> str:
+        """Ключ идемпотентности заявки; если распознавание его не задало, выводится из номера и телефона"""
+        if not data.get('idempotency_key'):
+            fingerprint = f"{data.get('application_number', '')}|{data.get('phone', '')}|{data.get('created_at', '')}"
+            data['idempotency_key'] = ApplicationOutbox.make_key(fingerprint)
+        return data['idempotency_key']
+
+    def confirm_application(self, data: Dict) -> Future:
+        """
+        Принимает заявку из письма. Future[bool] отвечает, можно ли пометить письмо
+        прочитанным: при EMAIL_ACK=stored - после записи в outbox, при delivered -
+        после доставки всех шагов. Неудачная доставка дает False: письмо остается
+        непрочитанным, а заявку повторно доставит outbox.
+        """
+        confirmation = Future()
+        key = self.application_key(data)
+        wait_delivery = self.config.get('email_ack', 'delivered') == 'delivered'
+        if wait_delivery:
+            # Регистрируемся до записи: доставка может завершиться раньше, чем вернется add()
+            self.add_delivery_waiter(key, confirmation)
+
+        def on_stored(stored: Future):
+            if stored.exception():
+                self.resolve_delivery_waiter(key, confirmation, False)
+            elif not wait_delivery:
+                self.resolve_delivery_waiter(key, confirmation, True)
+            elif stored.result():
+                if 'pending' not in self.delivery_steps(data).values():
+                    self.resolve_delivery_waiter(key, confirmation, True)
+                # Иначе результат даст on_step_recorded()
             else:
-                data['object_type'] = 'house'  # по умолчанию дом
-                data['object_description'] = 'дом'
-
-            # Извлекаем площадь строения
-            area_match = re.search(r"Площадь строения: ([^\n]+)", text)
-            if area_match:
-                data['area'] = area_match.group(1).strip()
-
-            # Извлекаем бюджет
-            budget_match = re.search(r"бюджет[^:]*: ([^\n]+)", text, re.IGNORECASE)
-            if budget_match:
-                data['budget'] = budget_match.group(1).strip()
-
-            # Извлекаем наличие участка
-            land_match = re.search(r"земельный участок[^:]*: ([^\n]+)", text, re.IGNORECASE)
-            if land_match:
-                data['has_land'] = land_match.group(1).strip()
-
-            # Определяем способ связи
-            contact_patterns = [
-                (r"whatsapp", 'whatsapp'),
-                (r"telegram", 'telegram'),
-                (r"озвучить по телефону", 'phone_call'),
-                (r"позвонить", 'phone_call')
-            ]
-
-            for pattern, method in contact_patterns:
-                if re.search(pattern, text, re.IGNORECASE):
-                    data['contact_method'] = method
-                    break
+                # Не записана: пропущена, дубль или уже в журнале. Письмо с заявкой,
+                # которая еще доставляется, оставляем непрочитанным
+                self.resolve_delivery_waiter(key, confirmation, self.outbox.status(key) != 0)
+
+        self.accept_application(data).add_done_callback(on_stored)
+        return confirmation
+
+    def add_delivery_waiter(self, key: str, confirmation: Future):
+        with self.in_flight_lock:
+            self.delivery_waiters.setdefault(key, []).append(confirmation)
+
+        def forget(future: Future):
+            # Письмо перестало ждать (тайм-аут подтверждения): не держим ссылку до конца доставки
+            if future.cancelled():
+                self.resolve_delivery_waiter(key, future, False)
+        confirmation.add_done_callback(forget)
+
+    def resolve_delivery_waiter(self, key: str, confirmation: Optional[Future], delivered: bool):
+        """Завершает ожидание письма (или всех писем заявки, если confirmation=None)"""
+        with self.in_flight_lock:
+            waiters = self.delivery_waiters.get(key, [])
+            if confirmation is None:
+                resolved, waiters = waiters, []
             else:
-                data['contact_method'] = 'whatsapp'  # по умолчанию WhatsApp
-
-            # Определяем тип формы
-            form_match = re.search(r"Название формы: (Application|Заявка)", text, re.IGNORECASE)
-            if form_match:
-                data['form_type'] = form_match.group(1).lower()
+                resolved = [confirmation]
+                waiters = [waiter for waiter in waiters if waiter is not confirmation]
+            if waiters:
+                self.delivery_waiters[key] = waiters
             else:
-                data['form_type'] = 'application'
+                self.delivery_waiters.pop(key, None)
 
-            # Добавляем временную метку
-            data['created_at'] = datetime.now().isoformat()
-
-            logger.info(f"📋 Распознанные данные заявки: {data}")
-            return data if data.get('phone') else None
+        for waiter in resolved:
+            try:
+                waiter.set_result(delivered)
+            except InvalidStateError:
+                # Уже отменено или завершено
+                pass
+
+    def delivery_steps(self, data: Dict) -> Dict[str, str]:
+        """Какие шаги доставки нужны заявке: pending - выполнить, skipped - не требуется"""
+        contact_method = data.get('contact_method')
+        phone = data.get('phone')
+
+        tenant = self.tenants.get(data.get('tenant', 'default'))
+        if tenant is None:
+            # Арендатор удален из конфигурации: шаги остаются в журнале до его возвращения
+            return {'crm': 'pending', 'message': 'pending'}
+
+        crm_needed = tenant.pyrus_api and tenant.pyrus_form_id
+        message_needed = phone and (
+            (contact_method == 'whatsapp' and tenant.green_api) or contact_method == 'telegram'
+        )
+        return {
+            'crm': 'pending' if crm_needed else 'skipped',
+            'message': 'pending' if message_needed else 'skipped'
+        }
 
-        except Exception as e:
-            logger.error(f"❌ Ошибка при парсинге заявки: {e}")
-            self.stats['errors'] += 1
+    def deliver(self, key: str, data: Dict, steps: Dict[str, str], put_timeout: Optional[float] = -1,
+                priority: int = Priority.NORMAL):
+        """Ставит незавершенные шаги доставки заявки в очереди CRM и WhatsApp"""
+        for step, status in steps.items():
+            if status != 'pending':
+                continue
+            if step == 'crm' and self.config.get('crm_sync_mode') == 'bulk':
+                # Задачи CRM создает пакетная синхронизация (crm_sync_loop)
+                continue
+            if not self.step_ready(data, step):
+                # Зависимость еще не прошла проверку или разомкнут выключатель:
+                # шаг ждет в outbox, попытка не тратится
+                self.notify_fallback(key, step, data)
+                continue
+
+            with self.in_flight_lock:
+                if (key, step) in self.in_flight_steps:
+                    continue
+                self.in_flight_steps.add((key, step))
+
+            dispatch_queue = self.crm_queue if step == 'crm' else self.whatsapp_queue
+            if isinstance(dispatch_queue, AsyncDispatchQueue):
+                run_step = self.arun_delivery_step
+            else:
+                run_step = self.run_delivery_step
+            try:
+                dispatch_queue.submit(run_step, key, step, data, priority, put_timeout=put_timeout, priority=priority)
+            except queue.Full:
+                logger.warning(f"⏳ Шаг {step} заявки {key[:12]} отложен до повторного прохода outbox")
+                with self.in_flight_lock:
+                    self.in_flight_steps.discard((key, step))
+
+    def step_api(self, data: Dict, step: str):
+        """Клиент API, через который выполняется шаг (None - шаг не обращается к сети)"""
+        tenant = self.tenant_for(data)
+        if not tenant:
             return None
+        if step == 'crm':
+            return tenant.pyrus_api
+        return tenant.green_api if data.get('contact_method') == 'whatsapp' else None
+
+    def step_breaker(self, data: Dict, step: str) -> Optional[CircuitBreaker]:
+        """Выключатель операции, которой выполняется шаг"""
+        api = self.step_api(data, step)
+        if not api:
+            return None
+        return api.breakers.get('create_task' if step == 'crm' else 'send_message')
+
+    def step_ready(self, data: Dict, step: str) -> bool:
+        """Прошла ли проверку зависимость, через которую выполняется шаг, и пропустит ли вызов ее выключатель"""
+        api = self.step_api(data, step)
+        if not api:
+            return True
+        probe = self.probes.get(api)
+        if probe is not None and not probe.ready.is_set():
+            return False
+        breaker = self.step_breaker(data, step)
+        return breaker is None or breaker.available()
+
+    def defer_step(self, key: str, step: str, data: Dict, error: CircuitOpenError):
+        """
+        Шаг не выполнялся: выключатель разомкнулся, пока шаг ждал в очереди.
+        Результат не записывается, шаг остается в outbox без траты попытки.
+        """
+        logger.info("⏸️ Шаг %s заявки %s отложен: %s", step, key[:12], error, extra={'category': 'delivery'})
+        with self.in_flight_lock:
+            self.in_flight_steps.discard((key, step))
+        # Письмо не ждет восстановления сервиса: заявка уже в журнале
+        self.resolve_delivery_waiter(key, None, False)
+        self.notify_fallback(key, step, data)
+
+    def notify_fallback(self, key: str, step: str, data: Dict):
+        """
+        Пока выключатель шага разомкнут или сервис не проходит проверку, сообщает
+        о заявке в MANAGER_CHAT_ID, чтобы менеджер мог связаться с клиентом сам.
+        Один раз на заявку.
+        """
+        chat_id = self.config.get('manager_chat_id')
+        api = self.step_api(data, step)
+        if not chat_id or not self.telegram_bot or not api:
+            return
+        breaker = self.step_breaker(data, step)
+        probe = self.probes.get(api)
+        if (not breaker or breaker.state == 'closed') and (not probe or probe.state != 'unhealthy'):
+            return
+        with self.in_flight_lock:
+            if key in self.fallback_notified:
+                return
+            self.fallback_notified.add(key)
 
-    def process_application(self, data: Dict) -> bool:
-        """Обрабатывает заявку и отправляет ответное сообщение"""
-        try:
-            success_count = 0
-            total_actions = 3  # WhatsApp/Telegram, CRM, статистика
-
-            # Пропускаем заявки с способом связи "озвучить по телефону"
-            if data.get('contact_method') == 'phone_call':
-                logger.info("⏭️ Пропускаем заявку с способом связи 'озвучить по телефону'")
-                return True
+        service = "Pyrus" if step == 'crm' else "WhatsApp"
+        text = (f"⚠️ {service} недоступен, заявка ждет восстановления\n"
+                f"📞 {data.get('phone') or '-'}, {data.get('name') or 'без имени'}\n"
+                f"🏠 {data.get('object_description') or '-'}")
+        if data.get('application_number'):
+            text += f"\n🧾 Заявка № {data['application_number']}"
+        bot = self.telegram_bot
 
-            # 1. Создаем задачу в Pyrus CRM
-            if self.pyrus_api and self.config.get('pyrus_form_id'):
-                crm_data = {
-                    'Телефон': data.get('phone', ''),
-                    'Тип объекта': data.get('object_description', ''),
-                    'Способ связи': data.get('contact_method', ''),
-                    'Площадь': data.get('area', ''),
-                    'Бюджет': data.get('budget', ''),
-                    'Участок': data.get('has_land', ''),
-                    'Номер заявки': data.get('application_number', ''),
-                    'Дата создания': data.get('created_at', '')
-                }
+        def send():
+            try:
+                bot.send_message(chat_id, text)
+            except Exception as e:
+                logger.error(f"❌ Не удалось сообщить менеджеру о заявке {key[:12]}: {e}")
+                with self.in_flight_lock:
+                    self.fallback_notified.discard(key)
 
-                task_id = self.pyrus_api.create_task(self.config['pyrus_form_id'], crm_data)
-                if task_id:
-                    success_count += 1
-                    self.stats['created_crm_tasks'] += 1
-                    data['crm_task_id'] = task_id
+        # deliver() может выполняться в потоке записи журнала: Telegram не должен его задерживать
+        try:
+            self.fallback_pool.submit(send)
+        except RuntimeError:
+            # Бот останавливается
+            pass
+
+    def step_superseded(self, key: str, step: str) -> bool:
+        """
+        Шаг уже выполнен другой попыткой. Повторный проход outbox ставит шаги в
+        очереди по снимку журнала; пока он ждет места в очереди, снимок устаревает.
+        Проверка в момент выполнения надежна: шаг снова попадает в очередь только
+        после того, как результат предыдущей попытки зафиксирован.
+        """
+        if self.outbox.step_pending(key, step):
+            return False
+        with self.in_flight_lock:
+            self.in_flight_steps.discard((key, step))
+        return True
 
-            # 2. Выбираем шаблон сообщения
-            if data.get('form_type') == 'заявка':
-                message_template = self.message_templates['general_request']
-            else:
-                object_type = data.get('object_type', 'house')
-                message_template = self.message_templates.get(object_type, self.message_templates['house'])
-
-            # 3. Отправляем сообщение в зависимости от способа связи
-            contact_method = data.get('contact_method')
-            phone = data.get('phone')
-
-            message_sent = False
-
-            if contact_method == 'whatsapp' and phone and self.green_api:
-                if self.green_api.send_message(phone, message_template):
-                    success_count += 1
-                    self.stats['sent_whatsapp'] += 1
-                    message_sent = True
-            elif contact_method == 'telegram' and phone:
-                # Здесь можно добавить отправку через Telegram User API
-                logger.info(f"📱 Требуется отправка в Telegram на {phone}: {message_template}")
-                # Заглушка - считаем успешным
-                success_count += 1
-                self.stats['sent_telegram'] += 1
-                message_sent = True
-
-            # 4. Обновляем общую статистику
-            if message_sent or data.get('crm_task_id'):
-                self.stats['processed_applications'] += 1
-                success_count += 1
-
-            # Определяем успешность операции
-            success_ratio = success_count / total_actions
-            is_successful = success_ratio >= 0.5  # Считаем успешным если выполнено хотя бы 50%
-
-            if is_successful:
-                logger.info(f"✅ Успешно обработана заявка ({success_count}/{total_actions}): {data}")
+    def run_delivery_step(self, key: str, step: str, data: Dict, priority: int = Priority.NORMAL):
+        """Выполняет один шаг доставки и записывает его результат в журнал"""
+        if self.step_superseded(key, step):
+            return None
+        result, error, deferred = None, "", None
+        try:
+            if step == 'crm':
+                result = self.create_crm_task(data)
             else:
-                logger.warning(f"⚠️ Частично обработана заявка ({success_count}/{total_actions}): {data}")
-                self.stats['errors'] += 1
-
-            return is_successful
-
+                result = self.send_reply(data, priority)
+            if not result:
+                error = f"шаг {step} не выполнен"
+        except CircuitOpenError as e:
+            deferred = e
         except Exception as e:
-            logger.error(f"❌ Ошибка при обработке заявки: {e}")
-            self.stats['errors'] += 1
-            return False
+            error = str(e)
+            logger.error(f"❌ Ошибка шага {step} заявки {key[:12]}: {e}")
+        finally:
+            if deferred:
+                self.defer_step(key, step, data, deferred)
+            else:
+                recorded = self.outbox.complete_step(key, step, data, bool(result), error)
+                recorded.add_done_callback(lambda f: self.on_step_recorded(key, step, data, bool(result), f))
+        return result
 
-    def check_email(self):
-        """Проверяет новые письма в почтовом ящике"""
+    async def arun_delivery_step(self, key: str, step: str, data: Dict, priority: int = Priority.NORMAL):
+        """Асинхронный вариант run_delivery_step()"""
+        if await asyncio.to_thread(self.step_superseded, key, step):
+            return None
+        result, error = None, ""
         try:
-            if not all(self.email_config.values()):
-                return
+            if step == 'crm':
+                result = await self.acreate_crm_task(data)
+            else:
+                result = await self.asend_reply(data, priority)
+            if not result:
+                error = f"шаг {step} не выполнен"
+        except asyncio.CancelledError:
+            # Прерван при остановке: шаг остается незавершенным в журнале и будет повторен
+            with self.in_flight_lock:
+                self.in_flight_steps.discard((key, step))
+            raise
+        except CircuitOpenError as e:
+            self.defer_step(key, step, data, e)
+            return None
+        except Exception as e:
+            error = str(e)
+            logger.error(f"❌ Ошибка шага {step} заявки {key[:12]}: {e}")
+
+        recorded = self.outbox.complete_step(key, step, data, bool(result), error)
+        recorded.add_done_callback(lambda f: self.on_step_recorded(key, step, data, bool(result), f))
+        return result
+
+    def on_step_recorded(self, key: str, step: str, data: Dict, success: bool, recorded: Future):
+        """Обновляет статистику, когда результат шага записан в журнал"""
+        with self.in_flight_lock:
+            self.in_flight_steps.discard((key, step))
+            if not recorded.exception() and recorded.result():
+                # Заявка доставлена или исчерпала попытки
+                self.fallback_notified.discard(key)
+
+        if success and step == 'message' and data.get('received_at'):
+            metrics.stage_latency('lead_to_reply').observe(time.time() - data['received_at'])
+
+        if success and step == 'crm':
+            self.stats.inc('created_crm_tasks')
+        elif success and data.get('contact_method') == 'whatsapp':
+            self.stats.inc('sent_whatsapp')
+        elif success:
+            self.stats.inc('sent_telegram')
+        else:
+            self.stats.inc('errors')
+
+        if recorded.exception():
+            self.resolve_delivery_waiter(key, None, False)
+            return
+        if recorded.result() or not success:
+            # Доставлена, исчерпаны попытки или очередная неудача: письму больше нечего ждать
+            self.resolve_delivery_waiter(key, None, recorded.result() != 0)
+        if recorded.result() == 1:
+            self.stats.inc('processed_applications')
+            logger.info("✅ Успешно обработана заявка: %s", data, extra={'category': 'application', 'key': key})
+        elif recorded.result() == 2:
+            logger.warning("⚠️ Частично обработана заявка, попытки исчерпаны: %s", data, extra={'key': key})
+        elif not success:
+            logger.warning("⚠️ Шаг %s заявки %s не выполнен, будет повтор", step, key[:12], extra={'key': key, 'step': step})
+
+    def create_crm_task(self, data: Dict) -> Optional[str]:
+        """Создает задачу в Pyrus CRM по данным заявки"""
+        if data.get('crm_task_id'):
+            return data['crm_task_id']
+        tenant = self.tenant_for(data)
+        if not tenant or not tenant.pyrus_api:
+            return None
 
-            imap_server = self.email_config.get('imap_server')
-            username = self.email_config.get('username')
-            password = self.email_config.get('password')
+        with metrics.timer('pyrus'):
+            task_id = tenant.pyrus_api.create_task(tenant.pyrus_form_id, self.crm_fields(data))
+        if task_id:
+            data['crm_task_id'] = task_id
+        else:
+            metrics.stage_error('pyrus')
+        return task_id
+
+    async def acreate_crm_task(self, data: Dict) -> Optional[str]:
+        """Асинхронный вариант create_crm_task()"""
+        if data.get('crm_task_id'):
+            return data['crm_task_id']
+        tenant = self.tenant_for(data)
+        if not tenant or not tenant.pyrus_api:
+            return None
 
-            # Подключаемся к почтовому серверу
-            imap = imaplib.IMAP4_SSL(imap_server)
-            imap.login(username, password)
-            imap.select("INBOX")
+        with metrics.timer('pyrus'):
+            task_id = await tenant.pyrus_api.acreate_task(tenant.pyrus_form_id, self.crm_fields(data))
+        if task_id:
+            data['crm_task_id'] = task_id
+        else:
+            metrics.stage_error('pyrus')
+        return task_id
 
-            # Ищем непрочитанные письма
-            status, messages = imap.search(None, "UNSEEN")
+    @staticmethod
+    def crm_fields(data: Dict) -> Dict:
+        """Поля задачи Pyrus по данным заявки"""
+        return {
+            'Телефон': data.get('phone', ''),
+            'Тип объекта': data.get('object_description', ''),
+            'Способ связи': data.get('contact_method', ''),
+            'Площадь': data.get('area', ''),
+            'Бюджет': data.get('budget', ''),
+            'Участок': data.get('has_land', ''),
+            'Номер заявки': data.get('application_number', ''),
+            'Дата создания': data.get('created_at', '')
+        }
 
-            if status == "OK" and messages[0]:
-                message_ids = messages[0].split()
-                logger.info(f"📧 Найдено {len(message_ids)} непрочитанных писем")
+    def reply_template(self, data: Dict, tenant: Tenant) -> str:
+        """Текст ответа клиенту по таблице правил и шаблонам арендатора"""
+        return self.templates.render(data, tenant.id)
 
-                for msg_id in message_ids:
-                    # Получаем письмо
-                    status, msg_data = imap.fetch(msg_id, "(RFC822)")
+    def send_reply(self, data: Dict, priority: int = Priority.NORMAL) -> bool:
+        """Отправляет клиенту ответ выбранным способом связи"""
+        tenant = self.tenant_for(data)
+        if not tenant:
+            return False
+        message_template = self.reply_template(data, tenant)
+
+        contact_method = data.get('contact_method')
+        phone = data.get('phone')
+
+        if contact_method == 'whatsapp' and phone and tenant.green_api:
+            with metrics.timer('green_api'):
+                sent = tenant.green_api.send_message(phone, message_template, priority)
+            if not sent:
+                metrics.stage_error('green_api')
+            return sent
+        elif contact_method == 'telegram' and phone:
+            # Здесь можно добавить отправку через Telegram User API
+            logger.info("📱 Требуется отправка в Telegram на %s: %s", phone, message_template, extra={'category': 'delivery'})
+            # Заглушка - считаем успешным
+            return True
+        return False
+
+    async def asend_reply(self, data: Dict, priority: int = Priority.NORMAL) -> bool:
+        """Асинхронный вариант send_reply()"""
+        tenant = self.tenant_for(data)
+        if tenant and data.get('contact_method') == 'whatsapp' and data.get('phone') and tenant.green_api:
+            with metrics.timer('green_api'):
+                sent = await tenant.green_api.asend_message(data['phone'], self.reply_template(data, tenant), priority)
+            if not sent:
+                metrics.stage_error('green_api')
+            return sent
+        # Остальные способы связи не обращаются к сети
+        return self.send_reply(data, priority)
+
+    def replay_outbox(self):
+        """Ставит в очереди все незавершенные заявки из журнала"""
+        started = time.monotonic()
+        total = 0
+        after_id = 0
+        while not self.replay_stop.is_set():
+            # В кластере каждый процесс дозавершает свои заявки, заявки выбывших забирает лидер
+            rows = self.outbox.pending(limit=1000, after_id=after_id, node=self.node_id if self.leases else None)
+            if not rows:
+                break
+            for row_id, key, data, steps in rows:
+                # Ждем места в очереди: повторная отправка не должна терять заявки.
+                # Свежие заявки и ручные проверки обгоняют повторы
+                self.deliver(key, data, steps, put_timeout=None, priority=Priority.BULK)
+            after_id = rows[-1][0]
+            total += len(rows)
+
+        if total:
+            logger.info(f"♻️ Outbox: {total} незавершенных заявок поставлено на доставку за {time.monotonic() - started:.2f} с")
+
+    def sync_crm_step(self, key: str, data: Dict) -> Optional[str]:
+        """Шаг crm для пакетной синхронизации (с той же защитой от повторов, что и deliver())"""
+        if not self.step_ready(data, 'crm'):
+            return None
+        with self.in_flight_lock:
+            if (key, 'crm') in self.in_flight_steps:
+                return None
+            self.in_flight_steps.add((key, 'crm'))
+        return self.run_delivery_step(key, 'crm', data, Priority.BULK)
+
+    def crm_sync_loop(self):
+        """Фоновый поток пакетной синхронизации (CRM_SYNC_MODE=bulk) и периодической сверки с Pyrus"""
+        bulk = self.config.get('crm_sync_mode') == 'bulk'
+        next_reconcile = time.monotonic() + self.config.get('crm_reconcile_interval', 900)
+        while not self.replay_stop.is_set():
+            # Интервалы читаются на каждом проходе: они меняются перезагрузкой .env
+            sync_interval = self.config.get('crm_sync_interval', 5)
+            reconcile_interval = self.config.get('crm_reconcile_interval', 900)
+            # В кластере синхронизацию и сверку ведет только лидер
+            leader = not self.leases or 'leader' in self.owned_leases
+            try:
+                if bulk and leader:
+                    self.crm_sync.sync(self.replay_stop)
+                if reconcile_interval and time.monotonic() >= next_reconcile:
+                    next_reconcile = time.monotonic() + reconcile_interval
+                    if leader:
+                        self.crm_sync.reconcile()
+            except Exception as e:
+                logger.error(f"❌ Ошибка синхронизации с Pyrus: {e}")
+                self.stats.inc('errors')
+            self.replay_stop.wait(sync_interval if bulk else max(1.0, next_reconcile - time.monotonic()))
 
-                    if status == "OK":
-                        email_body = msg_data[0][1]
-                        email_message = email.message_from_bytes(email_body)
+    def replay_loop(self):
+        """Фоновый поток повторной доставки из журнала"""
+        while not self.replay_stop.is_set():
+            try:
+                self.replay_outbox()
+            except Exception as e:
+                logger.error(f"❌ Ошибка повторной доставки из outbox: {e}")
+                self.stats.inc('errors')
+            # Отложенные выключателем шаги повторяются, как только он пропустит пробный вызов
+            timeout = self.config.get('outbox_replay_interval', 30)
+            for breaker in list(self.circuit_breakers.values()):
+                if breaker.state == 'open':
+                    timeout = min(timeout, breaker.retry_in() + 0.05)
+            self.replay_wakeup.wait(timeout)
+            self.replay_wakeup.clear()
+
+    def start_probes(self):
+        """Заводит фоновые проверки Pyrus, Green API и почтовых ящиков всех арендаторов"""
+        self.register_probes()
+        if self.probes and not self.probe_thread:
+            self.probe_thread = threading.Thread(target=self.probe_loop, name="dependency-probes", daemon=True)
+            self.probe_thread.start()
+
+    def register_probes(self):
+        """
+        Сводит набор проверок с текущими клиентами: проверки прежних клиентов
+        (после перезагрузки .env) удаляются, у новых клиентов появляются свои.
+        Набор подменяется целиком, поток проверок видит либо старый, либо новый.
+        """
+        options = {
+            'interval': self.config.get('health_check_interval', 60.0),
+            'retry_delay': self.config.get('probe_retry_delay', 5.0),
+            'max_delay': self.config.get('probe_max_delay', 60.0)
+        }
+        probes = {}
+        for tenant in self.tenants.values():
+            if tenant.pyrus_api:
+                probes[tenant.pyrus_api] = self.probes.get(tenant.pyrus_api) or DependencyProbe(
+                    f"Pyrus CRM ({tenant.id})",
+                    lambda tenant=tenant, api=tenant.pyrus_api: api.check_access(tenant.pyrus_form_id),
+                    kind='pyrus', target=tenant.id, **options
+                )
+            if tenant.green_api:
+                probes[tenant.green_api] = self.probes.get(tenant.green_api) or DependencyProbe(
+                    f"Green API WhatsApp ({tenant.id})", tenant.green_api.get_state_instance,
+                    kind='green_api', target=tenant.id, **options
+                )
+            # В кластере ящики проверяет процесс, который их слушает
+            if self.leases and f"intake:{tenant.id}" not in self.owned_leases:
+                continue
+            for mailbox in tenant.mailboxes:
+                key = ('imap', tenant.id, mailbox['username'])
+                probe = self.probes.get(key)
+                # Сервер или пароль ящика изменились - прежний результат проверки не годится
+                if probe is None or probe.check.args != (tenant, mailbox):
+                    probe = DependencyProbe(
+                        f"Email IMAP {mailbox['username']} ({tenant.id})",
+                        functools.partial(self.check_imap, tenant, mailbox),
+                        kind='imap', target=f"{tenant.id}/{mailbox['username']}", **options
+                    )
+                probes[key] = probe
+        for probe in probes.values():
+            probe.interval = options['interval']
+            probe.retry_delay = options['retry_delay']
+            probe.max_delay = options['max_delay']
+        self.probes = probes
+
+    def probe_loop(self):
+        """Выполняет проверки в пуле по расписанию каждой из них"""
+        running = set()
+        lock = threading.Lock()
+
+        def finished(probe: DependencyProbe, was_healthy: bool, future: Future):
+            with lock:
+                running.discard(probe)
+            if not was_healthy and not future.exception() and future.result():
+                # Отложенные шаги доставки можно выполнять, не дожидаясь интервала повтора
+                self.replay_wakeup.set()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.config.get('probe_workers', 8)),
+                                thread_name_prefix='probe') as pool:
+            while not self.replay_stop.is_set():
+                for probe in list(self.probes.values()):
+                    with lock:
+                        if probe in running or not probe.due():
+                            continue
+                        running.add(probe)
+                    was_healthy = probe.state == 'healthy'
+                    pool.submit(probe.run).add_done_callback(functools.partial(finished, probe, was_healthy))
+                self.replay_stop.wait(0.2)
+
+    def check_imap(self, tenant: Tenant, mailbox: Dict) -> Optional[bool]:
+        """
+        Проверка почтового ящика. Если ящик слушает IDLE-сессия, ее состояние и
+        есть результат: лишний вход занял бы соединение из лимита арендатора.
+        Иначе - короткий вход и выход, только если есть свободное соединение.
+        """
+        for listener in self.email_listeners:
+            if listener.server == mailbox['imap_server'] and listener.username == mailbox['username']:
+                if listener.imap:
+                    return True
+                if listener.last_error:
+                    raise RuntimeError(listener.last_error)
+                # Сессия еще подключается
+                return None
 
-                        # Проверяем, является ли письмо заявкой
-                        subject = email_message.get("Subject", "")
-                        body = self.get_email_body(email_message)
+        if not tenant.connections.acquire(blocking=False):
+            return None
+        try:
+            imap_class = imaplib.IMAP4_SSL if mailbox.get('use_ssl', True) else imaplib.IMAP4
+            imap = imap_class(mailbox['imap_server'], mailbox.get('port', 993),
+                              timeout=self.config.get('probe_timeout', 10.0))
+            try:
+                imap.login(mailbox['username'], mailbox['password'])
+            finally:
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+            return True
+        finally:
+            tenant.connections.release()
+
+    def health_snapshot(self) -> Dict:
+        """Кэшированные результаты фоновых проверок для /health и /ready"""
+        dependencies = [probe.snapshot() for probe in self.probes.values()]
+        breakers = [breaker.snapshot() for breaker in self.circuit_breakers.values()]
+        healthy = all(item['state'] == 'healthy' for item in dependencies)
+        # Разомкнутый выключатель: сервис отвечает на проверки, но не принимает заявки
+        healthy = healthy and all(item['state'] == 'closed' for item in breakers)
+        snapshot = {
+            'status': 'ok' if healthy else 'degraded',
+            'uptime_seconds': round((datetime.now() - self.start_time).total_seconds()),
+            'dependencies': dependencies,
+            'circuit_breakers': breakers
+        }
+        if self.leases:
+            snapshot['cluster'] = {
+                'node': self.node_id,
+                'nodes': len(self.cluster_nodes),
+                'leases': sorted(self.owned_leases)
+            }
+        return snapshot
+
+    def health_route(self, ready_only: bool):
+        """Ответ HTTP /health (всегда 200) или /ready (503, пока не все зависимости доступны)"""
+        snapshot = self.health_snapshot()
+        status = 503 if ready_only and snapshot['status'] != 'ok' else 200
+        return status, 'application/json; charset=utf-8', json.dumps(snapshot, ensure_ascii=False) + "\n"
+
+    def format_health(self) -> str:
+        """Состояние зависимостей для /health в Telegram"""
+        lines = []
+        for probe in self.probes.values():
+            item = probe.snapshot()
+            if item['state'] == 'healthy':
+                icon, state = "✅", "доступен"
+            elif item['state'] == 'unhealthy':
+                icon, state = "⚠️", f"недоступен ({item['error']}), неудач подряд: {item['consecutive_failures']}"
+            else:
+                icon, state = "⏳", "проверяется"
+            details = []
+            if item['latency_ms'] is not None:
+                details.append(f"{item['latency_ms']:.0f} мс")
+            if item['checked_seconds_ago'] is not None:
+                details.append(f"{item['checked_seconds_ago']:.0f} с назад")
+            suffix = f" [{', '.join(details)}]" if details else ""
+            lines.append(f"{icon} {item['name']} - {state}{suffix}")
+        for breaker in self.circuit_breakers.values():
+            item = breaker.snapshot()
+            if item['state'] == 'open':
+                lines.append(f"🔌 {item['name']} - разомкнут, неудач подряд: {item['consecutive_failures']}, "
+                             f"пробный вызов через {item['retry_in_seconds']:.0f} с")
+            elif item['state'] == 'half_open':
+                lines.append(f"🔌 {item['name']} - пробный вызов")
+        return "\n".join(lines)
 
-                        full_text = f"{subject} {body}"
+    def check_email(self):
+        """Разовая проверка всех почтовых ящиков всех арендаторов"""
+        for tenant in self.tenants.values():
+            for mailbox in tenant.mailboxes:
+                self.check_mailbox(tenant, mailbox)
 
-                        if self.is_application_message(full_text):
-                            logger.info(f"📧 Получена заявка по email: {subject}")
-                            application_data = self.parse_application(full_text)
-                            if application_data:
-                                self.process_application(application_data)
+    def check_mailbox(self, tenant: Tenant, mailbox: Dict):
+        """Разовая проверка почтового ящика через новое соединение"""
+        try:
+            with tenant.connections:
+                imap_class = imaplib.IMAP4_SSL if mailbox.get('use_ssl', True) else imaplib.IMAP4
+                with metrics.timer('imap_connect'):
+                    imap = imap_class(mailbox['imap_server'], mailbox.get('port', 993))
+                    imap.login(mailbox['username'], mailbox['password'])
+                    imap.select(mailbox.get('mailbox', 'INBOX'))
 
-                        # Помечаем письмо как прочитанное
-                        imap.store(msg_id, '+FLAGS', '\\Seen')
+                self.process_inbox(imap, tenant)
 
-            imap.close()
-            imap.logout()
+                imap.close()
+                imap.logout()
 
         except Exception as e:
-            logger.error(f"❌ Ошибка при проверке email: {e}")
-            self.stats['errors'] += 1
+            logger.error(f"❌ Ошибка при проверке email {mailbox.get('username')}: {e}")
+            self.stats.inc('errors')
+
+    def process_inbox(self, imap, tenant: Optional[Tenant] = None):
+        """
+        Обрабатывает непрочитанные письма в уже открытой IMAP-сессии конвейером:
+        пачки выбираются в этом потоке, разбор и распознавание идут в пуле
+        email_parse_pool, доставка - в очередях CRM и WhatsApp. Пока разбирается
+        и доставляется одна пачка, выбирается следующая. Прочитанными письма
+        помечаются пачками по мере подтверждения заявок; не подтвержденные
+        остаются непрочитанными до следующей проверки.
+        """
+        fetcher = IMAPBatchFetcher(imap, self.extract_email_text, batch_size=self.config.get('email_fetch_batch', 50))
+        tenant_id = tenant.id if tenant else 'default'
+        window = max(fetcher.batch_size, self.config.get('email_pipeline_window', 100))
+
+        # Ищем непрочитанные письма
+        uids = fetcher.search_unseen()
+
+        if uids:
+            logger.info("📧 Найдено %d непрочитанных писем", len(uids), extra={'category': 'imap'})
+
+            pending = {}
+            for batch in fetcher.batches(uids):
+                # Не выбираем больше window писем вперед: очереди доставки не переполняются
+                if len(pending) + len(batch) > window:
+                    self.acknowledge(fetcher, pending, self.config.get('email_ack_timeout', 60.0),
+                                     until=window - len(batch))
+                if self.intake_stop.is_set():
+                    break
+                with metrics.timer('imap_fetch'):
+                    messages = fetcher.fetch_messages(batch)
+                for uid, subject, payload, part in messages:
+                    pending[uid] = self.email_parse_pool.submit(
+                        self.process_message, fetcher, subject, payload, part, tenant_id
+                    )
+                self.acknowledge(fetcher, pending, 0)
+
+            self.acknowledge(fetcher, pending, self.config.get('email_ack_timeout', 60.0))
+            for confirmation in pending.values():
+                confirmation.cancel()
+            if pending:
+                logger.warning(f"⏳ {len(pending)} писем без подтверждения доставки остаются непрочитанными")
+
+        self.log_periodic_stats()
+
+    def process_message(self, fetcher: IMAPBatchFetcher, subject: str, payload: bytes,
+                        part: Optional[Tuple], tenant_id: str) -> Optional[Future]:
+        """Стадия разбора: текст письма и распознавание заявки; возвращает Future подтверждения"""
+        body = fetcher.message_text(payload, part)
+        return self.handle_email(subject, body, tenant_id)
+
+    def acknowledge(self, fetcher: IMAPBatchFetcher, pending: Dict[int, Future], timeout: float,
+                    until: int = 0):
+        """
+        Ждет подтверждения писем из pending (не дольше timeout), пока их не
+        останется until, и помечает подтвержденные прочитанными одной командой.
+        Письма с ошибкой разбора, записи или доставки остаются непрочитанными.
+        """
+        deadline = time.monotonic() + timeout
+        seen = []
+        while True:
+            waiting = []
+            for uid, future in list(pending.items()):
+                if future.done() and not future.cancelled() and not future.exception() and isinstance(future.result(), Future):
+                    # Разбор завершен - дальше ждем подтверждения самой заявки
+                    future = pending[uid] = future.result()
+                if not future.done():
+                    waiting.append(future)
+                    continue
+
+                del pending[uid]
+                if future.cancelled() or future.exception():
+                    logger.error(f"❌ Письмо {uid} не обработано, останется непрочитанным: "
+                                 f"{'отменено' if future.cancelled() else future.exception()}")
+                    self.stats.inc('errors')
+                elif future.result() is False:
+                    logger.warning(f"⚠️ Заявка из письма {uid} не подтверждена, письмо останется непрочитанным")
+                else:
+                    seen.append(uid)
+
+            remaining = deadline - time.monotonic()
+            if len(pending) <= until or remaining <= 0 or self.intake_stop.is_set():
+                break
+            # Короткие интервалы: остановка бота не ждет тайм-аута подтверждения
+            wait_futures(waiting, timeout=min(remaining, 1.0), return_when=FIRST_COMPLETED)
+
+        if seen:
+            fetcher.mark_seen(seen)
+
+    def handle_email(self, subject: str, body: str, tenant_id: str = 'default') -> Optional[Future]:
+        """Проверяет письмо; для заявки возвращает Future[bool] подтверждения (см. confirm_application)"""
+        full_text = f"{subject} {body}"
+
+        is_application, application_data = self.recognize_application(full_text, tenant_id)
+        if is_application:
+            logger.info("📧 Получена заявка по email: %s", subject, extra={'category': 'application'})
+            if application_data:
+                return self.confirm_application(application_data)
+        return None
+
+    def log_periodic_stats(self):
+        """Выводит статистику в лог каждые 10 проверок почты"""
+        self.check_count = getattr(self, 'check_count', 0) + 1
+        if self.check_count % 10 == 0:
+            logger.info(f"📊 Статистика: обработано {self.stats['processed_applications']} заявок, время работы: {self.get_uptime()}")
+
+    def on_imap_session_mail(self, imap, tenant: Optional[Tenant] = None):
+        """Колбэк долгоживущей IMAP-сессии: ошибки отдельных писем не рвут соединение"""
+        try:
+            self.process_inbox(imap, tenant)
+        except (imaplib.IMAP4.abort, OSError):
+            # Обрыв соединения обрабатывает сам IMAPIdleListener
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка при обработке писем: {e}")
+            self.stats.inc('errors')
 
     def get_email_body(self, email_message) -> str:
-        """Извлекает текст из письма"""
+        """Извлекает текст из уже разобранного письма"""
         try:
             body = ""
+            html = None
 
             if email_message.is_multipart():
                 for part in email_message.walk():
                     content_type = part.get_content_type()
                     content_disposition = str(part.get("Content-Disposition"))
+                    if "attachment" in content_disposition:
+                        continue
 
-                    if content_type == "text/plain" and "attachment" not in content_disposition:
-                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+                    if content_type == "text/plain":
+                        body = MIMETextExtractor.part_text(part)
                         break
+                    if content_type == "text/html" and html is None:
+                        html = part
+                if not body and html is not None:
+                    body = HTMLTextExtractor.convert(MIMETextExtractor.part_text(html))
             else:
-                body = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
+                body = MIMETextExtractor.part_text(email_message)
+                if email_message.get_content_type() == "text/html":
+                    body = HTMLTextExtractor.convert(body)
 
             return body
 
@@ -659,69 +5533,510 @@ class AutoResponderBot:
             logger.error(f"❌ Ошибка при извлечении текста письма: {e}")
             return ""
 
+    def extract_email_text(self, raw: bytes) -> str:
+        """Извлекает текст из письма в байтах RFC822, не разбирая вложения"""
+        try:
+            return MIMETextExtractor().extract(raw)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при извлечении текста письма: {e}")
+            return ""
+
     def run(self):
         """Запускает бота"""
+        if self.config.get('runtime') == 'asyncio':
+            try:
+                asyncio.run(self.run_async())
+            except KeyboardInterrupt:
+                logger.info("⏹️ Бот остановлен пользователем")
+            return
+
         logger.info("🚀 Запуск бота автоответчика...")
         self.start_time = datetime.now()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.config_reload_requested.set())
 
         try:
-            # Проверяем конфигурацию
-            config_warnings = []
-
-            if not self.config.get('telegram_bot_token'):
-                config_warnings.append("⚠️ Telegram Bot Token не настроен")
-
-            if not all(self.email_config.values()):
-                config_warnings.append("⚠️ Email настройки не полные")
-
-            if not self.green_api:
-                config_warnings.append("⚠️ Green API не настроен")
-
-            if not self.pyrus_api:
-                config_warnings.append("⚠️ Pyrus CRM не настроен")
-
-            if config_warnings:
-                logger.warning("Предупреждения конфигурации:")
-                for warning in config_warnings:
-                    logger.warning(warning)
-
-            # Запускаем Telegram бота в отдельном потоке
-            if hasattr(self, 'telegram_bot') and self.telegram_bot:
-                telegram_thread = threading.Thread(
-                    target=self.telegram_bot.polling, 
-                    kwargs={'none_stop': True, 'timeout': 60}
-                )
-                telegram_thread.daemon = True
-                telegram_thread.start()
-                logger.info("✅ Telegram Bot запущен")
-
-            # Главный цикл для проверки email
-            check_interval = self.config.get('check_interval', 60)
-            logger.info(f"🔄 Начинаем проверку email каждые {check_interval} секунд")
-
-            while True:
-                try:
-                    self.check_email()
-
-                    # Выводим статистику каждые 10 проверок
-                    if hasattr(self, 'check_count'):
-                        self.check_count += 1
-                    else:
-                        self.check_count = 1
+            self.start_services()
+            self.start_email_intake()
 
-                    if self.check_count % 10 == 0:
-                        logger.info(f"📊 Статистика: обработано {self.stats['processed_applications']} заявок, время работы: {self.get_uptime()}")
-
-                except Exception as e:
-                    logger.error(f"❌ Ошибка в цикле проверки email: {e}")
-                    self.stats['errors'] += 1
-
-                time.sleep(check_interval)
+            # Почтовые ящики обслуживаются своими потоками, главный поток ждет остановки
+            while not self.intake_stop.wait(60):
+                pass
 
         except KeyboardInterrupt:
             logger.info("⏹️ Бот остановлен пользователем")
         except Exception as e:
             logger.error(f"💥 Критическая ошибка в работе бота: {e}")
+        finally:
+            self.shutdown()
+
+    async def run_async(self):
+        """
+        Асинхронный режим: доставка заявок в Pyrus и Green API выполняется
+        корутинами на одном цикле событий. Остановка по SIGINT/SIGTERM
+        прекращает прием заявок и дожидается начатых доставок.
+        """
+        logger.info("🚀 Запуск бота автоответчика (asyncio)...")
+        self.start_time = datetime.now()
+        loop = asyncio.get_running_loop()
+        if not AsyncHTTPClient.available():
+            logger.warning("⚠️ aiohttp не установлен: HTTP-запросы выполняются в пуле потоков")
+            # Пул по умолчанию (до 32 потоков) ограничил бы число одновременных доставок
+            loop.set_default_executor(ThreadPoolExecutor(
+                max_workers=2 * self.config.get('async_concurrency', 100), thread_name_prefix="async-http"
+            ))
+        self.crm_queue.start(loop)
+        self.whatsapp_queue.start(loop)
+        self.async_stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.async_stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                loop.add_signal_handler(signal.SIGHUP, self.config_reload_requested.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        try:
+            self.start_services()
+            # У imaplib нет асинхронного API: каждый ящик обслуживается своим потоком
+            self.start_email_intake()
+            await self.async_stop.wait()
+        except Exception as e:
+            logger.error(f"💥 Критическая ошибка в работе бота: {e}")
+        finally:
+            await self.shutdown_async()
+
+    async def shutdown_async(self):
+        """Прекращает прием заявок, дожидается начатых доставок и закрывает ресурсы"""
+        logger.info("⏹️ Останавливаем прием заявок...")
+        # Остановка ждет потоков приема: цикл событий в это время выполняет доставки
+        await asyncio.to_thread(self.stop_intake)
+
+        timeout = self.config.get('shutdown_timeout', 30.0)
+        await asyncio.gather(self.crm_queue.drain(timeout), self.whatsapp_queue.drain(timeout))
+        await asyncio.to_thread(self.stop_delivery)
+        for http in self.http_clients.values():
+            await http.aclose()
+
+    def start_email_intake(self):
+        """
+        Запускает прием писем со всех ящиков всех арендаторов: по потоку на ящик.
+        Ящики арендатора, укладывающиеся в лимит соединений, ждут писем через
+        IDLE; иначе ящики опрашиваются по очереди короткими сессиями.
+        В кластере прием арендаторов запускает поток кластера по мере захвата аренд.
+        """
+        if self.leases:
+            self.cluster_intake.set()
+            self.cluster_wakeup.set()
+            return
+        for tenant in self.tenants.values():
+            self.start_tenant_intake(tenant)
+
+    def start_tenant_intake(self, tenant: Tenant):
+        """Потоки приема писем одного арендатора; их можно остановить отдельно (stop_tenant_intake)"""
+        stop = threading.Event()
+        listeners = []
+        use_idle = self.config.get('email_idle', True) and tenant.use_idle
+        if self.config.get('email_idle', True) and not use_idle:
+            logger.warning(f"⚠️ Арендатор {tenant.id}: ящиков больше лимита соединений ({tenant.max_connections}), IDLE выключен")
+
+        for mailbox in tenant.mailboxes:
+            if use_idle:
+                listener = self.create_email_listener(tenant, mailbox)
+                listeners.append(listener)
+                target, args = self.run_email_listener, (tenant, listener)
+            else:
+                target, args = self.poll_mailbox, (tenant, mailbox, stop)
+            threading.Thread(target=target, args=args, name=f"imap-{tenant.id}-{mailbox['username']}",
+                             daemon=True).start()
+
+        self.tenant_intake[tenant.id] = (stop, listeners)
+        self.email_listeners = self.email_listeners + listeners
+        if tenant.mailboxes:
+            mode = "IMAP IDLE" if use_idle else f"проверка каждые {self.config.get('check_interval', 60)} с"
+            logger.info(f"🔄 Арендатор {tenant.id}: {len(tenant.mailboxes)} ящ., {mode}")
+
+    def stop_tenant_intake(self, tenant_id: str):
+        """
+        Останавливает прием писем арендатора. Письмо, которое сейчас
+        обрабатывается, дорабатывается; необработанные остаются непрочитанными
+        и достаются следующей сессии.
+        """
+        stop, listeners = self.tenant_intake.pop(tenant_id, (None, []))
+        if stop:
+            stop.set()
+        for listener in listeners:
+            listener.stop()
+        self.email_listeners = [listener for listener in self.email_listeners if listener not in listeners]
+
+    def stop_email_intake(self):
+        """Останавливает опрос и IDLE-сессии всех ящиков"""
+        self.intake_stop.set()
+        for tenant_id in list(self.tenant_intake):
+            self.stop_tenant_intake(tenant_id)
+
+    def run_email_listener(self, tenant: Tenant, listener: IMAPIdleListener):
+        """Поток IDLE-сессии: соединение занимает место в лимите арендатора"""
+        with tenant.connections:
+            listener.run()
+
+    def poll_mailbox(self, tenant: Tenant, mailbox: Dict, stop: threading.Event):
+        """Поток периодической проверки одного ящика"""
+        while not stop.is_set():
+            self.check_mailbox(tenant, mailbox)
+            # Интервал читается каждый раз: CHECK_INTERVAL меняется перезагрузкой .env
+            stop.wait(self.config.get('check_interval', 60))
+
+    def create_email_listener(self, tenant: Tenant, mailbox: Dict) -> IMAPIdleListener:
+        """Долгоживущая IMAP-сессия для ящика арендатора"""
+        return IMAPIdleListener(
+            mailbox['imap_server'],
+            mailbox['username'],
+            mailbox['password'],
+            on_new_mail=lambda imap: self.on_imap_session_mail(imap, tenant),
+            port=mailbox.get('port', 993),
+            use_ssl=mailbox.get('use_ssl', True),
+            mailbox=mailbox.get('mailbox', 'INBOX'),
+            idle_timeout=self.config.get('email_idle_timeout', 300),
+            poll_interval=self.config.get('check_interval', 60)
+        )
+
+    def start_services(self):
+        """Проверяет конфигурацию и запускает метрики, повторную доставку и Telegram"""
+        # Проверяем конфигурацию
+        config_warnings = []
+
+        if not self.config.get('telegram_bot_token'):
+            config_warnings.append("⚠️ Telegram Bot Token не настроен")
+
+        if not any(tenant.mailboxes for tenant in self.tenants.values()):
+            config_warnings.append("⚠️ Email настройки не полные")
+
+        if not self.green_api:
+            config_warnings.append("⚠️ Green API не настроен")
+
+        if not self.pyrus_api:
+            config_warnings.append("⚠️ Pyrus CRM не настроен")
+
+        if config_warnings:
+            logger.warning("Предупреждения конфигурации:")
+            for warning in config_warnings:
+                logger.warning(warning)
+
+        # HTTP-эндпоинт метрик
+        self.metrics_server = None
+        if self.config.get('metrics_port'):
+            try:
+                self.metrics_server = MetricsServer(self.config['metrics_host'], self.config['metrics_port'])
+                self.metrics_server.routes['/health'] = functools.partial(self.health_route, False)
+                self.metrics_server.routes['/ready'] = functools.partial(self.health_route, True)
+                self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"❌ Не удалось запустить HTTP-сервер метрик: {e}")
+                self.metrics_server = None
+
+        # Pyrus, Green API и ящики проверяются в фоне: прием заявок их не ждет
+        self.start_probes()
+
+        # Изменения .env применяются без перезапуска (и по SIGHUP)
+        threading.Thread(target=self.config_reload_loop, name="config-reload", daemon=True).start()
+
+        # Изменения в каталоге шаблонов применяются без перезапуска
+        if self.config.get('template_reload_interval'):
+            threading.Thread(target=self.templates.watch,
+                             args=(self.replay_stop, self.config['template_reload_interval']),
+                             name="templates-reload", daemon=True).start()
+
+        # Дозавершаем заявки, оставшиеся в журнале с прошлого запуска
+        self.replay_thread = threading.Thread(target=self.replay_loop, name="outbox-replay", daemon=True)
+        self.replay_thread.start()
+        if self.config.get('crm_sync_mode') == 'bulk' or self.config.get('crm_reconcile_interval'):
+            self.crm_sync_thread = threading.Thread(target=self.crm_sync_loop, name="crm-sync", daemon=True)
+            self.crm_sync_thread.start()
+
+        # Запускаем прием апдейтов Telegram (webhook или long polling).
+        # В кластере апдейты получает только владелец аренды telegram
+        if self.leases:
+            self.cluster_thread = threading.Thread(target=self.cluster_loop, name="cluster", daemon=True)
+            self.cluster_thread.start()
+        elif self.telegram_bot:
+            self.start_telegram()
+
+    def cluster_loop(self):
+        """
+        Фоновый поток кластера: отметка процесса, продление и перераспределение
+        аренд. Работает до конца shutdown(), чтобы доставки, которые еще
+        дорабатывают, не забрал лидер. Если аренды не удается продлить дольше
+        их срока, ресурсы останавливаются: их уже могли взять другие процессы.
+        """
+        renewed_at = time.monotonic()
+        while not self.cluster_stop.is_set():
+            try:
+                with self.cluster_lock:
+                    self.cluster_step()
+                renewed_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"❌ Ошибка кластера: {e}")
+                self.stats.inc('errors')
+                if self.owned_leases and time.monotonic() - renewed_at > self.leases.ttl:
+                    logger.error("❌ Кластер: аренды не продлены в срок, прием останавливается")
+                    with self.cluster_lock:
+                        for name in list(self.owned_leases):
+                            self.drop_resource(name, release=False)
+            self.cluster_wakeup.wait(self.config.get('cluster_renew_interval', 2))
+            self.cluster_wakeup.clear()
+
+    def cluster_step(self):
+        """
+        Один проход кластера. Ящики делятся по арендаторам (ящики арендатора
+        делят лимит соединений): каждый процесс держит не больше своей доли,
+        лишние отдает, а свободные берет в порядке rendezvous-хэша, так что
+        распределение устойчиво к появлению и уходу процессов. Прием Telegram
+        (у токена бота может быть только один получатель getUpdates) и роль
+        лидера - по одной аренде на кластер. Лидер забирает незавершенные
+        заявки выбывших процессов.
+        """
+        live = self.leases.heartbeat()
+        self.cluster_nodes = live
+        owned = self.leases.renew()
+        for name in self.owned_leases - owned:
+            logger.warning(f"⚠️ Кластер: аренда {name} потеряна")
+            self.drop_resource(name, release=False)
+        if self.intake_stop.is_set():
+            return
+
+        def rank(name: str) -> str:
+            return hashlib.sha1(f"{name}|{self.node_id}".encode()).hexdigest()
+
+        wanted = []
+        if self.cluster_intake.is_set():
+            wanted = sorted((f"intake:{tenant.id}" for tenant in self.tenants.values() if tenant.mailboxes), key=rank)
+        share = -(-len(wanted) // len(live))
+        mine = [name for name in wanted if name in self.owned_leases]
+        for name in mine[share:]:
+            self.drop_resource(name)
+        owners = self.leases.owners()
+        taken = len(mine[:share])
+        for name in wanted:
+            if taken >= share:
+                break
+            if name not in self.owned_leases and name not in owners and self.leases.acquire(name):
+                self.take_resource(name)
+                taken += 1
+
+        singletons = ['leader'] + (['telegram'] if self.telegram_bot else [])
+        for name in singletons:
+            if name not in self.owned_leases and name not in owners and self.leases.acquire(name):
+                self.take_resource(name)
+
+        if 'leader' in self.owned_leases and self.cluster_adopted != live:
+            self.cluster_adopted = live
+            self.outbox.adopt(live).add_done_callback(self.on_outbox_adopted)
+
+    def on_outbox_adopted(self, future: Future):
+        if future.exception():
+            logger.error(f"❌ Кластер: не удалось забрать заявки выбывших процессов: {future.exception()}")
+            self.cluster_adopted = None
+        elif future.result():
+            logger.info(f"♻️ Кластер: {future.result()} незавершенных заявок выбывших процессов забрано лидером")
+            self.replay_wakeup.set()
+
+    def take_resource(self, name: str):
+        """Запускает ресурс, аренду которого взял процесс"""
+        self.owned_leases.add(name)
+        if name.startswith('intake:'):
+            tenant = self.tenants.get(name.split(':', 1)[1])
+            if tenant:
+                self.start_tenant_intake(tenant)
+        elif name == 'telegram':
+            self.start_telegram()
+        elif name == 'leader':
+            # Новый лидер заново проверяет заявки выбывших процессов
+            self.cluster_adopted = None
+        logger.info(f"🔑 Кластер: {self.node_id} получил {name}")
+        if self.probe_thread:
+            self.register_probes()
+
+    def drop_resource(self, name: str, release: bool = True):
+        """Останавливает ресурс и (release) освобождает его аренду для других процессов"""
+        self.owned_leases.discard(name)
+        if name.startswith('intake:'):
+            self.stop_tenant_intake(name.split(':', 1)[1])
+        elif name == 'telegram':
+            self.stop_telegram()
+        if release:
+            self.leases.release(name)
+        logger.info(f"🔓 Кластер: {self.node_id} отдал {name}")
+        if self.probe_thread:
+            self.register_probes()
+
+    def start_telegram(self):
+        """Запускает диспетчер апдейтов и webhook-сервер либо long polling"""
+        self.telegram_stop = threading.Event()
+        self.telegram_dispatcher = ChatUpdateDispatcher(
+            self.telegram_bot.process_new_updates,
+            workers=self.config.get('telegram_workers', 4)
+        )
+        self.telegram_dispatcher.start()
+        self.webhook_server = None
+
+        # Поток получает свои бот, диспетчер и флаг остановки: после перезагрузки
+        # конфигурации прежний поток не должен подхватить новый экземпляр
+        session = (self.telegram_bot, self.telegram_dispatcher, self.telegram_stop)
+        if self.config.get('telegram_mode') == 'webhook':
+            # Регистрация webhook обращается к Telegram: не задерживаем запуск приема писем
+            self.telegram_thread = threading.Thread(target=self.enable_telegram_webhook, args=session,
+                                                    name="telegram-webhook", daemon=True)
+        else:
+            self.telegram_thread = threading.Thread(target=self.poll_telegram, args=session,
+                                                    name="telegram-polling", daemon=True)
+            logger.info("✅ Telegram Bot запущен (polling)")
+        self.telegram_thread.start()
+
+    def enable_telegram_webhook(self, telegram_bot, dispatcher: 'ChatUpdateDispatcher', stop: threading.Event):
+        """Поток регистрации webhook; при ошибке переходит на long polling"""
+        try:
+            self.start_telegram_webhook(telegram_bot, dispatcher)
+            return
+        except Exception as e:
+            logger.error(f"❌ Не удалось включить webhook, переходим на polling: {e}")
+            if self.webhook_server:
+                self.webhook_server.stop()
+            self.webhook_server = None
+
+        logger.info("✅ Telegram Bot запущен (polling)")
+        self.poll_telegram(telegram_bot, dispatcher, stop)
+
+    def start_telegram_webhook(self, telegram_bot, dispatcher: 'ChatUpdateDispatcher'):
+        """Поднимает локальный HTTP-сервер и регистрирует webhook в Telegram"""
+        public_url = self.config.get('telegram_webhook_url')
+        if not public_url:
+            raise ValueError("TELEGRAM_WEBHOOK_URL не задан")
+
+        secret = self.config.get('telegram_webhook_secret') or hashlib.sha256(
+            self.config['telegram_bot_token'].encode()
+        ).hexdigest()[:32]
+        path = f"/telegram/{hashlib.sha256(secret.encode()).hexdigest()[:16]}"
+
+        self.webhook_server = TelegramWebhookServer(
+            self.config.get('telegram_webhook_host', '0.0.0.0'),
+            self.config.get('telegram_webhook_port', 8443),
+            path, secret, dispatcher
+        )
+        self.webhook_server.start()
+        telegram_bot.remove_webhook()
+        telegram_bot.set_webhook(url=public_url.rstrip('/') + path, secret_token=secret)
+        logger.info("✅ Telegram Bot запущен (webhook)")
+
+    def poll_telegram(self, telegram_bot, dispatcher: 'ChatUpdateDispatcher', stop: threading.Event):
+        """Long polling: забирает апдейты и передает их диспетчеру"""
+        try:
+            telegram_bot.remove_webhook()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось снять webhook перед polling: {e}")
+
+        offset = None
+        backoff = 1
+        while not stop.is_set():
+            try:
+                updates = telegram_bot.get_updates(offset=offset, timeout=60, long_polling_timeout=60)
+                backoff = 1
+            except Exception as e:
+                logger.error(f"❌ Ошибка получения апдейтов Telegram: {e}")
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            for update in updates:
+                # Если очередь чата заполнена, ждем: апдейт нельзя подтверждать, не поставив в очередь
+                while not dispatcher.dispatch(update):
+                    if stop.is_set():
+                        return
+                offset = update.update_id + 1
+
+        # Подтверждаем полученные апдейты, чтобы новый экземпляр бота не получил их повторно
+        if offset is not None:
+            try:
+                telegram_bot.get_updates(offset=offset, timeout=10, long_polling_timeout=1)
+            except Exception:
+                pass
+
+    def stop_telegram(self):
+        """
+        Останавливает прием апдейтов. Поток приема дорабатывает текущий
+        запрос, его апдейты обрабатывает прежний диспетчер, и только потом
+        диспетчер останавливается.
+        """
+        old_stop = getattr(self, 'telegram_stop', None)
+        old_dispatcher = getattr(self, 'telegram_dispatcher', None)
+        old_thread = getattr(self, 'telegram_thread', None)
+        if not old_stop:
+            return
+        old_stop.set()
+        self.telegram_stop = None
+        if self.webhook_server:
+            # Telegram повторит webhook-запросы, на которые не получил ответа
+            self.webhook_server.stop()
+            self.webhook_server = None
+
+        def retire():
+            if old_thread:
+                old_thread.join(90)
+            old_dispatcher.stop()
+        threading.Thread(target=retire, name="telegram-retire", daemon=True).start()
+
+    def restart_telegram(self):
+        """Пересоздает бота Telegram после смены токена или режима"""
+        self.stop_telegram()
+        self.telegram_bot = self.create_telegram_bot(self.config)
+        if self.telegram_bot and (not self.leases or 'telegram' in self.owned_leases):
+            self.start_telegram()
+
+    def shutdown(self):
+        """Дожидается отправки уже поставленных в очереди задач"""
+        self.stop_intake()
+        self.stop_delivery()
+
+    def stop_intake(self):
+        """Прекращает прием заявок: почта, Telegram, аренды кластера и повтор журнала"""
+        self.stop_email_intake()
+        self.email_parse_pool.shutdown(wait=True)
+        if getattr(self, 'telegram_stop', None):
+            self.telegram_stop.set()
+            if self.webhook_server:
+                self.webhook_server.stop()
+            self.telegram_dispatcher.stop()
+        if self.leases:
+            # Ящики и Telegram сразу переходят к другим процессам
+            with self.cluster_lock:
+                for name in list(self.owned_leases):
+                    self.owned_leases.discard(name)
+                    self.leases.release(name)
+        self.replay_stop.set()
+        self.replay_wakeup.set()
+        self.config_reload_requested.set()
+
+    def stop_delivery(self):
+        """Останавливает очереди отправки и закрывает журнал заявок"""
+        logger.info("⏳ Завершаем задачи в очередях отправки...")
+        self.crm_queue.stop()
+        self.whatsapp_queue.stop()
+        self.crm_sync.close()
+        self.fallback_pool.shutdown(wait=True)
+        if self.leases:
+            # Доставки завершены: незавершенные заявки теперь может забрать лидер
+            self.cluster_stop.set()
+            self.cluster_wakeup.set()
+            if self.cluster_thread:
+                self.cluster_thread.join(10)
+            self.leases.leave()
+        self.outbox.close()
+        self.dedup.close()
+        if getattr(self, 'metrics_server', None):
+            self.metrics_server.stop()
 
 def main():
     """Основная функция запуска бота"""
@@ -729,6 +6044,7 @@ def main():
     # Создаем необходимые директории
     Path("logs").mkdir(exist_ok=True)
     Path("data").mkdir(exist_ok=True)
+    LogPipeline.setup("logs")
 
     # Проверяем наличие .env файла
     if not Path(".env").exists():
@@ -0,0 +1,164 @@
+"""
+Сравнение сред выполнения доставки (RUNTIME) на локальных заглушках Pyrus
+и Green API с задержкой ответа --api-delay. Каждый вариант запускается
+отдельным процессом бота; заявки принимаются через accept_application(),
+замеряется время до доставки всех заявок и наибольшее число потоков:
+  - threads с --workers потоками на интеграцию и с --concurrency потоками;
+  - asyncio с aiohttp и без него (запросы в пуле потоков);
+  - остановка asyncio посреди доставки с SHUTDOWN_TIMEOUT=0.2: недоставленные
+    шаги должны остаться в outbox незавершенными, а не ошибочными.
+
+    python benchmarks/asyncio_runtime_benchmark.py --leads 500
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_servers import serve_in_process
+
+
+def lead_text(index: int) -> str:
+    return (f"Новая заявка № {index}\nТелефон: +7900{index:06d}\n"
+            "Способ связи: WhatsApp\nДанные формы:")
+
+
+def run_bot(args):
+    """Дочерний процесс: один вариант среды выполнения; печатает результат JSON-строкой"""
+    if args.no_aiohttp:
+        # Импорт aiohttp завершится ImportError, как без установленного пакета
+        sys.modules['aiohttp'] = None
+    workdir = Path(tempfile.mkdtemp(prefix='runtime-bench-'))
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    for key in list(os.environ):
+        if key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_')):
+            del os.environ[key]
+    os.environ.update({
+        'PYRUS_LOGIN': 'bench', 'PYRUS_SECURITY_KEY': 'key', 'PYRUS_FORM_ID': '1', 'PYRUS_API_URL': api_url,
+        'GREEN_API_INSTANCE_ID': '1000', 'GREEN_API_TOKEN': 'token', 'GREEN_API_URL': api_url,
+        'OUTBOX_PATH': str(workdir / 'outbox.db'),
+        'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'METRICS_PORT': '0',
+        'CHECK_INTERVAL': '3600',
+        'RUNTIME': args.runtime,
+        'CRM_WORKERS': str(args.workers), 'WHATSAPP_WORKERS': str(args.workers),
+        'ASYNC_CONCURRENCY': str(args.concurrency),
+        'HTTP_POOL_SIZE': str(args.concurrency),
+        'DISPATCH_QUEUE_SIZE': str(args.leads * 2),
+        'SHUTDOWN_TIMEOUT': str(args.shutdown_timeout),
+        # Замеряется среда выполнения, а не ограничитель отправок
+        'WHATSAPP_RATE': '0',
+        'WHATSAPP_MAX_CONCURRENCY': str(args.concurrency),
+    })
+
+    import logging
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.CRITICAL)
+
+    bot = autoresponder_bot.AutoResponderBot()
+    result = {}
+    finished = threading.Event()
+
+    def load():
+        if args.runtime == 'asyncio':
+            while getattr(bot, 'async_stop', None) is None:
+                time.sleep(0.01)
+        threads = threading.active_count()
+        started = time.perf_counter()
+        for index in range(args.leads):
+            bot.accept_application(bot.recognize_application(lead_text(index))[1])
+        deadline = started + (args.stop_after or 120)
+        while time.perf_counter() < deadline and bot.outbox.counts()['delivered'] < args.leads:
+            threads = max(threads, threading.active_count())
+            time.sleep(0.02)
+        result.update(elapsed=time.perf_counter() - started, threads=threads)
+        if args.runtime == 'asyncio':
+            bot.async_stop._loop.call_soon_threadsafe(bot.async_stop.set)
+        finished.set()
+
+    loader = threading.Thread(target=load, name="bench-load", daemon=True)
+    if args.runtime == 'asyncio':
+        loader.start()
+        bot.run()
+    else:
+        bot.start_services()
+        loader.start()
+        finished.wait()
+        bot.shutdown()
+
+    # Журнал после остановки - то, что увидит бот при следующем запуске
+    outbox = autoresponder_bot.ApplicationOutbox(os.environ['OUTBOX_PATH'])
+    result['counts'] = outbox.counts()
+    outbox.close()
+    print(json.dumps(result))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def measure(api_port: int, leads: int, runtime: str, *options) -> dict:
+    command = [sys.executable, __file__, '--api-port', str(api_port), '--leads', str(leads), '--runtime', runtime]
+    output = subprocess.run(command + list(options), capture_output=True, text=True, timeout=300).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Доставка заявок: пулы потоков против asyncio")
+    parser.add_argument('--leads', type=int, default=500)
+    parser.add_argument('--api-delay', type=float, default=0.2, help="задержка ответа заглушек Pyrus/Green, с")
+    parser.add_argument('--workers', type=int, default=2, help="CRM_WORKERS и WHATSAPP_WORKERS")
+    parser.add_argument('--concurrency', type=int, default=100, help="ASYNC_CONCURRENCY и HTTP_POOL_SIZE")
+    # Параметры дочернего процесса
+    parser.add_argument('--runtime', choices=('threads', 'asyncio'))
+    parser.add_argument('--api-port', type=int)
+    parser.add_argument('--no-aiohttp', action='store_true')
+    parser.add_argument('--stop-after', type=float, default=0.0)
+    parser.add_argument('--shutdown-timeout', type=float, default=30.0)
+    args = parser.parse_args()
+    if args.runtime:
+        run_bot(args)
+
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, args.api_delay), daemon=True)
+    fakes.start()
+    _, api_port = parent.recv()
+
+    failed = False
+    for title, runtime, options in (
+            (f"threads, {args.workers} потока", 'threads', ('--workers', str(args.workers))),
+            (f"threads, {args.concurrency} потоков", 'threads', ('--workers', str(args.concurrency))),
+            ("asyncio + aiohttp", 'asyncio', ('--concurrency', str(args.concurrency))),
+            ("asyncio без aiohttp", 'asyncio', ('--concurrency', str(args.concurrency), '--no-aiohttp')),
+    ):
+        result = measure(api_port, args.leads, runtime, *options)
+        delivered = result['counts']['delivered']
+        print(f"⏱️ {title}: {delivered}/{args.leads} заявок доставлено за {result['elapsed']:.2f} с, "
+              f"потоков до {result['threads']}")
+        failed |= delivered != args.leads
+
+    # Остановка посреди доставки: начатые шаги дожидаются SHUTDOWN_TIMEOUT, остальные отменяются
+    leads = args.leads * 4
+    result = measure(api_port, leads, 'asyncio', '--concurrency', str(args.concurrency),
+                     '--stop-after', '0.3', '--shutdown-timeout', '0.2')
+    counts = result['counts']
+    print(f"⏹️ Остановка через 0.3 с, SHUTDOWN_TIMEOUT=0.2: из {leads} заявок доставлено {counts['delivered']}, "
+          f"ждут повтора {counts['pending']}, ошибочных {counts['failed']}")
+    failed |= counts['failed'] != 0 or counts['delivered'] + counts['pending'] != leads
+
+    parent.send(None)
+    fakes.join(5)
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Замер разбора очереди непрочитанных писем: в ящик заранее кладется N заявок,
+затем бот выполняет одну проверку почты (check_email) против локальных
+заглушек IMAP, Pyrus и Green API. Печатает время до последнего ответа
+в WhatsApp (и последней задачи в CRM) и до пометки последнего письма
+прочитанным; число задач CRM сверх числа писем означает повторные доставки.
+
+    python benchmarks/backlog_benchmark.py --leads 1000 --workers 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call, lead_email
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время разбора очереди из N писем-заявок")
+    parser.add_argument('--leads', type=int, default=1000)
+    parser.add_argument('--api-delay', type=float, default=0.05, help="задержка ответа заглушек Pyrus/Green, с")
+    parser.add_argument('--parse-workers', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=8, help="CRM_WORKERS и WHATSAPP_WORKERS")
+    parser.add_argument('--ack', default='delivered', choices=('delivered', 'stored'))
+    parser.add_argument('--fail', type=int, default=0, help="сколько заявок получат ошибку WhatsApp")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, args.api_delay), daemon=True)
+    fakes.start()
+    imap_port, api_port = parent.recv()
+
+    phones = [f"79{index:09d}" for index in range(args.leads)]
+    for index, phone in enumerate(phones):
+        api_call(api_port, '/_append', {
+            'username': 'sales@example.com',
+            'raw': lead_email(0, index, phone),
+            'phone': phone
+        })
+    api_call(api_port, '/_fail', {'phones': phones[:args.fail]})
+
+    workdir = Path(tempfile.mkdtemp(prefix='backlog-bench-'))
+    for key in list(os.environ):
+        if key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_')):
+            del os.environ[key]
+    os.environ.update({
+        'EMAIL_IMAP_SERVER': '127.0.0.1', 'EMAIL_IMAP_PORT': str(imap_port), 'EMAIL_IMAP_SSL': 'false',
+        'EMAIL_USERNAME': 'sales@example.com', 'EMAIL_PASSWORD': 'secret',
+        'EMAIL_ACK': args.ack, 'EMAIL_PARSE_WORKERS': str(args.parse_workers),
+        'PYRUS_LOGIN': 'bench', 'PYRUS_SECURITY_KEY': 'key', 'PYRUS_FORM_ID': '1',
+        'PYRUS_API_URL': f"http://127.0.0.1:{api_port}",
+        'GREEN_API_INSTANCE_ID': '1000', 'GREEN_API_TOKEN': 'token',
+        'GREEN_API_URL': f"http://127.0.0.1:{api_port}",
+        'OUTBOX_PATH': str(workdir / 'outbox.db'),
+        'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'METRICS_PORT': '0',
+        'OUTBOX_REPLAY_INTERVAL': '1',
+        'HTTP_POOL_SIZE': '50',
+        'CRM_WORKERS': str(args.workers),
+        'WHATSAPP_WORKERS': str(args.workers),
+        # Замеряется прием, а не ограничитель отправок
+        'WHATSAPP_RATE': '0',
+        'WHATSAPP_MAX_CONCURRENCY': str(args.workers * 4),
+        'DISPATCH_QUEUE_SIZE': '100'
+    })
+
+    import logging
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.ERROR)
+
+    bot = autoresponder_bot.AutoResponderBot()
+    bot.start_services()
+
+    started = time.time()
+    bot.check_email()
+    check_done = time.time() - started
+
+    expected = args.leads - args.fail
+    stats = {}
+    replies_done = seen_done = None
+    while time.time() - started < 600:
+        stats = api_call(api_port, '/_stats')
+        if replies_done is None and len(stats['replies']) >= expected and stats['tasks'] >= args.leads:
+            replies_done = time.time() - started
+        if seen_done is None and stats['seen'] >= expected:
+            seen_done = time.time() - started
+        if replies_done is not None and seen_done is not None:
+            break
+        time.sleep(0.05)
+
+    print(f"📬 {args.leads} писем, ack={args.ack}, разбор {args.parse_workers} потоков, доставка {args.workers}+{args.workers}: "
+          f"check_email {check_done:.2f} с, все ответы и задачи {replies_done or float('nan'):.2f} с, "
+          f"все прочитаны {seen_done or float('nan'):.2f} с "
+          f"(ответов {len(stats['replies'])}, прочитано {stats['seen']}, задач CRM {stats['tasks']})")
+
+    bot.shutdown()
+    parent.send(None)
+    fakes.join(5)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
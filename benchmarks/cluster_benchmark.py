@@ -0,0 +1,206 @@
+"""
+Отказоустойчивость кластера (CLUSTER_PATH) на локальных заглушках.
+
+Запускает --nodes процессов бота (python autoresponder_bot.py) с общими
+журналом заявок, индексом дубликатов и таблицей аренд; --tenants арендаторов
+с отдельным ящиком на каждого и прием Telegram делятся между процессами.
+Заглушки подают корпус (corpus.py) с частотой --rate в секунду, на доле
+--kill-at подачи процесс, принимающий Telegram, получает SIGKILL. Печатает:
+  - распределение аренд до и после отказа;
+  - время, за которое ящики и Telegram упавшего процесса перешли к живым;
+  - сколько заявок доставлено и сколько клиентов получили ответ дважды;
+  - сколько раз два процесса одновременно запросили getUpdates (409).
+
+    python benchmarks/cluster_benchmark.py --nodes 3 --tenants 6 --emails 400 --chats 80
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import corpus
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call, percentile
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def node_environment(workdir: Path, imap_port: int, api_port: int, tenants_file: Path, node: str, ttl: float,
+                     renew: float) -> dict:
+    """Окружение процесса бота: ящики - у арендаторов из TENANTS_FILE, Telegram - у арендатора default"""
+    api_url = f"http://127.0.0.1:{api_port}"
+    env = {key: value for key, value in os.environ.items()
+           if not key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_', 'CLUSTER_'))}
+    env.update({
+        'GREEN_API_INSTANCE_ID': '1101', 'GREEN_API_TOKEN': 'token', 'GREEN_API_URL': api_url,
+        'PYRUS_LOGIN': 'bot@srubim.ru', 'PYRUS_SECURITY_KEY': 'key', 'PYRUS_FORM_ID': '1', 'PYRUS_API_URL': api_url,
+        'TELEGRAM_BOT_TOKEN': '123456:cluster-test', 'TELEGRAM_API_URL': api_url, 'TELEGRAM_MODE': 'polling',
+        'TENANTS_FILE': str(tenants_file),
+        'OUTBOX_PATH': str(workdir / 'outbox.db'), 'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'CLUSTER_PATH': str(workdir / 'cluster.db'), 'CLUSTER_NODE_ID': node,
+        'CLUSTER_LEASE_TTL': str(ttl), 'CLUSTER_RENEW_INTERVAL': str(renew),
+        'TEMPLATES_DIR': str(ROOT / 'templates'),
+        'METRICS_PORT': '0', 'OUTBOX_REPLAY_INTERVAL': '1', 'CONFIG_RELOAD_INTERVAL': '0',
+        'LOG_FORMAT': 'text', 'WHATSAPP_RATE': '0'
+    })
+    return env
+
+
+def leases(workdir: Path) -> dict:
+    """Текущие аренды: ресурс -> процесс"""
+    connection = sqlite3.connect(workdir / 'cluster.db', timeout=30)
+    try:
+        return dict(connection.execute("SELECT name, node FROM leases WHERE expires_at >= ?", (time.time(),)))
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        connection.close()
+
+
+def distribution(owners: dict) -> dict:
+    """Процесс -> его ресурсы"""
+    result = {}
+    for name, node in sorted(owners.items()):
+        result.setdefault(node, []).append(name.replace('intake:', ''))
+    return result
+
+
+def covered(owners: dict, resources: set, live: set) -> bool:
+    return all(owners.get(name) in live for name in resources)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отказ процесса кластера под нагрузкой")
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--tenants', type=int, default=6)
+    parser.add_argument('--emails', type=int, default=400)
+    parser.add_argument('--chats', type=int, default=80)
+    parser.add_argument('--rate', type=float, default=20.0, help="заявок в секунду")
+    parser.add_argument('--kill-at', type=float, default=0.4, help="доля подачи, после которой процесс убивается")
+    parser.add_argument('--api-delay', type=float, default=0.05, help="задержка ответа заглушек Pyrus/Green, с")
+    parser.add_argument('--lease-ttl', type=float, default=10.0)
+    parser.add_argument('--renew-interval', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, args.api_delay), daemon=True)
+    fakes.start()
+    imap_port, api_port = parent.recv()
+
+    workdir = Path(tempfile.mkdtemp(prefix='cluster-bench-'))
+    usernames = [f"brand{index:02d}@example.com" for index in range(args.tenants)]
+    spec = {'tenants': [
+        {
+            'id': f"brand{index:02d}",
+            'mailboxes': [{'imap_server': '127.0.0.1', 'port': imap_port, 'use_ssl': False,
+                           'username': username, 'password': 'secret'}],
+            'green_api': {'instance_id': str(2000 + index), 'api_token': 'token',
+                          'api_url': f"http://127.0.0.1:{api_port}"},
+            'pyrus': {'login': f"brand{index:02d}", 'security_key': 'key', 'form_id': index + 2,
+                      'api_url': f"http://127.0.0.1:{api_port}"},
+            'max_connections': 1
+        }
+        for index, username in enumerate(usernames)
+    ]}
+    tenants_file = workdir / 'tenants.json'
+    tenants_file.write_text(json.dumps(spec), encoding='utf-8')
+
+    # Письмо попадает в ящик по содержимому: повторная отправка формы - в тот же ящик
+    items = corpus.generate(args.emails, args.chats, seed=args.seed)
+    for item in items:
+        if item['kind'] == 'email':
+            item['username'] = usernames[zlib.crc32(item['raw'].encode('utf-8', 'surrogateescape')) % len(usernames)]
+    expected = [item['phone'] for item in items if item.get('expect_reply')]
+    api_call(api_port, '/_load', {'items': items})
+    del items
+
+    processes = {}
+    for index in range(args.nodes):
+        node = f"node{index}"
+        directory = workdir / node
+        directory.mkdir()
+        (directory / '.env').write_text('', encoding='utf-8')
+        log = open(directory / 'stdout.log', 'w')
+        processes[node] = subprocess.Popen(
+            [sys.executable, str(ROOT / 'autoresponder_bot.py')], cwd=directory, stdout=log, stderr=subprocess.STDOUT,
+            env=node_environment(workdir, imap_port, api_port, tenants_file, node, args.lease_ttl, args.renew_interval)
+        )
+
+    resources = {f"intake:brand{index:02d}" for index in range(args.tenants)} | {'telegram', 'leader'}
+    live = set(processes)
+    deadline = time.time() + 60
+    while not covered(leases(workdir), resources, live) and time.time() < deadline:
+        time.sleep(0.1)
+    # Доли выравниваются, когда все процессы отметились в таблице
+    time.sleep(args.renew_interval * 2)
+    before = leases(workdir)
+    print(f"🖥️ {args.nodes} процесса, {args.tenants} арендаторов; аренды до отказа:")
+    for node, names in distribution(before).items():
+        print(f"   {node}: {', '.join(names)}")
+
+    started = time.time()
+    api_call(api_port, '/_schedule', {'rate': args.rate})
+    time.sleep(len(expected) / args.rate * args.kill_at)
+
+    victim = before.get('telegram', 'node0')
+    processes[victim].send_signal(signal.SIGKILL)
+    killed_at = time.time()
+    # Как systemd или Docker: завершившийся процесс не остается зомби с прежним PID
+    processes[victim].wait()
+    live.discard(victim)
+    while not covered(leases(workdir), resources, live) and time.time() - killed_at < 60:
+        time.sleep(0.02)
+    failover = time.time() - killed_at
+    after = leases(workdir)
+    print(f"💥 SIGKILL {victim} через {killed_at - started:.1f} с подачи; ресурсы перешли за {failover:.2f} с:")
+    for node, names in distribution(after).items():
+        print(f"   {node}: {', '.join(names)}")
+
+    stats = {}
+    while time.time() - started < 180:
+        stats = api_call(api_port, '/_stats')
+        if all(phone in stats['replies'] for phone in expected):
+            break
+        time.sleep(0.2)
+    elapsed = time.time() - started
+
+    for node, process in processes.items():
+        if node in live:
+            process.send_signal(signal.SIGTERM)
+    for process in processes.values():
+        process.wait(60)
+    parent.send(None)
+    fakes.join(5)
+
+    delivered = [phone for phone in expected if phone in stats['replies']]
+    doubled = {phone: count for phone, count in stats['reply_counts'].items() if count > 1}
+    latencies = [stats['replies'][phone] - stats['appended'][phone] for phone in delivered if phone in stats['appended']]
+    after_kill = [stats['replies'][phone] - stats['appended'][phone] for phone in delivered
+                  if phone in stats['appended'] and killed_at <= stats['appended'][phone] <= killed_at + failover]
+    print(f"📨 Доставлено {len(delivered)}/{len(expected)} за {elapsed:.1f} с, "
+          f"задержка p50 {percentile(latencies, 0.5):.2f} с, p99 {percentile(latencies, 0.99):.2f} с, "
+          f"max {max(latencies, default=0.0):.2f} с")
+    if after_kill:
+        print(f"   поданных во время перехода: {len(after_kill)}, max задержка {max(after_kill):.2f} с")
+    print(f"🔁 Двойных ответов клиентам: {len(doubled)}; одновременных getUpdates (409): {stats['telegram_conflicts']}")
+    if doubled:
+        print(f"   номера: {', '.join(sorted(doubled))}")
+    print(f"📁 Логи процессов: {workdir}")
+    if len(delivered) < len(expected) or doubled:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
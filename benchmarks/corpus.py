@@ -0,0 +1,230 @@
+"""
+Генератор корпуса для нагрузочных замеров: письма с заявками в том виде,
+в каком их присылают формы сайта (текст, HTML, quoted-printable, base64,
+windows-1251 в 8bit и base64, вложения с планами), сообщения менеджеров в Telegram с
+пересланной заявкой, повторные отправки той же заявки и посторонние
+письма и сообщения, на которые бот отвечать не должен.
+
+Корпус детерминирован (--seed) и может быть сохранен для повторных
+прогонов без генерации (load_test.py --corpus DIR):
+
+    python benchmarks/corpus.py --out /tmp/corpus --emails 400 --chats 100
+
+Каталог содержит manifest.jsonl (одна строка на элемент: kind, phone,
+expect_reply, file или text) и письма *.eml.
+"""
+
+import argparse
+import json
+import os
+import random
+from email.charset import QP, Charset
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from pathlib import Path
+
+FIRST_NAMES = ('Александр', 'Дмитрий', 'Сергей', 'Андрей', 'Алексей', 'Михаил', 'Иван', 'Николай', 'Елена',
+               'Ольга', 'Наталья', 'Татьяна', 'Ирина', 'Светлана', 'Марина', 'Анна', 'Юлия', 'Евгений')
+LAST_NAMES = ('Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов',
+              'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров')
+REGIONS = ('Московская обл., Истринский р-н', 'Ленинградская обл., Всеволожск', 'Тверская обл., Конаково',
+           'Калужская обл., Таруса', 'Владимирская обл., Суздаль', 'Ярославская обл., Переславль')
+HOUSES = ('дом из бруса 9x12 с мансардой', 'дом из оцилиндрованного бревна 10x10',
+          'двухэтажный дом из клееного бруса 8x10', 'коттедж из бревна ручной рубки 12x14',
+          'гостевой домик 6x8 с террасой')
+BATHS = ('баня из бревна 6x4 с комнатой отдыха', 'баня-бочка 2.2x4', 'банный комплекс с парилкой и купелью',
+         'сауна из кедра 3x4 под ключ')
+BUDGETS = ('до 1,5 млн руб.', '1,5-3 млн руб.', '3-5 млн руб.', 'свыше 5 млн руб.', 'пока не определились')
+LAND = ('Да', 'Нет', 'В процессе покупки')
+FORM_TITLES = ('Заявка', 'Application')
+ADDRESSES = ('no-reply@tilda.ws', 'forms@srubim.ru', 'robot@lptracker.ru', 'noreply@marquiz.ru')
+
+NOISE_EMAILS = (
+    ("Ваш заказ отправлен", "Здравствуйте! Заказ № 58213 передан в службу доставки СДЭК.\n"
+                            "Отследить его можно в личном кабинете."),
+    ("Счет на оплату хостинга", "Счет № 4471 на сумму 1 290 руб. Оплатите до конца месяца, "
+                                "чтобы сайт продолжил работать."),
+    ("Скидки на пиломатериалы", "Только до воскресенья: брус камерной сушки со скидкой 15%.\n"
+                                "Доставка по области бесплатно."),
+    ("Re: договор", "Добрый день, договор подписали, скан во вложении. Оригинал отправим почтой."),
+)
+NOISE_CHATS = (
+    "Добрый день! Во сколько завтра планерка?",
+    "Клиент из вчерашней заявки просил перезвонить после обеда",
+    "Сметы по бане на Истре отправил на почту",
+    "/stats",
+)
+
+
+def charset(name: str, body_encoding) -> Charset:
+    """Кодировка тела письма: None - 8bit, QP - quoted-printable"""
+    result = Charset(name)
+    result.body_encoding = body_encoding
+    return result
+
+
+def phone_number(index: int) -> str:
+    """Уникальный номер для index: 79<код 01-99><7 цифр>"""
+    return f"79{10 + index % 90:02d}{index:07d}"[:11]
+
+
+def phone_text(phone: str, rng: random.Random) -> str:
+    """Номер в одном из форматов, которые пишут в формах"""
+    code, a, b, c = phone[1:4], phone[4:7], phone[7:9], phone[9:11]
+    return rng.choice((
+        f"+7 ({code}) {a}-{b}-{c}",
+        f"8 {code} {a} {b} {c}",
+        f"+7{code}{a}{b}{c}",
+        f"+7 {code} {a}-{b}-{c}",
+    ))
+
+
+def lead_text(number: int, phone: str, rng: random.Random) -> str:
+    """Текст уведомления формы сайта о новой заявке"""
+    bath = rng.random() < 0.35
+    lines = [f"Новая заявка № {number}", f"Название формы: {rng.choice(FORM_TITLES)}"]
+    if rng.random() < 0.8:
+        lines.append(f"Имя: {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}")
+    lines.append(f"Телефон: {phone_text(phone, rng)}")
+    if rng.random() < 0.7:
+        lines.append(f"Площадь строения: {rng.randrange(16 if bath else 60, 60 if bath else 250)} м²")
+    if rng.random() < 0.6:
+        lines.append(f"Планируемый бюджет: {rng.choice(BUDGETS)}")
+    if rng.random() < 0.5:
+        lines.append(f"Есть ли земельный участок: {rng.choice(LAND)}")
+    lines.append("Куда отправить расчет стоимости: WhatsApp")
+    lines.append(f"Данные формы: {rng.choice(BATHS if bath else HOUSES)}, {rng.choice(REGIONS)}")
+    if rng.random() < 0.3:
+        lines.append("Комментарий: хотим начать строительство весной, интересует фундамент и кровля")
+    return "\n".join(lines)
+
+
+def lead_email(number: int, text: str, rng: random.Random, attachment_kb: int) -> bytes:
+    """Письмо с заявкой в одном из вариантов оформления"""
+    variant = rng.choice(('plain', 'html', 'alternative', 'base64', 'legacy'))
+    if variant in ('html', 'legacy'):
+        # В однобайтовых кодировках нет знака ²
+        text = text.replace("м²", "кв. м")
+    if variant == 'plain':
+        message = MIMEText(text, 'plain', charset('utf-8', None))
+    elif variant == 'html':
+        html = "<html><body><p>" + text.replace("\n", "<br>\n") + "</p></body></html>"
+        message = MIMEText(html, 'html', 'cp1251')
+    elif variant == 'alternative':
+        # quoted-printable, как у большинства конструкторов форм
+        message = MIMEMultipart('alternative')
+        message.attach(MIMEText(text, 'plain', charset('utf-8', QP)))
+        message.attach(MIMEText("<div>" + text.replace("\n", "<br>") + "</div>", 'html', charset('utf-8', QP)))
+    elif variant == 'base64':
+        message = MIMEText(text, 'plain', 'utf-8')
+    else:
+        message = MIMEText(text, 'plain', charset('windows-1251', None))
+
+    if attachment_kb and rng.random() < 0.1:
+        mixed = MIMEMultipart('mixed')
+        mixed.attach(message)
+        plan = MIMEApplication(rng.randbytes(attachment_kb * 1024), 'pdf')
+        plan.add_header('Content-Disposition', 'attachment', filename="plan_uchastka.pdf")
+        mixed.attach(plan)
+        message = mixed
+
+    message['Subject'] = f"Новая заявка № {number}"
+    message['From'] = rng.choice(ADDRESSES)
+    message['Date'] = formatdate(localtime=True)
+    return message.as_bytes()
+
+
+def noise_email(rng: random.Random) -> bytes:
+    subject, text = rng.choice(NOISE_EMAILS)
+    message = MIMEText(text, 'plain', 'utf-8')
+    message['Subject'] = subject
+    message['From'] = "info@example.ru"
+    return message.as_bytes()
+
+
+def chat_text(text: str, rng: random.Random) -> str:
+    """Заявка, пересланная менеджером в чат с ботом"""
+    return rng.choice(("", "Переслано с сайта:\n", "Заявка с формы, обработай пожалуйста\n\n")) + text
+
+
+def generate(emails: int, chats: int, noise: float = 0.1, duplicates: float = 0.05, seed: int = 1,
+             username: str = 'leads@example.com', attachment_kb: int = 200) -> list:
+    """
+    Корпус в порядке подачи. Элемент - словарь в формате /_append или
+    /_telegram (fake_servers) плюс expect_reply: ждать ли ответа клиенту.
+    """
+    rng = random.Random(seed)
+    items = []
+    number = 10000 * seed
+    for index in range(emails + chats):
+        number += 1
+        phone = phone_number(number)
+        text = lead_text(number, phone, rng)
+        if index < emails:
+            raw = lead_email(number, text, rng, attachment_kb)
+            items.append({'kind': 'email', 'username': username, 'raw': raw.decode('utf-8', 'surrogateescape'),
+                          'phone': phone, 'expect_reply': True})
+        else:
+            items.append({'kind': 'chat', 'chat_id': 1000 + index % 20, 'text': chat_text(text, rng),
+                          'phone': phone, 'expect_reply': True})
+    rng.shuffle(items)
+
+    # Повторная отправка той же формы и посторонние сообщения: ответов не добавляют
+    for item in rng.sample(items, int(len(items) * duplicates)):
+        copy = dict(item, phone=None, expect_reply=False)
+        items.insert(rng.randrange(items.index(item) + 1, len(items) + 1), copy)
+    for _ in range(int((emails + chats) * noise)):
+        if rng.random() < emails / max(1, emails + chats):
+            item = {'kind': 'email', 'username': username, 'raw': noise_email(rng).decode('utf-8', 'surrogateescape')}
+        else:
+            item = {'kind': 'chat', 'chat_id': 999, 'text': rng.choice(NOISE_CHATS)}
+        items.insert(rng.randrange(len(items) + 1), dict(item, phone=None, expect_reply=False))
+    return items
+
+
+def save(items: list, directory: Path):
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / 'manifest.jsonl', 'w', encoding='utf-8') as manifest:
+        for index, item in enumerate(items):
+            entry = {key: value for key, value in item.items() if key != 'raw'}
+            if 'raw' in item:
+                entry['file'] = f"{index:06d}.eml"
+                (directory / entry['file']).write_bytes(item['raw'].encode('utf-8', 'surrogateescape'))
+            manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def load(directory: Path, username: str = 'leads@example.com') -> list:
+    """Сохраненный корпус; письма попадают в ящик username"""
+    items = []
+    with open(directory / 'manifest.jsonl', encoding='utf-8') as manifest:
+        for line in manifest:
+            item = json.loads(line)
+            if 'file' in item:
+                item['raw'] = (directory / item.pop('file')).read_bytes().decode('utf-8', 'surrogateescape')
+                item['username'] = username
+            items.append(item)
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Корпус писем и сообщений с заявками для load_test.py")
+    parser.add_argument('--out', required=True, help="каталог корпуса")
+    parser.add_argument('--emails', type=int, default=400)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--noise', type=float, default=0.1, help="доля посторонних писем и сообщений")
+    parser.add_argument('--duplicates', type=float, default=0.05, help="доля повторных отправок заявок")
+    parser.add_argument('--attachment-kb', type=int, default=200, help="размер вложения у 10%% писем, КБ")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    items = generate(args.emails, args.chats, args.noise, args.duplicates, args.seed, attachment_kb=args.attachment_kb)
+    save(items, Path(args.out))
+    size = sum(os.path.getsize(path) for path in Path(args.out).iterdir())
+    print(f"🗂️ {len(items)} элементов ({sum(item['expect_reply'] for item in items)} заявок), "
+          f"{size / 2 ** 20:.1f} МБ в {args.out}")
+
+
+if __name__ == "__main__":
+    main()
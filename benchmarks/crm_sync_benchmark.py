@@ -0,0 +1,164 @@
+"""
+Замер создания задач Pyrus на локальной заглушке: по одной на заявку (CRM_SYNC_MODE=inline)
+против пакетной синхронизации (bulk), восстановление после недоступности Pyrus и сверка
+журнала с реестром формы.
+
+  throughput - N заявок, время до появления всех задач в форме;
+  outage     - заявки приходят, пока Pyrus отвечает 503; сколько запросов ушло впустую
+               и за сколько очередь догнана после восстановления;
+  reconcile  - часть задач создана без ответа клиенту (500), часть затем удалена из формы;
+               сверка должна привязать первые и пересоздать вторые без дублей.
+
+    python benchmarks/crm_sync_benchmark.py --leads 1000
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call
+
+
+def lead(index: int) -> dict:
+    return {
+        'application_number': str(100000 + index),
+        'phone': f"+7 9{index:09d}",
+        'contact_method': 'whatsapp',
+        'object_type': 'house',
+        'object_description': 'дом',
+        'form_type': 'application',
+        'created_at': datetime.now().isoformat()
+    }
+
+
+def wait_for(condition, timeout: float = 120.0) -> float:
+    started = time.time()
+    while not condition() and time.time() - started < timeout:
+        time.sleep(0.05)
+    return time.time() - started
+
+
+def run_worker(scenario: str, mode: str, leads: int, api_delay: float, workers: int) -> dict:
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, api_delay), daemon=True)
+    fakes.start()
+    _, api_port = parent.recv()
+    stats = lambda: api_call(api_port, '/_stats')
+
+    workdir = Path(tempfile.mkdtemp(prefix='crm-sync-bench-'))
+    for key in list(os.environ):
+        if key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_', 'CRM_', 'OUTBOX_')):
+            del os.environ[key]
+    os.environ.update({
+        'PYRUS_LOGIN': 'bench', 'PYRUS_SECURITY_KEY': 'key', 'PYRUS_FORM_ID': '1',
+        'PYRUS_API_URL': f"http://127.0.0.1:{api_port}",
+        'OUTBOX_PATH': str(workdir / 'outbox.db'),
+        'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'METRICS_PORT': '0',
+        'HTTP_POOL_SIZE': '50',
+        'HTTP_MAX_RETRIES': '0',
+        'DISPATCH_QUEUE_SIZE': str(leads * 2),
+        'CRM_SYNC_MODE': mode,
+        'CRM_SYNC_INTERVAL': '0.2',
+        'CRM_SYNC_CONCURRENCY': str(workers),
+        'CRM_WORKERS': str(workers),
+        'CRM_RECONCILE_INTERVAL': '0',
+        'OUTBOX_REPLAY_INTERVAL': '0.5',
+        # В reconcile повтор неудачного шага не должен успеть раньше сверки
+        'OUTBOX_RETRY_DELAY': '600' if scenario == 'reconcile' else '1'
+    })
+
+    import logging
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.CRITICAL)
+    bot = autoresponder_bot.AutoResponderBot()
+    bot.start_services()
+    result = {'scenario': scenario, 'mode': mode, 'leads': leads}
+
+    if scenario == 'throughput':
+        started = time.time()
+        for index in range(leads):
+            bot.accept_application(lead(index))
+        wait_for(lambda: stats()['form_tasks'] >= leads)
+        result['seconds'] = round(time.time() - started, 2)
+
+    elif scenario == 'outage':
+        api_call(api_port, '/_config', {'pyrus_down': True})
+        for index in range(leads):
+            bot.accept_application(lead(index))
+        time.sleep(3)
+        api_call(api_port, '/_config', {'pyrus_down': False})
+        result['rejected'] = stats()['pyrus_rejected']
+        result['seconds'] = round(wait_for(lambda: stats()['form_tasks'] >= leads), 2)
+
+    elif scenario == 'reconcile':
+        lost, dropped = leads // 50, leads // 20
+        api_call(api_port, '/_config', {'pyrus_lose': lost})
+        for index in range(leads):
+            bot.accept_application(lead(index))
+        wait_for(lambda: bot.outbox.step_backlog('crm')[0] <= lost and stats()['form_tasks'] >= leads)
+        api_call(api_port, '/_drop_tasks', {'count': dropped})
+        result['lost'], result['dropped'] = lost, dropped
+        totals = bot.crm_sync.reconcile()
+        result.update({name: totals[name] for name in ('verified', 'relinked', 'backfilled')})
+        result['reconcile_seconds'] = round(totals['seconds'], 2)
+        result['backfill_seconds'] = round(wait_for(lambda: stats()['form_tasks'] >= leads, 30), 2)
+        result['crm_backlog'] = bot.outbox.step_backlog('crm')[0]
+
+    final = stats()
+    result['form_tasks'] = final['form_tasks']
+    result['created'] = final['tasks']
+    bot.shutdown()
+    parent.send(None)
+    fakes.join(5)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная синхронизация задач Pyrus и сверка с реестром формы")
+    parser.add_argument('--leads', type=int, default=1000)
+    parser.add_argument('--api-delay', type=float, default=0.05, help="задержка ответа заглушки Pyrus, с")
+    parser.add_argument('--workers', type=int, default=8, help="CRM_WORKERS и CRM_SYNC_CONCURRENCY")
+    parser.add_argument('--worker', nargs=2, metavar=('SCENARIO', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(*args.worker, args.leads, args.api_delay, args.workers)))
+        sys.stdout.flush()
+        os._exit(0)
+
+    runs = [('throughput', 'inline'), ('throughput', 'bulk'), ('outage', 'inline'), ('outage', 'bulk'),
+            ('reconcile', 'inline')]
+    for scenario, mode in runs:
+        output = subprocess.run(
+            [sys.executable, __file__, '--worker', scenario, mode, '--leads', str(args.leads),
+             '--api-delay', str(args.api_delay), '--workers', str(args.workers)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if scenario == 'throughput':
+            print(f"📋 {mode:<6} {result['leads']} заявок: все задачи в форме за {result['seconds']} с "
+                  f"({result['leads'] / result['seconds']:.0f} задач/с), создано {result['created']}")
+        elif scenario == 'outage':
+            print(f"🚧 {mode:<6} сбой 3 с: отклонено запросов {result['rejected']}, после восстановления "
+                  f"все {result['leads']} задач за {result['seconds']} с, создано {result['created']}")
+        else:
+            print(f"🧾 сверка: потеряно ответов {result['lost']}, удалено из формы {result['dropped']} -> "
+                  f"подтверждено {result['verified']}, привязано {result['relinked']}, "
+                  f"пересоздано {result['backfilled']} за {result['reconcile_seconds']} с + {result['backfill_seconds']} с; "
+                  f"в форме {result['form_tasks']}/{result['leads']}, без задачи {result['crm_backlog']}")
+
+
+if __name__ == "__main__":
+    main()
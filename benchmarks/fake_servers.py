@@ -0,0 +1,605 @@
+"""
+Локальные заглушки внешних сервисов для нагрузочных замеров:
+IMAP-сервер с отдельным ящиком на каждый логин (SEARCH/FETCH/STORE/IDLE)
+и HTTP-сервер, отвечающий как Pyrus, Green API и Telegram Bot API
+(/bot<token>/getUpdates, sendMessage, setWebhook).
+
+Сервер также принимает служебные запросы:
+  POST /_append   {"username": ..., "raw": ..., "phone": ...} - положить письмо в ящик
+  POST /_telegram {"text": ..., "chat_id": ..., "phone": ...} - сообщение боту в Telegram
+  POST /_load     {"items": [...]} - заранее передать письма и сообщения (в формате /_append
+                  и /_telegram, у сообщений "kind": "chat") для /_schedule
+  POST /_schedule {"rate": ...} - подавать переданные элементы с заданной частотой в секунду
+                  (0 - все сразу) из потока заглушки, а не из замеряемого процесса
+  POST /_fail     {"phones": [...]} - отвечать ошибкой на sendMessage для этих номеров
+  POST /_config   {"api_delay": ..., "api_jitter": ..., "pyrus_error_rate": ..., "green_error_rate": ...,
+                   "green_error_status": ..., "send_concurrency": ..., "pyrus_down": ..., "pyrus_lose": ...,
+                   "state_delay": ..., "auth_delay": ..., "telegram_delay": ..., "revoke_tokens": true} -
+                  изменить поведение заглушек (api_jitter -
+                  разброс задержки ±доля, *_error_rate - доля запросов, на которые Pyrus или Green API
+                  отвечают 500 (Green API - green_error_status, 0 - обрыв соединения без ответа),
+                  pyrus_down - Pyrus отвечает 503, pyrus_lose - столько следующих задач создается,
+                  но клиент получает 500, state_delay/auth_delay - задержка getStateInstance
+                  и /auth, telegram_delay - задержка sendMessage Telegram, с; revoke_tokens - отозвать
+                  выданные токены Pyrus, /tasks с ними отвечает 401)
+  POST /_drop_tasks {"count": n} - удалить n последних задач из реестра формы
+  POST /_drop_imap - оборвать IMAP-сессии, ожидающие в IDLE (проверка переподключения)
+  GET  /_stats    число IMAP-сессий и HTTP-соединений, прочитанных писем, задач CRM, время получения каждого ответа
+                  WhatsApp, число ответов на каждый номер и одновременных getUpdates (409), обращений к /auth
+"""
+
+import email
+import json
+import random
+import re
+import select
+import socket
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Mailbox:
+    """Письма одного логина; условие будит IDLE-сессии при новом письме"""
+
+    def __init__(self):
+        self.messages = []
+        self.condition = threading.Condition()
+
+    def append(self, raw: bytes):
+        message = email.message_from_bytes(raw)
+        with self.condition:
+            self.messages.append({'uid': len(self.messages) + 1, 'raw': raw, 'msg': message, 'seen': False})
+            self.condition.notify_all()
+
+
+class FakeState:
+    """Общее состояние заглушек"""
+
+    def __init__(self, api_delay: float = 0.05, seed: int = 0):
+        self.api_delay = api_delay
+        self.api_jitter = 0.0
+        self.pyrus_error_rate = 0.0
+        self.green_error_rate = 0.0
+        # Ответ Green API на внедренную ошибку; 0 - закрыть соединение, не ответив
+        self.green_error_status = 500
+        self.injected_errors = 0
+        self.random = random.Random(seed)
+        self.mailboxes = {}
+        self.sessions = 0
+        # TCP-соединения с HTTP-заглушкой (проверка keep-alive)
+        self.api_connections = 0
+        # Увеличивается при обрыве сессий: IDLE-сессии прежнего поколения закрываются
+        self.imap_generation = 0
+        # Задержка ответа на каждую команду IMAP, с (время в пути до сервера)
+        self.imap_delay = 0.0
+        self.appended = {}
+        self.replies = {}
+        self.tasks = 0
+        # Реестр задач Pyrus: id -> {'form_id', 'fields', 'created'}
+        self.form_tasks = {}
+        self.pyrus_down = False
+        self.state_delay = 0.0
+        self.auth_delay = 0.0
+        # Токены Pyrus выдаются по порядку (token-<n>); токены с номером до revoked_tokens включительно получают 401
+        self.auth_calls = 0
+        self.revoked_tokens = 0
+        self.pyrus_rejected = 0
+        self.pyrus_lose = 0
+        self.failing_phones = set()
+        # Green API отвечает 429, если одновременных sendMessage больше send_concurrency (0 - без ограничения)
+        self.send_concurrency = 0
+        self.active_sends = 0
+        self.throttled = 0
+        self.reply_counts = {}
+        # Telegram: апдейты для getUpdates и число ответов бота (sendMessage)
+        self.telegram_updates = []
+        self.telegram_condition = threading.Condition()
+        self.telegram_sent = 0
+        # Как Bot API: подтвержденные апдейты забываются, одновременный второй getUpdates получает 409
+        self.telegram_confirmed = 0
+        self.telegram_polling = False
+        self.telegram_conflicts = 0
+        # Задержка ответа на sendMessage, с
+        self.telegram_delay = 0.0
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def mailbox(self, username: str) -> Mailbox:
+        with self.lock:
+            return self.mailboxes.setdefault(username, Mailbox())
+
+    def drop_imap_sessions(self):
+        with self.lock:
+            self.imap_generation += 1
+
+    def delay(self) -> float:
+        """Задержка ответа API с учетом разброса"""
+        with self.lock:
+            return max(0.0, self.api_delay * (1 + self.random.uniform(-self.api_jitter, self.api_jitter)))
+
+    def inject_error(self, rate: float) -> bool:
+        """True - ответить на этот запрос ошибкой (с вероятностью rate)"""
+        with self.lock:
+            if rate and self.random.random() < rate:
+                self.injected_errors += 1
+                return True
+        return False
+
+    def append(self, item: dict):
+        """Письмо в ящик или сообщение в Telegram; время подачи - начало отсчета задержки ответа"""
+        with self.lock:
+            if item.get('phone'):
+                self.appended[item['phone']] = time.time()
+        if item.get('kind') == 'chat':
+            self.add_telegram_update(item['text'], item.get('chat_id', 1))
+        else:
+            # 8-битные письма в других кодировках передаются в JSON как строки с surrogateescape
+            self.mailbox(item['username']).append(item['raw'].encode('utf-8', 'surrogateescape'))
+
+    def add_telegram_update(self, text: str, chat_id: int):
+        with self.telegram_condition:
+            update_id = len(self.telegram_updates) + 1
+            self.telegram_updates.append({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Менеджер', 'username': f"manager{chat_id}"},
+                    'text': text
+                }
+            })
+            self.telegram_condition.notify_all()
+
+    def schedule(self, items: list, rate: float):
+        """Подает письма и сообщения с частотой rate в секунду (по расписанию, а не по готовности бота)"""
+        started = time.monotonic()
+        for index, item in enumerate(items):
+            if rate:
+                pause = started + index / rate - time.monotonic()
+                if pause > 0:
+                    time.sleep(pause)
+            self.append(item)
+
+
+def quote(value) -> str:
+    return 'NIL' if value is None else '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def body_structure(part) -> str:
+    """BODYSTRUCTURE письма (достаточно для IMAPBatchFetcher.find_text_part)"""
+    if part.is_multipart():
+        children = ''.join(body_structure(child) for child in part.get_payload())
+        return f"({children} {quote(part.get_content_subtype().upper())})"
+
+    params = part.get_params()[1:] if part.get_params() else []
+    param_list = '(' + ' '.join(f"{quote(k.upper())} {quote(v)}" for k, v in params) + ')' if params else 'NIL'
+    raw = part.get_payload(decode=False)
+    raw = raw if isinstance(raw, str) else ''
+    encoding = part.get('Content-Transfer-Encoding', '7BIT').upper()
+    maintype, subtype = part.get_content_maintype(), part.get_content_subtype()
+    disposition = part.get_content_disposition()
+    disposition = f"({quote(disposition.upper())} NIL)" if disposition else 'NIL'
+    base = f"({quote(maintype.upper())} {quote(subtype.upper())} {param_list} NIL NIL {quote(encoding)} {len(raw)}"
+    if maintype == 'text':
+        return f"{base} {raw.count(chr(10))} NIL {disposition} NIL)"
+    return f"{base} NIL {disposition} NIL)"
+
+
+def body_section(entry: dict, section: str) -> bytes:
+    if section == '':
+        return entry['raw']
+    part = entry['msg']
+    for number in section.split('.'):
+        number = int(number)
+        if part.is_multipart():
+            part = part.get_payload()[number - 1]
+        elif number != 1:
+            return b''
+    # get_payload() заменяет 8-битные байты без charset на U+FFFD, отдаем исходные
+    raw = part._payload
+    return raw.encode('utf-8', 'surrogateescape') if isinstance(raw, str) else b''
+
+
+def uid_set(spec: str) -> set:
+    uids = set()
+    for chunk in spec.split(','):
+        if ':' in chunk:
+            start, end = chunk.split(':')
+            uids.update(range(int(start), int(end) + 1))
+        else:
+            uids.add(int(chunk))
+    return uids
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    state: FakeState = None
+
+    def send(self, data: bytes):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        self.mailbox = None
+        self.known = 0
+        self.generation = self.state.imap_generation
+        self.send(b'* OK fake IMAP ready\r\n')
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                parts = line.decode().rstrip('\r\n').split(' ', 2)
+                tag, command = parts[0], parts[1].upper()
+                argument = parts[2] if len(parts) > 2 else ''
+                if not self.dispatch(tag, command, argument):
+                    return
+        finally:
+            if self.mailbox is not None:
+                with self.state.lock:
+                    self.state.sessions -= 1
+
+    def dispatch(self, tag: str, command: str, argument: str) -> bool:
+        ok = f'{tag} OK done\r\n'.encode()
+        if self.state.imap_delay and command != 'IDLE':
+            time.sleep(self.state.imap_delay)
+        if command == 'CAPABILITY':
+            self.send(b'* CAPABILITY IMAP4rev1 IDLE\r\n' + ok)
+        elif command == 'LOGIN':
+            username = argument.split(' ')[0].strip('"')
+            self.mailbox = self.state.mailbox(username)
+            with self.state.lock:
+                self.state.sessions += 1
+            self.send(ok)
+        elif command == 'SELECT':
+            self.known = len(self.mailbox.messages)
+            self.send(f'* {self.known} EXISTS\r\n'.encode() + ok)
+        elif command in ('NOOP', 'CLOSE'):
+            self.send(ok)
+        elif command == 'LOGOUT':
+            self.send(b'* BYE\r\n' + ok)
+            return False
+        elif command == 'UID':
+            self.uid_command(argument)
+            self.report_exists()
+            self.send(ok)
+        elif command == 'IDLE':
+            if not self.idle():
+                # Сессия оборвана: соединение закрывается без ответа на команду
+                return False
+            self.send(ok)
+        else:
+            self.send(f'{tag} BAD {command}\r\n'.encode())
+        return True
+
+    def uid_command(self, argument: str):
+        subcommand, _, rest = argument.partition(' ')
+        subcommand = subcommand.upper()
+        messages = self.mailbox.messages
+        if subcommand == 'SEARCH':
+            uids = ' '.join(str(entry['uid']) for entry in messages if not entry['seen'])
+            self.send(f'* SEARCH {uids}\r\n'.encode())
+        elif subcommand == 'FETCH':
+            spec, _, items = rest.partition(' ')
+            wanted = uid_set(spec)
+            for sequence, entry in enumerate(messages, 1):
+                if entry['uid'] in wanted:
+                    self.fetch(sequence, entry, items)
+        elif subcommand == 'STORE':
+            wanted = uid_set(rest.split()[0])
+            for entry in messages:
+                if entry['uid'] in wanted:
+                    entry['seen'] = True
+
+    def fetch(self, sequence: int, entry: dict, items: str):
+        out = [f'* {sequence} FETCH (UID {entry["uid"]}'.encode()]
+        if 'BODYSTRUCTURE' in items:
+            out.append(b' BODYSTRUCTURE ' + body_structure(entry['msg']).encode())
+        if re.search(r'\bRFC822\b(?!\.)', items):
+            out.append(f' RFC822 {{{len(entry["raw"])}}}\r\n'.encode() + entry['raw'])
+        for section in re.findall(r'BODY(?:\.PEEK)?\[([^\]]*)\]', items):
+            if section.startswith('HEADER.FIELDS'):
+                data = f"Subject: {entry['msg'].get('Subject', '')}\r\n\r\n".encode()
+            else:
+                data = body_section(entry, section)
+            out.append(f' BODY[{section}] {{{len(data)}}}\r\n'.encode() + data)
+        out.append(b')\r\n')
+        self.send(b''.join(out))
+
+    def report_exists(self):
+        """Как настоящий сервер, сообщает о новых письмах в ответе на команду"""
+        if len(self.mailbox.messages) > self.known:
+            self.known = len(self.mailbox.messages)
+            self.send(f'* {self.known} EXISTS\r\n'.encode())
+
+    def idle(self) -> bool:
+        """Ждет DONE, сообщая о новых письмах; False - сессия оборвана /_drop_imap"""
+        self.send(b'+ idling\r\n')
+        while True:
+            with self.mailbox.condition:
+                self.mailbox.condition.wait(0.05)
+                self.report_exists()
+            if self.generation != self.state.imap_generation:
+                return False
+            if select.select([self.connection], [], [], 0)[0]:
+                self.rfile.readline()
+                return True
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело уходят отдельными записями: без TCP_NODELAY ответ ждет отложенного ACK (~40 мс)
+    disable_nagle_algorithm = True
+    state: FakeState = None
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.api_connections += 1
+
+    def do_GET(self):
+        if self.path.startswith('/bot'):
+            self.telegram()
+        elif self.path == '/_stats':
+            with self.state.lock:
+                self.reply({
+                    'sessions': self.state.sessions,
+                    'api_connections': self.state.api_connections,
+                    'seen': sum(entry['seen'] for mailbox in self.state.mailboxes.values() for entry in mailbox.messages),
+                    'tasks': self.state.tasks,
+                    'form_tasks': len(self.state.form_tasks),
+                    'pyrus_rejected': self.state.pyrus_rejected,
+                    'auth_calls': self.state.auth_calls,
+                    'throttled': self.state.throttled,
+                    'injected_errors': self.state.injected_errors,
+                    'telegram_sent': self.state.telegram_sent,
+                    'telegram_conflicts': self.state.telegram_conflicts,
+                    'appended': self.state.appended,
+                    'replies': self.state.replies,
+                    'reply_counts': self.state.reply_counts
+                })
+        elif '/getStateInstance/' in self.path:
+            time.sleep(self.state.state_delay)
+            self.reply({'stateInstance': 'authorized'})
+        elif self.path.startswith('/forms/') and '/register' in self.path:
+            self.register()
+        elif self.path.startswith('/forms/'):
+            with self.state.lock:
+                down = self.state.pyrus_down
+            if down:
+                self.reply({'error': 'unavailable'}, status=503)
+            else:
+                self.reply({'id': int(urlsplit(self.path).path.split('/')[2]), 'fields': []})
+        else:
+            self.reply({}, status=404)
+
+    def register(self):
+        url = urlsplit(self.path)
+        form_id = int(url.path.split('/')[2])
+        created_after = parse_qs(url.query).get('created_after')
+        since = 0.0
+        if created_after:
+            since = datetime.strptime(created_after[0], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+        with self.state.lock:
+            if self.state.pyrus_down:
+                self.reply({'error': 'unavailable'}, status=503)
+                return
+            tasks = [
+                {'id': task_id, 'fields': task['fields']}
+                for task_id, task in self.state.form_tasks.items()
+                if task['form_id'] == form_id and task['created'] >= since
+            ]
+        self.reply({'tasks': tasks})
+
+    def telegram(self):
+        """Bot API: параметры telebot передает в строке запроса"""
+        url = urlsplit(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if method == 'getUpdates':
+            deadline = time.monotonic() + min(float(params.get('timeout', 0)), 1.0)
+            with self.state.telegram_condition:
+                if self.state.telegram_polling:
+                    self.state.telegram_conflicts += 1
+                    self.reply({'ok': False, 'error_code': 409,
+                                'description': 'Conflict: terminated by other getUpdates request'}, status=409)
+                    return
+                self.state.telegram_polling = True
+                # Подтвержденные апдейты (update_id < offset) больше не отдаются никому
+                self.state.telegram_confirmed = max(self.state.telegram_confirmed, int(params.get('offset', 0)))
+                try:
+                    while True:
+                        updates = [update for update in self.state.telegram_updates
+                                   if update['update_id'] >= self.state.telegram_confirmed]
+                        remaining = deadline - time.monotonic()
+                        if updates or remaining <= 0:
+                            break
+                        self.state.telegram_condition.wait(remaining)
+                finally:
+                    self.state.telegram_polling = False
+            self.reply({'ok': True, 'result': updates[:int(params.get('limit', 100))]})
+        elif method == 'sendMessage':
+            time.sleep(self.state.telegram_delay)
+            with self.state.lock:
+                self.state.telegram_sent += 1
+                message_id = 100000 + self.state.telegram_sent
+            self.reply({'ok': True, 'result': {
+                'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}, 'text': params.get('text', '')
+            }})
+        elif method in ('setWebhook', 'deleteWebhook'):
+            self.reply({'ok': True, 'result': True})
+        else:
+            self.reply({'ok': False, 'error_code': 404, 'description': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path.startswith('/bot'):
+            self.telegram()
+        elif self.path == '/_append':
+            self.state.append(body)
+            self.reply({})
+        elif self.path == '/_telegram':
+            self.state.append(dict(body, kind='chat'))
+            self.reply({})
+        elif self.path == '/_load':
+            with self.state.lock:
+                self.state.pending.extend(body['items'])
+            self.reply({})
+        elif self.path == '/_schedule':
+            with self.state.lock:
+                items, self.state.pending = self.state.pending, []
+            threading.Thread(target=self.state.schedule, args=(items, body.get('rate', 0)), daemon=True).start()
+            self.reply({})
+        elif self.path == '/_config':
+            with self.state.lock:
+                self.state.api_delay = body.get('api_delay', self.state.api_delay)
+                self.state.api_jitter = body.get('api_jitter', self.state.api_jitter)
+                self.state.pyrus_error_rate = body.get('pyrus_error_rate', self.state.pyrus_error_rate)
+                self.state.green_error_rate = body.get('green_error_rate', self.state.green_error_rate)
+                self.state.green_error_status = body.get('green_error_status', self.state.green_error_status)
+                self.state.send_concurrency = body.get('send_concurrency', self.state.send_concurrency)
+                self.state.pyrus_down = body.get('pyrus_down', self.state.pyrus_down)
+                self.state.pyrus_lose = body.get('pyrus_lose', self.state.pyrus_lose)
+                self.state.state_delay = body.get('state_delay', self.state.state_delay)
+                self.state.auth_delay = body.get('auth_delay', self.state.auth_delay)
+                self.state.telegram_delay = body.get('telegram_delay', self.state.telegram_delay)
+                if body.get('revoke_tokens'):
+                    self.state.revoked_tokens = self.state.auth_calls
+            self.reply({})
+        elif self.path == '/_drop_tasks':
+            with self.state.lock:
+                for task_id in list(self.state.form_tasks)[-body['count']:]:
+                    del self.state.form_tasks[task_id]
+            self.reply({})
+        elif self.path == '/_drop_imap':
+            self.state.drop_imap_sessions()
+            self.reply({})
+        elif self.path == '/_fail':
+            with self.state.lock:
+                self.state.failing_phones = set(body['phones'])
+            self.reply({})
+        elif self.path.endswith('/auth'):
+            time.sleep(self.state.auth_delay)
+            with self.state.lock:
+                self.state.auth_calls += 1
+                token = f"token-{self.state.auth_calls}"
+            self.reply({'access_token': token, 'expires_in': 3600})
+        elif self.path.endswith('/tasks'):
+            time.sleep(self.state.delay())
+            if self.token_revoked():
+                self.reply({'error': 'token revoked'}, status=401)
+                return
+            if self.state.inject_error(self.state.pyrus_error_rate):
+                self.reply({'error': 'injected failure'}, status=500)
+                return
+            with self.state.lock:
+                if self.state.pyrus_down:
+                    self.state.pyrus_rejected += 1
+                    self.reply({'error': 'unavailable'}, status=503)
+                    return
+                self.state.tasks += 1
+                task_id = self.state.tasks
+                self.state.form_tasks[task_id] = {'form_id': body.get('form_id'), 'fields': body.get('fields', []),
+                                                  'created': time.time()}
+                if self.state.pyrus_lose:
+                    # Задача создана, но ответ до клиента не дошел
+                    self.state.pyrus_lose -= 1
+                    self.reply({'error': 'internal error'}, status=500)
+                    return
+            self.reply({'task': {'id': task_id}})
+        elif '/sendMessage/' in self.path:
+            with self.state.lock:
+                limit = self.state.send_concurrency
+                if limit and self.state.active_sends >= limit:
+                    self.state.throttled += 1
+                    self.reply({'error': 'too many requests'}, status=429)
+                    return
+                self.state.active_sends += 1
+            try:
+                time.sleep(self.state.delay())
+            finally:
+                with self.state.lock:
+                    self.state.active_sends -= 1
+            if self.state.inject_error(self.state.green_error_rate):
+                if not self.state.green_error_status:
+                    # Запрос прочитан, ответа нет: клиент получает "Connection aborted"
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                self.reply({'error': 'injected failure'}, status=self.state.green_error_status)
+                return
+            phone = body['chatId'].split('@')[0]
+            with self.state.lock:
+                if phone in self.state.failing_phones:
+                    self.reply({'error': 'fake failure'}, status=500)
+                    return
+                self.state.replies[phone] = time.time()
+                self.state.reply_counts[phone] = self.state.reply_counts.get(phone, 0) + 1
+            self.reply({'idMessage': f'msg-{phone}'})
+        else:
+            self.reply({}, status=404)
+
+    def token_revoked(self) -> bool:
+        """Токен запроса к Pyrus выдан до последнего revoke_tokens"""
+        number = self.headers.get('Authorization', '').rpartition('-')[2]
+        return number.isdigit() and int(number) <= self.state.revoked_tokens
+
+    def reply(self, payload, status: int = 200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент завершился, не дождавшись ответа (процесс бота убит)
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    # Все арендаторы подключаются одновременно - стандартной очереди в 5 соединений мало
+    request_queue_size = 1024
+
+
+class FakeAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Процесс бота завершился с открытыми keep-alive соединениями
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_fake_servers(host: str = '127.0.0.1', api_delay: float = 0.05):
+    """Запускает заглушки в фоновых потоках; возвращает (imap_port, api_port, state)"""
+    state = FakeState(api_delay)
+
+    imap_handler = type('Handler', (FakeIMAPHandler,), {'state': state})
+    imap_server = FakeIMAPServer((host, 0), imap_handler)
+
+    api_handler = type('Handler', (FakeAPIHandler,), {'state': state})
+    api_server = FakeAPIServer((host, 0), api_handler)
+
+    for server in (imap_server, api_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return imap_server.server_address[1], api_server.server_address[1], state
+
+
+def serve_in_process(connection, api_delay: float = 0.05):
+    """Точка входа дочернего процесса: сообщает порты и работает до завершения родителя"""
+    imap_port, api_port, _ = start_fake_servers(api_delay=api_delay)
+    connection.send((imap_port, api_port))
+    connection.recv()
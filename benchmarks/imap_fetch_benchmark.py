@@ -0,0 +1,137 @@
+"""
+Трафик и время выборки непрочитанных писем: прежняя схема (каждое письмо
+целиком командой FETCH RFC822, разбор email.message_from_bytes, STORE на
+каждое письмо) против IMAPBatchFetcher (пачки UID, BODYSTRUCTURE и тема,
+затем только текстовая часть через BODY.PEEK, один STORE на пачку).
+
+Оба варианта читают одинаковые ящики заглушки IMAP из fake_servers.py,
+10% писем корпуса - с вложением --attachment-kb. --rtt добавляет задержку
+к каждой команде IMAP, как у сервера в сети. Печатает принятые байты,
+число команд и время на письмо.
+
+    python benchmarks/imap_fetch_benchmark.py --emails 300 --rtt 0.02
+"""
+
+import argparse
+import email
+import imaplib
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+import corpus
+from autoresponder_bot import IMAPBatchFetcher, MIMETextExtractor
+from fake_servers import start_fake_servers
+
+
+class CountingIMAP(imaplib.IMAP4):
+    """IMAP4, считающий принятые байты и отправленные команды"""
+
+    def __init__(self, *args, **kwargs):
+        self.received = 0
+        self.commands = 0
+        super().__init__(*args, **kwargs)
+
+    def read(self, size):
+        data = super().read(size)
+        self.received += len(data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        self.received += len(line)
+        return line
+
+    def send(self, data):
+        self.commands += 1
+        super().send(data)
+
+
+def old_email_body(email_message) -> str:
+    """Прежний get_email_body(): первая text/plain часть, декодированная как UTF-8"""
+    if email_message.is_multipart():
+        for part in email_message.walk():
+            if part.get_content_type() == "text/plain" and "attachment" not in str(part.get("Content-Disposition")):
+                return part.get_payload(decode=True).decode('utf-8', errors='ignore')
+        return ""
+    return email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
+
+
+def old_fetch(imap) -> list:
+    """Прежний check_email(): по письму на команду FETCH (RFC822) и STORE"""
+    texts = []
+    _, data = imap.uid('SEARCH', None, 'UNSEEN')
+    for uid in data[0].split():
+        status, message_data = imap.uid('FETCH', uid, '(RFC822)')
+        if status == "OK":
+            message = email.message_from_bytes(message_data[0][1])
+            texts.append(f"{message.get('Subject', '')} {old_email_body(message)}")
+            imap.uid('STORE', uid, '+FLAGS', '(\\Seen)')
+    return texts
+
+
+def batch_fetch(imap, batch_size: int) -> list:
+    """Текущая выборка: пачки UID и только текстовая часть"""
+    fetcher = IMAPBatchFetcher(imap, lambda raw: MIMETextExtractor().extract(raw), batch_size=batch_size)
+    texts = []
+    for batch in fetcher.batches(fetcher.search_unseen()):
+        texts.extend(f"{subject} {text}" for _, subject, text in fetcher.fetch_texts(batch))
+        fetcher.mark_seen(batch)
+    return texts
+
+
+def measure(port: int, username: str, fetch) -> dict:
+    imap = CountingIMAP('127.0.0.1', port)
+    imap.login(username, 'secret')
+    imap.select('INBOX')
+    received, commands = imap.received, imap.commands
+    started = time.perf_counter()
+    texts = fetch(imap)
+    elapsed = time.perf_counter() - started
+    result = {'texts': texts, 'seconds': elapsed, 'bytes': imap.received - received,
+              'commands': imap.commands - commands}
+    imap.logout()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выборка писем: RFC822 по одному против пачек UID")
+    parser.add_argument('--emails', type=int, default=300)
+    parser.add_argument('--attachment-kb', type=int, default=200, help="размер вложения у 10%% писем, КБ")
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--rtt', type=float, default=0.0, help="задержка ответа на команду IMAP, с")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    imap_port, _, state = start_fake_servers(api_delay=0.0)
+    state.imap_delay = args.rtt
+    items = corpus.generate(args.emails, 0, noise=0.0, duplicates=0.0, seed=args.seed,
+                            attachment_kb=args.attachment_kb)
+    for username in ('old@example.com', 'batch@example.com'):
+        for item in items:
+            state.mailbox(username).append(item['raw'].encode('utf-8', 'surrogateescape'))
+    total = sum(len(entry['raw']) for entry in state.mailbox('old@example.com').messages)
+    print(f"📬 {len(items)} писем, {total / 2 ** 20:.1f} МБ в ящике, задержка команды {args.rtt * 1000:.0f} мс")
+
+    results = {
+        'RFC822 по одному': measure(imap_port, 'old@example.com', old_fetch),
+        f"пачки по {args.batch_size}": measure(imap_port, 'batch@example.com',
+                                               lambda imap: batch_fetch(imap, args.batch_size))
+    }
+    for name, result in results.items():
+        leads = sum(1 for text in result['texts'] if "Телефон" in text)
+        print(f"📥 {name:18} {result['bytes'] / 2 ** 20:7.2f} МБ, {result['commands']:5d} команд, "
+              f"{result['seconds']:6.2f} с ({result['seconds'] / len(items) * 1000:.2f} мс/письмо), "
+              f"заявок распознано {leads}/{len(items)}")
+    old, new = results.values()
+    print(f"⚖️ Трафик меньше в {old['bytes'] / max(new['bytes'], 1):.1f} раза, "
+          f"время меньше в {old['seconds'] / max(new['seconds'], 1e-9):.1f} раза")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Нагрузочный прогон всего конвейера заявок на локальных заглушках: письма
+приходят в IMAP-ящик, заявки от менеджеров - в Telegram (getUpdates),
+Pyrus и Green API отвечают с заданной задержкой, разбросом и долей ошибок
+(fake_servers.py). Корпус - corpus.py: сгенерированный или сохраненный.
+
+Заглушки подают письма и сообщения с частотой --rate в секунду из своего
+процесса, бот работает в отдельном процессе, поэтому CPU и память
+замеряются только у бота. Печатает пропускную способность, задержку от
+подачи заявки до ответа клиенту в WhatsApp (p50/p95/p99), CPU на заявку и
+RSS и сравнивает их с базовой линией (load_baseline.json): при ухудшении
+больше --tolerance код выхода 1.
+
+    python benchmarks/load_test.py                      # прогон и сравнение с базовой линией
+    python benchmarks/load_test.py --save-baseline      # записать базовую линию этой машины
+    python benchmarks/load_test.py --green-errors 0.05 --pyrus-errors 0.05 --no-check
+    python benchmarks/load_test.py --corpus /tmp/corpus --env WHATSAPP_RATE=5 --no-check
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import corpus
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call, percentile, rss_mb
+
+BASELINE = Path(__file__).resolve().parent / 'load_baseline.json'
+USERNAME = 'leads@example.com'
+
+# Показатели для сравнения с базовой линией: (ключ, подпись, больше - лучше, допустимый абсолютный разброс)
+CHECKS = (
+    ('throughput_per_s', "пропускная способность, заявок/с", True, 0.0),
+    ('latency_p50_s', "задержка p50, с", False, 0.05),
+    ('latency_p95_s', "задержка p95, с", False, 0.05),
+    ('latency_p99_s', "задержка p99, с", False, 0.1),
+    ('cpu_ms_per_lead', "CPU на заявку, мс", False, 0.5),
+    ('rss_peak_mb', "пик RSS, МБ", False, 5.0),
+)
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bot_environment(workdir: Path, imap_port: int, api_port: int, overrides: dict) -> dict:
+    """Окружение бота: арендатор default из .env, все интеграции - заглушки"""
+    api_url = f"http://127.0.0.1:{api_port}"
+    env = {
+        'EMAIL_IMAP_SERVER': '127.0.0.1', 'EMAIL_IMAP_PORT': str(imap_port), 'EMAIL_IMAP_SSL': 'false',
+        'EMAIL_USERNAME': USERNAME, 'EMAIL_PASSWORD': 'secret',
+        'GREEN_API_INSTANCE_ID': '1101', 'GREEN_API_TOKEN': 'token', 'GREEN_API_URL': api_url,
+        'PYRUS_LOGIN': 'bot@srubim.ru', 'PYRUS_SECURITY_KEY': 'key', 'PYRUS_FORM_ID': '1', 'PYRUS_API_URL': api_url,
+        'TELEGRAM_BOT_TOKEN': '123456:load-test', 'TELEGRAM_API_URL': api_url, 'TELEGRAM_MODE': 'polling',
+        'OUTBOX_PATH': str(workdir / 'outbox.db'), 'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'TEMPLATES_DIR': str(Path(__file__).resolve().parent.parent / 'templates'),
+        'METRICS_PORT': '0', 'OUTBOX_REPLAY_INTERVAL': '1', 'CONFIG_RELOAD_INTERVAL': '0',
+        # Замеряется конвейер, а не ограничитель отправок (его можно включить через --env)
+        'WHATSAPP_RATE': '0'
+    }
+    env.update(overrides)
+    return env
+
+
+def run_worker(scenario: dict) -> dict:
+    """Один прогон: заглушки - в дочернем процессе, бот - здесь"""
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, scenario['api_delay']), daemon=True)
+    fakes.start()
+    imap_port, api_port = parent.recv()
+    api_call(api_port, '/_config', {
+        'api_jitter': scenario['api_jitter'],
+        'pyrus_error_rate': scenario['pyrus_errors'],
+        'green_error_rate': scenario['green_errors']
+    })
+
+    # Корпус хранится у заглушек: в процессе бота остаются только номера для сверки
+    if scenario['corpus']:
+        items = corpus.load(Path(scenario['corpus']), USERNAME)
+    else:
+        items = corpus.generate(scenario['emails'], scenario['chats'], scenario['noise'], scenario['duplicates'],
+                                scenario['seed'], USERNAME)
+    expected = {item['phone'] for item in items if item.get('expect_reply')}
+    item_count = len(items)
+    api_call(api_port, '/_load', {'items': items})
+    del items
+    gc.collect()
+
+    workdir = Path(tempfile.mkdtemp(prefix='load-test-'))
+    for key in list(os.environ):
+        if key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_')):
+            del os.environ[key]
+    os.environ.update(bot_environment(workdir, imap_port, api_port, scenario['env']))
+
+    import logging
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.WARNING)
+
+    bot = autoresponder_bot.AutoResponderBot()
+    asyncio_runtime = bot.config.get('runtime') == 'asyncio'
+    if asyncio_runtime:
+        import asyncio
+        loop_ready = threading.Event()
+        running = {}
+
+        async def run_async():
+            running['loop'] = asyncio.get_running_loop()
+            loop_ready.set()
+            await bot.run_async()
+
+        runner = threading.Thread(target=asyncio.run, args=(run_async(),), daemon=True)
+        runner.start()
+        loop_ready.wait(10)
+    else:
+        bot.start_services()
+        bot.start_email_intake()
+    deadline = time.time() + 30
+    while api_call(api_port, '/_stats')['sessions'] < 1 and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)
+    rss_idle = rss_mb()
+
+    cpu_before = cpu_seconds()
+    started = time.time()
+    api_call(api_port, '/_schedule', {'rate': scenario['rate']})
+    fed_at = started + (item_count / scenario['rate'] if scenario['rate'] else 0)
+
+    # Пик RSS за прогон (ru_maxrss учел бы и генерацию корпуса)
+    rss_peak = rss_idle
+    stats = {}
+    while time.time() - started < scenario['timeout']:
+        rss_peak = max(rss_peak, rss_mb())
+        stats = api_call(api_port, '/_stats')
+        if expected <= stats['replies'].keys() and time.time() >= fed_at:
+            break
+        time.sleep(0.2)
+    finished = time.time()
+    cpu_used = cpu_seconds() - cpu_before
+
+    # Повторные отправки заявок приходят и после ответа на оригинал: ждем, не будет ли второго ответа
+    time.sleep(1.0)
+    stats = api_call(api_port, '/_stats')
+
+    answered = [phone for phone in expected if phone in stats['replies'] and phone in stats['appended']]
+    latencies = [stats['replies'][phone] - stats['appended'][phone] for phone in answered]
+    delivered = len(latencies)
+    first = min((stats['appended'][phone] for phone in answered), default=started)
+    last = max((stats['replies'][phone] for phone in answered), default=finished)
+    result = {
+        'items': item_count,
+        'leads': len(expected),
+        'delivered': delivered,
+        'duplicate_replies': sum(count - 1 for count in stats['reply_counts'].values()),
+        'unexpected_replies': len(stats['replies'].keys() - expected),
+        'crm_tasks': stats['tasks'],
+        'telegram_sent': stats['telegram_sent'],
+        'injected_errors': stats['injected_errors'],
+        'elapsed_s': round(finished - started, 2),
+        'throughput_per_s': round(delivered / max(last - first, 1e-9), 2),
+        'latency_p50_s': round(percentile(latencies, 0.5), 3),
+        'latency_p95_s': round(percentile(latencies, 0.95), 3),
+        'latency_p99_s': round(percentile(latencies, 0.99), 3),
+        'latency_max_s': round(max(latencies, default=0.0), 3),
+        'cpu_s': round(cpu_used, 2),
+        'cpu_ms_per_lead': round(cpu_used / max(delivered, 1) * 1000, 2),
+        'rss_idle_mb': round(rss_idle, 1),
+        'rss_peak_mb': round(rss_peak, 1)
+    }
+
+    if asyncio_runtime:
+        running['loop'].call_soon_threadsafe(bot.async_stop.set)
+        runner.join(30)
+    else:
+        bot.shutdown()
+    # Дочерний процесс держит stdout открытым: завершаем его явно
+    parent.send(None)
+    fakes.join(5)
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Ухудшения относительно базовой линии (пустой список - регрессий нет)"""
+    regressions = []
+    if result['delivered'] < result['leads']:
+        regressions.append(f"ответ получили {result['delivered']} из {result['leads']} заявок")
+    if result['duplicate_replies']:
+        regressions.append(f"повторных ответов клиентам: {result['duplicate_replies']}")
+    if result['unexpected_replies']:
+        regressions.append(f"ответов на посторонние письма и сообщения: {result['unexpected_replies']}")
+
+    for key, title, higher_is_better, slack in CHECKS:
+        old, new = baseline[key], result[key]
+        if higher_is_better:
+            worse = new < old * (1 - tolerance) - slack
+        else:
+            worse = new > old * (1 + tolerance) + slack
+        if worse:
+            regressions.append(f"{title}: {new} при базовой {old}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон конвейера заявок на заглушках")
+    parser.add_argument('--emails', type=int, default=400, help="заявок по email")
+    parser.add_argument('--chats', type=int, default=100, help="заявок в Telegram")
+    parser.add_argument('--noise', type=float, default=0.1, help="доля посторонних писем и сообщений")
+    parser.add_argument('--duplicates', type=float, default=0.05, help="доля повторных отправок заявок")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--corpus', help="каталог сохраненного корпуса (corpus.py --out) вместо генерации")
+    parser.add_argument('--rate', type=float, default=25.0, help="писем и сообщений в секунду (0 - все сразу)")
+    parser.add_argument('--api-delay', type=float, default=0.05, help="задержка ответа Pyrus/Green API, с")
+    parser.add_argument('--api-jitter', type=float, default=0.5, help="разброс задержки, ±доля")
+    parser.add_argument('--pyrus-errors', type=float, default=0.0, help="доля ответов Pyrus с ошибкой 500")
+    parser.add_argument('--green-errors', type=float, default=0.0, help="доля ответов Green API с ошибкой 500")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="переменная окружения бота, например RUNTIME=asyncio")
+    parser.add_argument('--timeout', type=float, default=180, help="предел ожидания ответов, с")
+    parser.add_argument('--baseline', default=str(BASELINE), help="файл базовой линии")
+    parser.add_argument('--save-baseline', action='store_true', help="записать результат как базовую линию")
+    parser.add_argument('--no-check', action='store_true', help="не сравнивать с базовой линией")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="допустимое ухудшение, доля")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(json.loads(args.worker))))
+        sys.stdout.flush()
+        os._exit(0)
+
+    scenario = {
+        'emails': args.emails, 'chats': args.chats, 'noise': args.noise, 'duplicates': args.duplicates,
+        'seed': args.seed, 'corpus': args.corpus, 'rate': args.rate, 'api_delay': args.api_delay,
+        'api_jitter': args.api_jitter, 'pyrus_errors': args.pyrus_errors, 'green_errors': args.green_errors,
+        'env': dict(item.split('=', 1) for item in args.env), 'timeout': args.timeout
+    }
+    output = subprocess.run([sys.executable, __file__, '--worker', json.dumps(scenario)],
+                            capture_output=True, text=True)
+    if output.returncode != 0:
+        sys.stderr.write(output.stderr)
+        sys.exit(output.returncode)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+
+    print(f"📬 Подано {result['items']} писем и сообщений, заявок {result['leads']}, "
+          f"ответ получили {result['delivered']} за {result['elapsed_s']} с "
+          f"(задач CRM {result['crm_tasks']}, ответов в Telegram {result['telegram_sent']}, "
+          f"внедренных ошибок API {result['injected_errors']})")
+    print(f"🚀 Пропускная способность: {result['throughput_per_s']} заявок/с")
+    print(f"⏱️ Задержка до ответа: p50 {result['latency_p50_s']} с, p95 {result['latency_p95_s']} с, "
+          f"p99 {result['latency_p99_s']} с, max {result['latency_max_s']} с")
+    print(f"🧮 CPU {result['cpu_s']} с ({result['cpu_ms_per_lead']} мс/заявку), "
+          f"RSS {result['rss_idle_mb']} МБ в простое, пик {result['rss_peak_mb']} МБ")
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps({
+            'scenario': scenario,
+            'machine': f"{platform.machine()}, {os.cpu_count()} CPU, Python {platform.python_version()}",
+            'result': result
+        }, ensure_ascii=False, indent=2) + "\n", encoding='utf-8')
+        print(f"💾 Базовая линия записана в {baseline_path}")
+        return
+    if args.no_check:
+        return
+    if not baseline_path.exists():
+        print(f"⚠️ Базовой линии {baseline_path} нет: запишите ее с --save-baseline")
+        return
+
+    baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+    if baseline['scenario'] != scenario:
+        print("⚠️ Сценарий отличается от базовой линии, сравнение пропущено: "
+              "запустите с теми же параметрами или перезапишите ее с --save-baseline")
+        return
+    regressions = compare(result, baseline['result'], args.tolerance)
+    if regressions:
+        print(f"❌ Регрессия относительно базовой линии ({baseline['machine']}):")
+        for line in regressions:
+            print(f"   • {line}")
+        sys.exit(1)
+    print(f"✅ В пределах {args.tolerance:.0%} от базовой линии ({baseline['machine']})")
+
+
+if __name__ == "__main__":
+    main()
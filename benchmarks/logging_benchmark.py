@@ -0,0 +1,129 @@
+"""
+Замер накладных расходов логирования на одну заявку: каждая заявка дает
+те же записи, что и в боте (получена, распознана, задача CRM, ответ
+WhatsApp, обработана). Сравниваются прежняя настройка (f-строки и
+синхронный FileHandler в bot.log) и LogPipeline (очередь, JSON, ротация)
+без прореживания и с LOG_SAMPLE. Печатает время в потоке заявки на одну
+заявку и время, за которое поток записи дописал очередь в файл.
+
+    python benchmarks/logging_benchmark.py --applications 20000 --threads 4
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from autoresponder_bot import ApplicationOutbox, ApplicationParser, LogPipeline
+
+LEAD_TEXT = (
+    "Новая заявка № 123\nНазвание формы: Заявка\nТелефон: +7 900 123-45-67\n"
+    "Способ связи: WhatsApp\nДанные формы: дом из бруса 9x12, фундамент, кровля"
+)
+
+logger = logging.getLogger('autoresponder_bot')
+
+
+def application_data() -> dict:
+    data = ApplicationParser().extract(LEAD_TEXT)
+    data['idempotency_key'] = ApplicationOutbox.make_key(LEAD_TEXT)
+    data['received_at'] = time.time()
+    data['tenant'] = 'default'
+    return data
+
+
+def log_eager(data: dict):
+    """Записи одной заявки в прежнем виде"""
+    logger.info(f"📧 Получена заявка по email: {'Новая заявка № 123'}")
+    logger.info(f"📋 Распознанные данные заявки: {data}")
+    logger.info(f"✅ Создана задача в Pyrus CRM: {12345}")
+    logger.info(f"✅ WhatsApp сообщение отправлено на {data['phone']}")
+    logger.info(f"✅ Успешно обработана заявка: {data}")
+
+
+def log_lazy(data: dict):
+    """Те же записи в бот после перехода на LogPipeline"""
+    key = data['idempotency_key']
+    logger.info("📧 Получена заявка по email: %s", 'Новая заявка № 123', extra={'category': 'application'})
+    logger.info("📋 Распознанные данные заявки: %s", data, extra={'category': 'application'})
+    logger.info("✅ Создана задача в Pyrus CRM: %s", 12345, extra={'category': 'delivery'})
+    logger.info("✅ WhatsApp сообщение отправлено на %s", data['phone'], extra={'category': 'delivery'})
+    logger.info("✅ Успешно обработана заявка: %s", data, extra={'category': 'application', 'key': key})
+
+
+def reset_logging():
+    LogPipeline.shutdown()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+
+def run(emit, applications: int, threads: int) -> float:
+    """Время, которое рабочие потоки тратят на записи, в пересчете на одну заявку, мкс"""
+    data = application_data()
+    per_thread = applications // threads
+
+    def worker():
+        for _ in range(per_thread):
+            emit(data)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (time.perf_counter() - started) / (per_thread * threads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы логирования на одну заявку")
+    parser.add_argument('--applications', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--sample', default='application=0.1,delivery=0.1',
+                        help="LOG_SAMPLE для прогона с прореживанием")
+    args = parser.parse_args()
+
+    # Консоль не замеряем: в боте под systemd/Docker ее забирает журнал
+    sys.stderr = open(os.devnull, 'w')
+    workdir = Path(tempfile.mkdtemp(prefix='logging-bench-'))
+
+    results = []
+
+    reset_logging()
+    logging.basicConfig(level=logging.INFO, format=LogPipeline.TEXT_FORMAT, handlers=[
+        logging.FileHandler(workdir / 'sync.log', encoding='utf-8'),
+        logging.StreamHandler()
+    ])
+    started = time.perf_counter()
+    hot = run(log_eager, args.applications, args.threads)
+    results.append(("FileHandler, f-строки", hot, time.perf_counter() - started, workdir / 'sync.log'))
+
+    for title, sample, directory in (("LogPipeline (JSON)", '', 'queue'),
+                                     (f"LogPipeline, LOG_SAMPLE={args.sample}", args.sample, 'sampled')):
+        reset_logging()
+        os.environ['LOG_SAMPLE'] = sample
+        os.environ['LOG_QUEUE_SIZE'] = '0'
+        LogPipeline.setup(str(workdir / directory))
+        started = time.perf_counter()
+        hot = run(log_lazy, args.applications, args.threads)
+        # Время до записи последней строки на диск
+        LogPipeline.shutdown()
+        results.append((title, hot, time.perf_counter() - started, workdir / directory / 'bot.log'))
+
+    for title, hot, total, path in results:
+        lines = sum(1 for name in path.parent.glob(path.name + '*') for _ in open(name, encoding='utf-8'))
+        print(f"🪵 {title:<52} {hot:7.1f} мкс/заявку в потоке заявки, "
+              f"все записи на диске через {total:5.2f} с, строк {lines}", file=sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Замер извлечения текста из писем с крупными вложениями: разбор целиком
+через email.message_from_bytes против потокового MIMETextExtractor.
+Для каждого варианта печатает среднее время и пик памяти (tracemalloc).
+
+    python benchmarks/mime_benchmark.py --attachments 3 --size-mb 8
+"""
+
+import argparse
+import email
+import os
+import sys
+import time
+import tracemalloc
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from autoresponder_bot import MIMETextExtractor
+
+LEAD_TEXT = "Новая заявка N 123\nТелефон: +7 900 123-45-67\nСпособ связи: WhatsApp\nДанные формы: дом из бруса"
+
+
+def build_message(attachments: int, size: int, attachments_first: bool = False, html_only: bool = False) -> bytes:
+    message = MIMEMultipart('mixed')
+    message['Subject'] = "Новая заявка"
+    if html_only:
+        text = MIMEText('<html><body><p>' + LEAD_TEXT.replace('\n', '<br>') + '</p></body></html>', 'html', 'cp1251')
+    else:
+        text = MIMEText(LEAD_TEXT, 'plain', 'cp1251')
+
+    files = []
+    for index in range(attachments):
+        part = MIMEApplication(os.urandom(size))
+        part.add_header('Content-Disposition', 'attachment', filename=f"plan{index}.pdf")
+        files.append(part)
+
+    for part in (files + [text] if attachments_first else [text] + files):
+        message.attach(part)
+    return message.as_bytes()
+
+
+def whole_message(raw: bytes) -> str:
+    """Прежний способ: разбор письма целиком и поиск первой text/plain части"""
+    message = email.message_from_bytes(raw)
+    for part in message.walk():
+        if part.get_content_type() == 'text/plain' and 'attachment' not in str(part.get('Content-Disposition')):
+            return part.get_payload(decode=True).decode('utf-8', errors='ignore')
+    return ""
+
+
+def streaming(raw: bytes) -> str:
+    return MIMETextExtractor().extract(raw)
+
+
+def measure(func, raw: bytes, repeat: int):
+    tracemalloc.start()
+    func(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(raw)
+    return (time.perf_counter() - started) / repeat, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время и память извлечения текста из писем с вложениями")
+    parser.add_argument('--attachments', type=int, default=3)
+    parser.add_argument('--size-mb', type=float, default=8, help="размер одного вложения, МБ")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    cases = [
+        ("текст, затем вложения", {}),
+        ("вложения, затем текст", {'attachments_first': True}),
+        ("только HTML (cp1251)", {'html_only': True}),
+    ]
+    for title, options in cases:
+        raw = build_message(args.attachments, size, **options)
+        for name, func in (("message_from_bytes", whole_message), ("MIMETextExtractor", streaming)):
+            elapsed, peak = measure(func, raw, args.repeat)
+            print(f"✉️ {title:<24} {len(raw) / 2 ** 20:5.1f} МБ  {name:<19} "
+                  f"{elapsed * 1000:8.1f} мс, пик памяти {peak / 2 ** 20:6.1f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Восстановление журнала заявок после перезапуска. Записывает --rows
+незавершенных заявок через ApplicationOutbox.add() (групповая фиксация),
+закрывает журнал, открывает его заново, как бот после падения, и замеряет:
+  - запись заявок;
+  - проход replay_outbox() по незавершенным заявкам страницами по 1000;
+  - постановку всех шагов в очереди DispatchQueue и полную доставку
+    мгновенными заглушками с записью результатов в журнал.
+
+    python benchmarks/outbox_recovery_benchmark.py --rows 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from autoresponder_bot import ApplicationOutbox, DispatchQueue, Priority
+
+STEPS = {'crm': 'pending', 'message': 'pending'}
+
+
+def lead(index: int) -> dict:
+    return {'application_number': str(index), 'phone': f"79{index:09d}", 'contact_method': 'whatsapp',
+            'object_type': 'house', 'object_description': 'дом', 'area': '120 м²', 'form_type': 'application'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Восстановление outbox после перезапуска")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=2, help="потоков на каждую очередь (CRM_WORKERS)")
+    parser.add_argument('--queue-size', type=int, default=100, help="DISPATCH_QUEUE_SIZE")
+    args = parser.parse_args()
+
+    path = Path(tempfile.mkdtemp(prefix='outbox-bench-')) / 'outbox.db'
+    outbox = ApplicationOutbox(str(path))
+    started = time.perf_counter()
+    futures = [outbox.add(f"key-{index}", lead(index), STEPS) for index in range(args.rows)]
+    for future in futures:
+        future.result()
+    print(f"💾 Записано {args.rows} заявок за {time.perf_counter() - started:.2f} с "
+          f"({path.stat().st_size / 2 ** 20:.1f} МБ)")
+    outbox.close()
+
+    # Перезапуск: новый экземпляр на том же файле
+    started = time.perf_counter()
+    outbox = ApplicationOutbox(str(path))
+    opened = time.perf_counter() - started
+    started = time.perf_counter()
+    rows = []
+    after_id = 0
+    while True:
+        page = outbox.pending(limit=1000, after_id=after_id)
+        if not page:
+            break
+        rows.extend(page)
+        after_id = page[-1][0]
+    scanned = time.perf_counter() - started
+    print(f"🔎 Журнал открыт за {opened * 1000:.0f} мс, {len(rows)} незавершенных заявок прочитано за {scanned:.2f} с")
+
+    queues = {step: DispatchQueue(step, workers=args.workers, maxsize=args.queue_size) for step in STEPS}
+    for dispatch_queue in queues.values():
+        dispatch_queue.start()
+    remaining = len(rows) * len(STEPS)
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def recorded(_):
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            if not remaining:
+                done.set()
+
+    def deliver(key: str, step: str, data: dict):
+        # Мгновенная заглушка Pyrus или Green API: остается стоимость очередей и журнала
+        outbox.complete_step(key, step, data, True).add_done_callback(recorded)
+
+    started = time.perf_counter()
+    for _, key, data, steps in rows:
+        for step in steps:
+            queues[step].submit(deliver, key, step, data, put_timeout=None, priority=Priority.BULK)
+    queued = time.perf_counter() - started
+    done.wait()
+    delivered = time.perf_counter() - started
+    for dispatch_queue in queues.values():
+        dispatch_queue.stop()
+    counts = outbox.counts()
+    outbox.close()
+    print(f"📤 Шаги поставлены в очереди за {queued:.2f} с, все заявки доставлены за {delivered:.2f} с "
+          f"({len(rows) / delivered:.0f} заявок/с)")
+    print(f"📊 Журнал после доставки: {counts}")
+    if counts['delivered'] != args.rows:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Распознавание заявок: прежние is_application_message() и parse_application()
+(по регулярному выражению на каждый признак и поле, компиляция на каждом
+вызове) против однопроходного ApplicationParser.
+
+Сначала проверяет на эталонном корпусе, что ApplicationParser дает те же
+результаты, что и прежний код: тот же ответ "заявка или нет" и тот же
+словарь полей (кроме created_at и поля name, которого прежний код не
+извлекал). При расхождении печатает текст и оба словаря и завершается с
+кодом 1. Корпус - заявки из corpus.py в разных форматах, пересланные в
+Telegram, посторонние письма и сообщения и пограничные случаи.
+
+    python benchmarks/parser_benchmark.py --messages 20000
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+import corpus
+from autoresponder_bot import ApplicationParser
+
+# Поля, которых не было в прежнем parse_application()
+IGNORED_FIELDS = ('created_at', 'name')
+
+EDGE_CASES = (
+    "",
+    "Новая заявка № 17",
+    "новая заявка № 18\nНазвание формы: заявка\nТелефон: 8 900 111 22 33",
+    "НОВАЯ ЗАЯВКА № 19\nНовая заявка № 20\nТЕЛЕФОН: +7 (900) 222-33-44",
+    "Название формы: Application\nтел. +7 900 333 44 55\nДанные формы: баня 6x4",
+    "Данные формы: сауна из кедра\nКуда отправить расчет стоимости: Telegram\nтелефон: 89004445566",
+    "Новая заявка № 21\nДанные формы: баня и гостевой домик\nТелефон: 8-900-555-66-77\nПозвонить после 18",
+    "Новая заявка № 22\nКуда отправить расчет стоимости: озвучить по телефону\nТелефон: +79006667788\n"
+    "Планируемый бюджет: 2 млн\nЕсть ли земельный участок (кадастр): Да\nПлощадь строения: 120 м²",
+    "Название формы: Заявка\nДанные формы: без телефона\nКуда отправить расчет стоимости: WhatsApp",
+    "Телефон: +7 900 777-88-99\nКуда отправить расчет стоимости: whatsapp и telegram",
+)
+
+
+def old_is_application_message(text: str) -> bool:
+    """Прежний is_application_message()"""
+    if not text:
+        return False
+
+    patterns = [
+        r"Новая заявка № \d+",
+        r"Название формы: (Application|Заявка)",
+        r"Данные формы:",
+        r"Телефон: [+\d\s\(\)\-]+",
+        r"Куда отправить расчет стоимости"
+    ]
+
+    matches = 0
+    for pattern in patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            matches += 1
+    return matches >= 2
+
+
+def old_parse_application(text: str) -> dict:
+    """Прежний parse_application() без проверки телефона и записи в лог"""
+    data = {}
+
+    application_number_match = re.search(r"Новая заявка № (\d+)", text)
+    if application_number_match:
+        data['application_number'] = application_number_match.group(1)
+
+    phone_patterns = [
+        r"Телефон: ([+\d\s\(\)\-]+)",
+        r"тел[\.:][\s]*([+\d\s\(\)\-]+)",
+        r"телефон[\.:][\s]*([+\d\s\(\)\-]+)"
+    ]
+    for pattern in phone_patterns:
+        phone_match = re.search(pattern, text, re.IGNORECASE)
+        if phone_match:
+            data['phone'] = phone_match.group(1).strip()
+            break
+
+    house_keywords = ['дом', 'коттедж', 'домик', 'house']
+    bath_keywords = ['бан', 'сауна', 'парилка', 'bath', 'sauna']
+    text_lower = text.lower()
+    if any(keyword in text_lower for keyword in house_keywords):
+        data['object_type'] = 'house'
+        data['object_description'] = 'дом'
+    elif any(keyword in text_lower for keyword in bath_keywords):
+        data['object_type'] = 'bath'
+        data['object_description'] = 'баня'
+    else:
+        data['object_type'] = 'house'
+        data['object_description'] = 'дом'
+
+    area_match = re.search(r"Площадь строения: ([^\n]+)", text)
+    if area_match:
+        data['area'] = area_match.group(1).strip()
+
+    budget_match = re.search(r"бюджет[^:]*: ([^\n]+)", text, re.IGNORECASE)
+    if budget_match:
+        data['budget'] = budget_match.group(1).strip()
+
+    land_match = re.search(r"земельный участок[^:]*: ([^\n]+)", text, re.IGNORECASE)
+    if land_match:
+        data['has_land'] = land_match.group(1).strip()
+
+    contact_patterns = [
+        (r"whatsapp", 'whatsapp'),
+        (r"telegram", 'telegram'),
+        (r"озвучить по телефону", 'phone_call'),
+        (r"позвонить", 'phone_call')
+    ]
+    for pattern, method in contact_patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            data['contact_method'] = method
+            break
+    else:
+        data['contact_method'] = 'whatsapp'
+
+    form_match = re.search(r"Название формы: (Application|Заявка)", text, re.IGNORECASE)
+    data['form_type'] = form_match.group(1).lower() if form_match else 'application'
+    data['created_at'] = datetime.now().isoformat()
+    return data
+
+
+def old_recognize(text: str):
+    """Прежняя цепочка: классификация, затем разбор; None - не заявка"""
+    if not old_is_application_message(text):
+        return None
+    return old_parse_application(text)
+
+
+def comparable(data):
+    if data is None:
+        return None
+    return {key: value for key, value in data.items() if key not in IGNORED_FIELDS}
+
+
+def golden_corpus(count: int, seed: int = 1) -> list:
+    """Тексты заявок из corpus.py, пересланные в чат, посторонние и пограничные"""
+    rng = random.Random(seed)
+    texts = list(EDGE_CASES)
+    for number in range(1, count + 1):
+        text = corpus.lead_text(number, corpus.phone_number(number), rng)
+        if rng.random() < 0.3:
+            text = corpus.chat_text(text, rng)
+        if rng.random() < 0.1:
+            # Пересылка из почтового клиента: признаки в другом регистре
+            text = text.lower()
+        texts.append(text)
+    texts.extend(text for _, text in corpus.NOISE_EMAILS)
+    texts.extend(corpus.NOISE_CHATS)
+    return texts
+
+
+def compare(texts: list) -> list:
+    """Тексты, на которых ApplicationParser расходится с прежним кодом: [(текст, было, стало)]"""
+    parser = ApplicationParser()
+    mismatches = []
+    for text in texts:
+        old, new = comparable(old_recognize(text)), comparable(parser.analyze(text)[1])
+        if old != new:
+            mismatches.append((text, old, new))
+    return mismatches
+
+
+def per_message(func, texts: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            func(text)
+    return (time.perf_counter() - started) / (rounds * len(texts)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Распознавание заявок: прежний код против ApplicationParser")
+    parser.add_argument('--messages', type=int, default=20000, help="заявок в эталонном корпусе")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    texts = golden_corpus(args.messages, args.seed)
+    mismatches = compare(texts)
+    for text, old, new in mismatches[:5]:
+        print(f"❌ Расхождение:\n{text}\n   было:  {old}\n   стало: {new}")
+    leads = sum(1 for text in texts if old_is_application_message(text))
+    print(f"🧪 Эталонный корпус: {len(texts)} текстов ({leads} заявок), расхождений {len(mismatches)}")
+    if mismatches:
+        sys.exit(1)
+
+    application_parser = ApplicationParser()
+    old = per_message(old_recognize, texts, args.rounds)
+    new = per_message(application_parser.analyze, texts, args.rounds)
+    print(f"⏱️ is_application_message + parse_application: {old:6.1f} мкс/сообщение")
+    print(f"⏱️ ApplicationParser.analyze:                  {new:6.1f} мкс/сообщение ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Замер холодного старта: время от запуска процесса бота до первой принятой заявки
+(запись в outbox) и до первого ответа клиенту в WhatsApp. Письмо с заявкой лежит
+в ящике до запуска; Green API и Pyrus - локальные заглушки, которые можно
+замедлить (зависший инстанс, медленная аутентификация).
+
+    python benchmarks/startup_benchmark.py --state-delay 10 --auth-delay 2
+    python benchmarks/startup_benchmark.py --bot-dir /path/to/other/checkout
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call, lead_email
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def first_outbox_row(path: Path) -> bool:
+    if not path.exists():
+        return False
+    try:
+        connection = sqlite3.connect(str(path), timeout=1)
+        try:
+            return connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] > 0
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+
+
+def import_seconds(bot_dir: Path) -> float:
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); started = time.perf_counter(); "
+            "import autoresponder_bot; print(time.perf_counter() - started)")
+    runs = [
+        float(subprocess.run([sys.executable, '-c', code, str(bot_dir)], capture_output=True, text=True,
+                             env=dict(os.environ, METRICS_PORT='0'), cwd=tempfile.mkdtemp()).stdout.split()[-1])
+        for _ in range(5)
+    ]
+    return sorted(runs)[len(runs) // 2]
+
+
+def cold_start(bot_dir: Path, state_delay: float, auth_delay: float, timeout: float) -> dict:
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, 0.05), daemon=True)
+    fakes.start()
+    imap_port, api_port = parent.recv()
+    api_call(api_port, '/_config', {'state_delay': state_delay, 'auth_delay': auth_delay})
+    api_call(api_port, '/_append', {'username': 'lead@example.com', 'raw': lead_email(0, 1, '79001234567'),
+                                    'phone': '79001234567'})
+
+    workdir = Path(tempfile.mkdtemp(prefix='startup-bench-'))
+    env = {key: value for key, value in os.environ.items()
+           if not key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_', 'WHATSAPP_'))}
+    env.update({
+        'EMAIL_IMAP_SERVER': '127.0.0.1', 'EMAIL_IMAP_PORT': str(imap_port), 'EMAIL_IMAP_SSL': 'false',
+        'EMAIL_USERNAME': 'lead@example.com', 'EMAIL_PASSWORD': 'secret',
+        'GREEN_API_INSTANCE_ID': '1000', 'GREEN_API_TOKEN': 'token',
+        'GREEN_API_URL': f"http://127.0.0.1:{api_port}",
+        'PYRUS_LOGIN': 'bench', 'PYRUS_SECURITY_KEY': 'key', 'PYRUS_FORM_ID': '1',
+        'PYRUS_API_URL': f"http://127.0.0.1:{api_port}",
+        'OUTBOX_PATH': str(workdir / 'outbox.db'), 'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'METRICS_PORT': '0', 'OUTBOX_REPLAY_INTERVAL': '30', 'PROBE_RETRY_DELAY': '1'
+    })
+    code = ("import sys; sys.path.insert(0, sys.argv[1]); import autoresponder_bot; "
+            "autoresponder_bot.AutoResponderBot().run()")
+
+    started = time.monotonic()
+    bot = subprocess.Popen([sys.executable, '-c', code, str(bot_dir)], env=env, cwd=workdir,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    accepted = replied = None
+    while time.monotonic() - started < timeout and replied is None:
+        if accepted is None and first_outbox_row(workdir / 'outbox.db'):
+            accepted = time.monotonic() - started
+        if api_call(api_port, '/_stats')['replies']:
+            replied = time.monotonic() - started
+            accepted = accepted if accepted is not None else replied
+        time.sleep(0.02)
+
+    bot.kill()
+    bot.wait()
+    parent.send(None)
+    fakes.join(5)
+    return {'accepted': accepted, 'replied': replied}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время от запуска бота до первой принятой заявки")
+    parser.add_argument('--state-delay', type=float, default=10, help="задержка ответа getStateInstance, с")
+    parser.add_argument('--auth-delay', type=float, default=2, help="задержка ответа Pyrus /auth, с")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--bot-dir', type=Path, default=ROOT, help="каталог с autoresponder_bot.py")
+    args = parser.parse_args()
+
+    print(f"📦 import autoresponder_bot: {import_seconds(args.bot_dir) * 1000:.0f} мс (медиана 5 запусков)")
+    for state_delay, auth_delay in ((0.0, 0.0), (args.state_delay, args.auth_delay)):
+        result = cold_start(args.bot_dir, state_delay, auth_delay, args.timeout)
+        shown = {key: f"{value:.2f} с" if value is not None else "нет" for key, value in result.items()}
+        print(f"🚀 getStateInstance {state_delay:g} с, /auth {auth_delay:g} с: заявка принята через {shown['accepted']}, "
+              f"ответ в WhatsApp через {shown['replied']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Замер ChatUpdateDispatcher и TelegramWebhookServer на локальной заглушке
+Telegram Bot API. Обработчик апдейта отвечает в чат через sendMessage,
+заглушка отвечает с задержкой --delay.
+
+  1. --updates апдейтов из --chats чатов: 1 поток против --workers потоков,
+     проверяется, что внутри каждого чата апдейты обработаны по порядку.
+  2. Webhook: --posts апдейтов POST-запросами на локальный сервер до полной
+     обработки; запрос с неверным секретом должен получить 403.
+
+    python benchmarks/telegram_dispatcher_benchmark.py --workers 8
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call
+
+SECRET = 'bench-secret'
+PATH = '/telegram/bench'
+
+
+def update_json(update_id: int, chat_id: int, sequence: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Менеджер'},
+            'text': str(sequence)
+        }
+    }
+
+
+def updates_json(count: int, chats: int, first_id: int = 1) -> list:
+    """Апдейты чатов вперемешку; текст - порядковый номер апдейта в своем чате"""
+    sequences = {}
+    result = []
+    for index in range(count):
+        chat_id = 1000 + index % chats
+        sequences[chat_id] = sequences.get(chat_id, 0) + 1
+        result.append(update_json(first_id + index, chat_id, sequences[chat_id]))
+    return result
+
+
+class Recorder:
+    """Обработчик апдейтов: отвечает в чат и запоминает порядок обработки по чатам"""
+
+    def __init__(self, telegram_bot, expected: int):
+        self.telegram_bot = telegram_bot
+        self.expected = expected
+        self.handled = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __call__(self, updates):
+        for update in updates:
+            message = update.message
+            self.telegram_bot.send_message(message.chat.id, f"Принято: {message.text}")
+            with self.lock:
+                self.handled.setdefault(message.chat.id, []).append(int(message.text))
+                self.count += 1
+                if self.count == self.expected:
+                    self.done.set()
+
+    def out_of_order(self) -> list:
+        return [chat_id for chat_id, sequence in self.handled.items() if sequence != sorted(sequence)]
+
+
+def run_dispatcher(autoresponder_bot, telegram_bot, updates: list, workers: int):
+    """Все апдейты в диспетчер сразу; возвращает (время до полной обработки, чаты с нарушенным порядком)"""
+    from telebot.types import Update
+    recorder = Recorder(telegram_bot, len(updates))
+    dispatcher = autoresponder_bot.ChatUpdateDispatcher(recorder, workers=workers, maxsize=len(updates))
+    dispatcher.start()
+    started = time.perf_counter()
+    for item in updates:
+        dispatcher.dispatch(Update.de_json(item))
+    recorder.done.wait(120)
+    elapsed = time.perf_counter() - started
+    dispatcher.stop()
+    return elapsed, recorder.out_of_order()
+
+
+def post(port: int, item: dict, secret: str) -> int:
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}{PATH}", data=json.dumps(item).encode(),
+        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_webhook(autoresponder_bot, telegram_bot, updates: list, workers: int):
+    """POST апдейтов на webhook; возвращает (время до полной обработки, ответы не 200, нарушения порядка, ответ на чужой секрет)"""
+    recorder = Recorder(telegram_bot, len(updates))
+    dispatcher = autoresponder_bot.ChatUpdateDispatcher(recorder, workers=workers, maxsize=len(updates))
+    dispatcher.start()
+    server = autoresponder_bot.TelegramWebhookServer('127.0.0.1', 0, PATH, SECRET, dispatcher)
+    server.start()
+    port = server.server.server_address[1]
+
+    started = time.perf_counter()
+    # Telegram доставляет апдейты по одному запросу за раз
+    rejected = [status for status in (post(port, item, SECRET) for item in updates) if status != 200]
+    recorder.done.wait(120)
+    elapsed = time.perf_counter() - started
+    forged = post(port, update_json(10 ** 6, 1, 1), 'wrong-secret')
+
+    server.stop()
+    dispatcher.stop()
+    return elapsed, rejected, recorder.out_of_order(), forged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Диспетчер апдейтов и webhook Telegram")
+    parser.add_argument('--updates', type=int, default=400)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=8, help="TELEGRAM_WORKERS")
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--delay', type=float, default=0.02, help="задержка ответа sendMessage, с")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, 0.0), daemon=True)
+    fakes.start()
+    _, api_port = parent.recv()
+    api_call(api_port, '/_config', {'telegram_delay': args.delay})
+
+    import logging
+    import telebot
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.CRITICAL)
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{api_port}/bot{{0}}/{{1}}"
+    telegram_bot = telebot.TeleBot('123456:bench', threaded=False)
+
+    failed = False
+    updates = updates_json(args.updates, args.chats)
+    for workers in (1, args.workers):
+        elapsed, disorder = run_dispatcher(autoresponder_bot, telegram_bot, updates, workers)
+        print(f"💬 {workers} поток(ов): {args.updates} апдейтов из {args.chats} чатов за {elapsed:.2f} с "
+              f"({args.updates / elapsed:.0f}/с), чатов с нарушенным порядком: {len(disorder)}")
+        failed |= bool(disorder)
+
+    updates = updates_json(args.posts, args.chats, first_id=args.updates + 1)
+    elapsed, rejected, disorder, forged = run_webhook(autoresponder_bot, telegram_bot, updates, args.workers)
+    print(f"🌐 Webhook: {args.posts} POST-запросов обработано за {elapsed:.2f} с, отклонено {len(rejected)}, "
+          f"чатов с нарушенным порядком: {len(disorder)}; неверный секрет -> {forged}")
+    failed |= bool(rejected or disorder) or forged != 403
+
+    sent = api_call(api_port, '/_stats')['telegram_sent']
+    print(f"📨 Заглушка получила {sent} sendMessage")
+    failed |= sent != 2 * args.updates + args.posts
+
+    parent.send(None)
+    fakes.join(5)
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
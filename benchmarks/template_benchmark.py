@@ -0,0 +1,115 @@
+"""
+Замер стоимости текста ответа на одну заявку: прежний выбор шаблона
+через if/else по словарю строк против TemplateStore (таблица правил,
+подстановка полей, кэш готовых текстов). Отдельно - задержка render()
+во время непрерывной перезагрузки каталога шаблонов в другом потоке.
+
+    python benchmarks/template_benchmark.py --messages 200000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from autoresponder_bot import TemplateStore
+
+TEMPLATES_DIR = Path(__file__).resolve().parent.parent / 'templates'
+
+
+def old_reply_template(data: dict, templates: dict) -> str:
+    """Прежний reply_template(): if/else по типу формы и объекта"""
+    if data.get('form_type') == 'заявка':
+        return templates['general_request']
+    object_type = data.get('object_type', 'house')
+    return templates.get(object_type, templates['house'])
+
+
+def leads(count: int, distinct: int) -> list:
+    """Заявки с distinct разными наборами полей (имя, площадь, номер)"""
+    kinds = [
+        {'form_type': 'application', 'object_type': 'house'},
+        {'form_type': 'application', 'object_type': 'bath'},
+        {'form_type': 'заявка', 'object_type': 'house'}
+    ]
+    return [
+        dict(kinds[index % len(kinds)], name=f"Клиент {index % distinct}", area=f"{100 + index % distinct} м²",
+             application_number=str(index % distinct))
+        for index in range(count)
+    ]
+
+
+def per_message(func, items: list) -> float:
+    started = time.perf_counter()
+    for data in items:
+        func(data)
+    return (time.perf_counter() - started) / len(items) * 1e6
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стоимость текста ответа на заявку")
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--reload-seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='templates-bench-'))
+    shutil.copytree(TEMPLATES_DIR, workdir / 'templates')
+    store = TemplateStore(str(workdir / 'templates'))
+    store.load()
+
+    repeated = leads(args.messages, 50)
+    unique = leads(args.messages, args.messages)
+    old = per_message(lambda data: old_reply_template(data, TemplateStore.DEFAULT_TEMPLATES), repeated)
+    print(f"📝 if/else по словарю строк:               {old:6.2f} мкс/сообщение")
+    print(f"📝 TemplateStore, 50 вариантов (кэш):      {per_message(store.render, repeated):6.2f} мкс/сообщение")
+    info = store.active[1].cache_info()
+    print(f"   кэш: попаданий {info.hits}, промахов {info.misses}")
+    print(f"📝 TemplateStore, все варианты разные:     {per_message(store.render, unique):6.2f} мкс/сообщение")
+
+    # render() во время перезагрузок: каждые ~10 мс меняется файл шаблона
+    stop = threading.Event()
+    reloads = 0
+
+    def reloader():
+        nonlocal reloads
+        path = workdir / 'templates' / 'house.txt'
+        text = path.read_text(encoding='utf-8')
+        version = 0
+        while not stop.is_set():
+            version += 1
+            path.write_text(text + f"\nВерсия {version}", encoding='utf-8')
+            if store.reload_if_changed():
+                reloads += 1
+            time.sleep(0.01)
+
+    thread = threading.Thread(target=reloader)
+    thread.start()
+    latencies = []
+    deadline = time.perf_counter() + args.reload_seconds
+    index = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        store.render(repeated[index % len(repeated)])
+        latencies.append(time.perf_counter() - started)
+        index += 1
+    stop.set()
+    thread.join()
+    print(f"🔄 Во время {reloads} перезагрузок: {len(latencies)} сообщений, "
+          f"p50 {percentile(latencies, 0.5) * 1e6:.1f} мкс, p99 {percentile(latencies, 0.99) * 1e6:.1f} мкс, "
+          f"max {max(latencies) * 1e3:.2f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Замер многоарендного приема заявок на локальных заглушках.
+
+Запускает бота с N арендаторами (по одному ящику, инстансу WhatsApp и форме
+Pyrus на каждого), кладет письма-заявки во все ящики и измеряет:
+  - память процесса на одного арендатора (сравнение прогонов с 1 и N арендаторами);
+  - задержку от попадания письма в ящик до отправки ответа в WhatsApp.
+
+    python benchmarks/tenants_benchmark.py --tenants 50 --leads 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_servers import serve_in_process
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса в МБ"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def api_call(port: int, path: str, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def lead_email(tenant: int, lead: int, phone: str) -> str:
+    return (
+        f"Subject: Новая заявка № {tenant}-{lead}\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "Content-Transfer-Encoding: 8bit\r\n\r\n"
+        f"Новая заявка № {tenant}{lead:03d}\r\n"
+        f"Телефон: +7 {phone[1:4]} {phone[4:7]}-{phone[7:9]}-{phone[9:]}\r\n"
+        "Способ связи: WhatsApp\r\n"
+        "Данные формы: дом из бруса\r\n"
+    )
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run_worker(tenants: int, leads: int, api_delay: float) -> dict:
+    """Один прогон в отдельном процессе: заглушки - в дочернем процессе, бот - здесь"""
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, api_delay), daemon=True)
+    fakes.start()
+    imap_port, api_port = parent.recv()
+
+    workdir = Path(tempfile.mkdtemp(prefix='tenants-bench-'))
+    spec = {'tenants': [
+        {
+            'id': f"brand{index:02d}",
+            'mailboxes': [{
+                'imap_server': '127.0.0.1', 'port': imap_port, 'use_ssl': False,
+                'username': f"brand{index:02d}@example.com", 'password': 'secret'
+            }],
+            'green_api': {'instance_id': str(1000 + index), 'api_token': 'token',
+                          'api_url': f"http://127.0.0.1:{api_port}"},
+            'pyrus': {'login': f"brand{index:02d}", 'security_key': 'key', 'form_id': index + 1,
+                      'api_url': f"http://127.0.0.1:{api_port}"},
+            'max_connections': 1
+        }
+        for index in range(tenants)
+    ]}
+    (workdir / 'tenants.json').write_text(json.dumps(spec), encoding='utf-8')
+
+    for key in list(os.environ):
+        if key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_')):
+            del os.environ[key]
+    os.environ.update({
+        'TENANTS_FILE': str(workdir / 'tenants.json'),
+        'OUTBOX_PATH': str(workdir / 'outbox.db'),
+        'DEDUP_PATH': str(workdir / 'dedup.db'),
+        'METRICS_PORT': '0',
+        'OUTBOX_REPLAY_INTERVAL': '1',
+        'EMAIL_IDLE_TIMEOUT': '600',
+        'HTTP_POOL_SIZE': '50',
+        'CRM_WORKERS': '8',
+        'WHATSAPP_WORKERS': '8',
+        # Замеряется прием, а не ограничитель отправок
+        'WHATSAPP_RATE': '0',
+        'WHATSAPP_MAX_CONCURRENCY': '50'
+    })
+
+    import logging
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.WARNING)
+
+    rss_before = rss_mb()
+    bot = autoresponder_bot.AutoResponderBot()
+    bot.start_services()
+    bot.start_email_intake()
+    deadline = time.time() + 30
+    while api_call(api_port, '/_stats')['sessions'] < tenants and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)
+    rss_idle = rss_mb()
+    threads = threading.active_count()
+
+    started = time.time()
+    phones = []
+    for lead in range(leads):
+        for index in range(tenants):
+            phone = f"79{index:03d}{lead:06d}"
+            phones.append(phone)
+            api_call(api_port, '/_append', {
+                'username': f"brand{index:02d}@example.com",
+                'raw': lead_email(index, lead, phone),
+                'phone': phone
+            })
+
+    stats = {}
+    while time.time() - started < 120:
+        stats = api_call(api_port, '/_stats')
+        if len(stats['replies']) >= len(phones):
+            break
+        time.sleep(0.1)
+    elapsed = time.time() - started
+
+    latencies = [stats['replies'][p] - stats['appended'][p] for p in phones if p in stats['replies']]
+    result = {
+        'tenants': tenants,
+        'leads': len(phones),
+        'delivered': len(latencies),
+        'crm_tasks': stats.get('tasks', 0),
+        'rss_before_mb': round(rss_before, 1),
+        'rss_idle_mb': round(rss_idle, 1),
+        'threads': threads,
+        'elapsed_s': round(elapsed, 2),
+        'latency_p50_s': round(percentile(latencies, 0.5), 3),
+        'latency_p95_s': round(percentile(latencies, 0.95), 3),
+        'latency_max_s': round(max(latencies, default=0.0), 3)
+    }
+    bot.shutdown()
+    # Дочерний процесс держит stdout открытым: завершаем его явно
+    parent.send(None)
+    fakes.join(5)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер памяти и задержки приема для N арендаторов")
+    parser.add_argument('--tenants', type=int, default=50)
+    parser.add_argument('--leads', type=int, default=4, help="писем на арендатора")
+    parser.add_argument('--api-delay', type=float, default=0.05, help="задержка ответа заглушек Pyrus/Green, с")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.tenants, args.leads, args.api_delay)))
+        sys.stdout.flush()
+        os._exit(0)
+
+    results = []
+    for tenants in (1, args.tenants):
+        output = subprocess.run(
+            [sys.executable, __file__, '--worker', '--tenants', str(tenants),
+             '--leads', str(args.leads), '--api-delay', str(args.api_delay)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    for result in results:
+        print(f"🏢 {result['tenants']:>3} арендаторов: RSS {result['rss_idle_mb']} МБ, потоков {result['threads']}, "
+              f"заявок {result['delivered']}/{result['leads']} за {result['elapsed_s']} с, "
+              f"задержка p50 {result['latency_p50_s']} с, p95 {result['latency_p95_s']} с, max {result['latency_max_s']} с")
+
+    single, many = results
+    if many['tenants'] > single['tenants']:
+        per_tenant = (many['rss_idle_mb'] - single['rss_idle_mb']) / (many['tenants'] - single['tenants'])
+        print(f"📊 Память на арендатора: {per_tenant:.2f} МБ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Замер ограничителя отправок WhatsApp на локальной заглушке Green API.
+
+  1. Ведро токенов: N отправок при WHATSAPP_RATE/WHATSAPP_BURST - фактическая скорость.
+  2. AIMD: заглушка отвечает 429, если одновременных отправок больше лимита;
+     сравнивается число 429 и время без адаптации и с ней.
+  3. Приоритеты: во время массовой повторной доставки отправляется /test_whatsapp -
+     сравнивается ожидание слота у срочной и у массовых отправок.
+
+    python benchmarks/whatsapp_limiter_benchmark.py
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('METRICS_PORT', '0')
+
+from fake_servers import serve_in_process
+from tenants_benchmark import api_call, percentile
+
+
+def send_all(autoresponder_bot, api_port: int, limiter, count: int, workers: int, priorities=None):
+    """Отправляет count сообщений через очередь; возвращает (время, отправлено, [(приоритет, время до отправки)])"""
+    http = autoresponder_bot.HTTPClient('green-api', pool_size=workers, max_retries=3, backoff_base=0.05)
+    green = autoresponder_bot.GreenAPI('1000', 'token', http=http, api_url=f"http://127.0.0.1:{api_port}",
+                                       limiter=limiter)
+    dispatch = autoresponder_bot.DispatchQueue('whatsapp-bench', workers=workers, maxsize=count + 10)
+    dispatch.start()
+
+    waits = []
+
+    def send(phone, priority):
+        sent = green.send_message(phone, "Здравствуйте!", priority)
+        waits.append((priority, time.monotonic() - started))
+        return sent
+
+    priorities = priorities or {}
+    started = time.monotonic()
+    futures = []
+    for index in range(count):
+        priority = priorities.get(index, autoresponder_bot.Priority.NORMAL)
+        futures.append(dispatch.submit(send, f"79{index:09d}", priority, priority=priority))
+    sent = sum(1 for future in futures if future.result())
+    elapsed = time.monotonic() - started
+    dispatch.stop()
+    return elapsed, sent, waits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость, 429 и приоритеты отправок WhatsApp")
+    parser.add_argument('--count', type=int, default=60)
+    parser.add_argument('--rate', type=float, default=10)
+    parser.add_argument('--burst', type=int, default=5)
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_in_process, args=(child, 0.05), daemon=True)
+    fakes.start()
+    _, api_port = parent.recv()
+
+    import logging
+    import autoresponder_bot
+    logging.getLogger('autoresponder_bot').setLevel(logging.CRITICAL)
+    Limiter, Priority = autoresponder_bot.SendRateLimiter, autoresponder_bot.Priority
+
+    # 1. Ведро токенов
+    limiter = Limiter('bucket', rate=args.rate, burst=args.burst, max_concurrency=8)
+    elapsed, sent, _ = send_all(autoresponder_bot, api_port, limiter, args.count, workers=8)
+    print(f"🪣 rate={args.rate:g}/с burst={args.burst}: {sent} сообщений за {elapsed:.2f} с "
+          f"= {sent / elapsed:.1f}/с (ожидалось ≤ {args.rate + args.burst / elapsed:.1f}/с), "
+          f"метрика send_rate {limiter.send_rate() * 60 / elapsed:.1f}/с")
+
+    # 2. AIMD против заглушки, пропускающей не больше 2 одновременных отправок
+    api_call(api_port, '/_config', {'send_concurrency': 2, 'api_delay': 0.1})
+    for title, limiter in (
+            ("без адаптации", None),
+            ("AIMD", Limiter('aimd', rate=0, max_concurrency=16)),
+    ):
+        before = api_call(api_port, '/_stats')['throttled']
+        elapsed, sent, _ = send_all(autoresponder_bot, api_port, limiter, 200, workers=16)
+        throttled = api_call(api_port, '/_stats')['throttled'] - before
+        limit = f", предел в конце {int(limiter.limit)}" if limiter else ""
+        print(f"📉 {title}: отправлено {sent}/200 за {elapsed:.2f} с, ответов 429: {throttled}{limit}")
+
+    # 3. Приоритеты: 100 массовых повторов и 3 срочные проверки в середине очереди;
+    #    время считается от постановки всей пачки в очередь
+    api_call(api_port, '/_config', {'send_concurrency': 0, 'api_delay': 0.05})
+    limiter = Limiter('priority', rate=20, burst=1, max_concurrency=4)
+    priorities = {index: Priority.BULK for index in range(100)}
+    priorities.update({40: Priority.HIGH, 60: Priority.HIGH, 80: Priority.HIGH})
+    elapsed, sent, waits = send_all(autoresponder_bot, api_port, limiter, 100, workers=4, priorities=priorities)
+    for priority in (Priority.HIGH, Priority.BULK):
+        values = [wait for p, wait in waits if p == priority]
+        print(f"🚦 {Priority.NAMES[priority]}: {len(values)} отправок, до отправки p50 {percentile(values, 0.5):.2f} с, "
+              f"max {max(values):.2f} с")
+
+    parent.send(None)
+    fakes.join(5)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
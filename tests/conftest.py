@@ -0,0 +1,49 @@
+"""
+Общие настройки тестов: бот импортируется из корня репозитория, заглушки
+внешних сервисов - из benchmarks/fake_servers.py.
+
+    python -m pytest -q
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+# Импорт бота не должен занимать порт метрик
+os.environ.setdefault('METRICS_PORT', '0')
+
+
+@pytest.fixture(scope='module')
+def fake_servers():
+    """Заглушки IMAP и HTTP API в фоновых потоках: (imap_port, api_port, state)"""
+    from fake_servers import start_fake_servers
+    return start_fake_servers(api_delay=0.0)
+
+
+@pytest.fixture
+def offline_bot(tmp_path, monkeypatch):
+    """Бот с Green API на закрытом порту; очереди не запущены, задачи перехватываются"""
+    for key in list(os.environ):
+        if key.startswith(('EMAIL_', 'PYRUS_', 'GREEN_API_', 'TELEGRAM_', 'TENANTS_', 'MANAGER_')):
+            monkeypatch.delenv(key)
+    monkeypatch.setenv('GREEN_API_INSTANCE_ID', '1101')
+    monkeypatch.setenv('GREEN_API_TOKEN', 'token')
+    monkeypatch.setenv('GREEN_API_URL', 'http://127.0.0.1:9')
+    monkeypatch.setenv('OUTBOX_PATH', str(tmp_path / 'outbox.db'))
+    monkeypatch.setenv('DEDUP_PATH', str(tmp_path / 'dedup.db'))
+    monkeypatch.setenv('TEMPLATES_DIR', str(tmp_path / 'templates'))
+    monkeypatch.setenv('CIRCUIT_FAILURE_THRESHOLD', '2')
+    monkeypatch.setenv('CIRCUIT_RESET_TIMEOUT', '30')
+    from autoresponder_bot import AutoResponderBot
+    bot = AutoResponderBot()
+    submitted = []
+    monkeypatch.setattr(bot.whatsapp_queue, 'submit', lambda *args, **kwargs: submitted.append(args))
+    bot.submitted = submitted
+    yield bot
+    bot.outbox.close()
+    bot.dedup.close()
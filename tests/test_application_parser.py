@@ -0,0 +1,18 @@
+"""ApplicationParser дает те же результаты, что и прежний код, на эталонном корпусе"""
+
+from autoresponder_bot import ApplicationParser
+from parser_benchmark import EDGE_CASES, compare, golden_corpus
+
+
+def test_matches_previous_parser_on_golden_corpus():
+    assert compare(golden_corpus(2000)) == []
+
+
+def test_edge_cases_are_covered():
+    parser = ApplicationParser()
+    results = [parser.analyze(text)[1] for text in EDGE_CASES]
+    # В корпусе есть и не-заявки, и заявки каждого способа связи и типа объекта
+    assert None in results
+    recognized = [data for data in results if data]
+    assert {data['contact_method'] for data in recognized} == {'whatsapp', 'telegram', 'phone_call'}
+    assert {data['object_type'] for data in recognized} == {'house', 'bath'}
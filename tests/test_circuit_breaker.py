@@ -0,0 +1,140 @@
+"""CircuitBreaker: переходы closed/open/half_open по часам теста и отложенные шаги доставки"""
+
+import time
+
+import pytest
+
+import autoresponder_bot
+from autoresponder_bot import CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.monotonic()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(autoresponder_bot.time, 'monotonic', clock)
+    return clock
+
+
+def fail(breaker: CircuitBreaker, times: int = 1):
+    for _ in range(times):
+        breaker.check()
+        breaker.record(False)
+
+
+def test_opens_after_threshold_and_backs_off_until_a_trial_succeeds(clock):
+    closed = []
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=10, max_reset_timeout=40,
+                             on_close=lambda: closed.append(clock.now))
+
+    fail(breaker, 2)
+    assert breaker.state == 'closed'
+    fail(breaker)
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert error.value.retry_in == 10
+    assert not breaker.available()
+
+    # Неудачные пробные вызовы удваивают паузу до max_reset_timeout
+    for pause in (10, 20, 40, 40):
+        clock.advance(pause - 1)
+        assert breaker.retry_in() == 1
+        assert not breaker.available()
+        clock.advance(1)
+        assert breaker.available()
+        breaker.check()
+        assert breaker.state == 'half_open'
+        # Пробный слот один: остальные вызовы отклоняются
+        with pytest.raises(CircuitOpenError):
+            breaker.check()
+        breaker.record(False)
+        assert breaker.state == 'open'
+        assert breaker.open_timeout == min(pause * 2, 40)
+
+    clock.advance(40)
+    breaker.check()
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    assert breaker.open_timeout == 10
+    assert closed == [clock.now]
+    # После замыкания счет неудач начинается заново
+    fail(breaker, 2)
+    assert breaker.state == 'closed'
+    assert breaker.snapshot()['rejected'] == 5
+
+
+def test_call_that_did_not_happen_frees_the_trial_slot(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=5)
+    fail(breaker)
+    clock.advance(5)
+    breaker.check()
+    # Отказал ограничитель: исход неизвестен, состояние не меняется
+    breaker.record(None)
+    assert breaker.state == 'half_open'
+    breaker.check()
+    breaker.record(True)
+    assert breaker.state == 'closed'
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    for _ in range(5):
+        fail(breaker)
+        breaker.check()
+        breaker.record(True)
+    assert breaker.state == 'closed'
+
+
+def test_zero_threshold_never_opens(clock):
+    breaker = CircuitBreaker('test', failure_threshold=0)
+    fail(breaker, 100)
+    assert breaker.state == 'closed'
+    assert breaker.available()
+
+
+def attempts(bot, key: str) -> int:
+    connection = bot.outbox._connect()
+    try:
+        return connection.execute("SELECT attempts FROM outbox WHERE idempotency_key = ?", (key,)).fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_open_breaker_defers_steps_without_spending_attempts(offline_bot, clock):
+    bot = offline_bot
+    data = {'phone': '79001234567', 'contact_method': 'whatsapp', 'tenant': 'default'}
+    steps = bot.delivery_steps(data)
+    assert steps == {'crm': 'skipped', 'message': 'pending'}
+    assert bot.outbox.add('key-1', data, steps).result(5)
+    breaker = bot.step_breaker(data, 'message')
+    fail(breaker, 2)
+    assert not bot.step_ready(data, 'message')
+
+    # Повторный проход outbox не ставит шаг в очередь, пока выключатель разомкнут
+    bot.deliver('key-1', data, steps)
+    assert bot.submitted == []
+    assert not bot.in_flight_steps
+
+    # Шаг, попавший в очередь до размыкания, откладывается при выполнении
+    bot.in_flight_steps.add(('key-1', 'message'))
+    assert bot.run_delivery_step('key-1', 'message', data) is None
+    assert not bot.in_flight_steps
+    assert bot.outbox.step_pending('key-1', 'message')
+    assert attempts(bot, 'key-1') == 0
+
+    # Время пробного вызова: шаг снова уходит в очередь
+    clock.advance(30)
+    assert bot.step_ready(data, 'message')
+    bot.deliver('key-1', data, steps)
+    assert [args[1:3] for args in bot.submitted] == [('key-1', 'message')]
@@ -0,0 +1,60 @@
+"""merged_env: какие значения берутся из перечитанного .env, а какие остаются из окружения процесса"""
+
+import os
+
+import pytest
+
+from autoresponder_bot import AutoResponderBot
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    """Бот, запущенный с .env {CHECK_INTERVAL=60, PYRUS_FORM_ID=1} и PYRUS_LOGIN из окружения процесса"""
+    for key in ('CHECK_INTERVAL', 'PYRUS_FORM_ID', 'PYRUS_LOGIN', 'DEBUG'):
+        monkeypatch.delenv(key, raising=False)
+    # load_dotenv() при запуске перенес значения файла в окружение
+    monkeypatch.setenv('CHECK_INTERVAL', '60')
+    monkeypatch.setenv('PYRUS_FORM_ID', '1')
+    monkeypatch.setenv('PYRUS_LOGIN', 'process@example.com')
+    bot = object.__new__(AutoResponderBot)
+    bot.env_file_values = {'CHECK_INTERVAL': '60', 'PYRUS_FORM_ID': '1'}
+    return bot
+
+
+def test_changed_file_values_replace_values_loaded_from_the_file(bot):
+    env = bot.merged_env({'CHECK_INTERVAL': '30', 'PYRUS_FORM_ID': '1'})
+    assert env['CHECK_INTERVAL'] == '30'
+    assert env['PYRUS_FORM_ID'] == '1'
+
+
+def test_process_environment_wins_over_the_file(bot):
+    # Переменная задана при запуске процесса (systemd, docker -e), а не файлом
+    env = bot.merged_env({'CHECK_INTERVAL': '60', 'PYRUS_FORM_ID': '1', 'PYRUS_LOGIN': 'file@example.com'})
+    assert env['PYRUS_LOGIN'] == 'process@example.com'
+
+
+def test_new_keys_are_added_and_removed_keys_are_dropped(bot):
+    env = bot.merged_env({'CHECK_INTERVAL': '60', 'DEBUG': 'true'})
+    assert env['DEBUG'] == 'true'
+    assert 'PYRUS_FORM_ID' not in env
+    assert env['PYRUS_LOGIN'] == 'process@example.com'
+
+
+def test_value_changed_in_the_process_is_not_dropped(bot, monkeypatch):
+    # Значение уже не совпадает с файлом - его задали иначе, удаление ключа из файла его не трогает
+    monkeypatch.setenv('PYRUS_FORM_ID', '7')
+    env = bot.merged_env({'CHECK_INTERVAL': '60'})
+    assert env['PYRUS_FORM_ID'] == '7'
+    env = bot.merged_env({'CHECK_INTERVAL': '60', 'PYRUS_FORM_ID': '2'})
+    assert env['PYRUS_FORM_ID'] == '7'
+
+
+def test_keys_without_value_are_ignored(bot):
+    env = bot.merged_env({'CHECK_INTERVAL': None, 'PYRUS_FORM_ID': '1'})
+    assert env['CHECK_INTERVAL'] == '60'
+
+
+def test_merging_does_not_touch_the_process_environment(bot):
+    bot.merged_env({'CHECK_INTERVAL': '30', 'DEBUG': 'true'})
+    assert os.environ['CHECK_INTERVAL'] == '60'
+    assert 'DEBUG' not in os.environ
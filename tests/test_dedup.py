@@ -0,0 +1,120 @@
+"""DedupIndex: окно дедупликации, перезапуск, освобождение ключей и общая таблица кластера"""
+
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import autoresponder_bot
+from autoresponder_bot import DedupIndex
+
+KEYS = ['number:42', 'phone:79001234567@c.us']
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(autoresponder_bot.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def open_index(tmp_path):
+    """Фабрика индексов на одном файле; все открытые индексы закрываются после теста"""
+    opened = []
+
+    def open_index(**kwargs) -> DedupIndex:
+        index = DedupIndex(str(tmp_path / 'dedup.db'), window=60, **kwargs)
+        opened.append(index)
+        return index
+
+    yield open_index
+    for index in opened:
+        index.close()
+
+
+def test_keys_expire_after_the_window(open_index, clock):
+    index = open_index()
+    assert index.check_and_add(KEYS) is None
+    clock.advance(59)
+    # Совпадения по любому из ключей достаточно
+    assert index.check_and_add(['phone:79001234567@c.us']) == 'phone:79001234567@c.us'
+    clock.advance(1)
+    assert index.check_and_add(KEYS) is None
+    assert (index.hits, index.misses) == (1, 2)
+
+
+def test_keys_survive_a_restart(open_index, clock):
+    first = open_index()
+    assert first.check_and_add(KEYS) is None
+    first.close()
+
+    restarted = open_index()
+    assert set(restarted.entries) == set(KEYS)
+    assert restarted.check_and_add(['number:42']) == 'number:42'
+
+
+def test_expired_keys_are_not_reloaded(open_index, clock):
+    first = open_index()
+    first.check_and_add(KEYS)
+    first.close()
+    clock.advance(60)
+
+    restarted = open_index()
+    assert not restarted.entries
+    assert restarted.check_and_add(KEYS) is None
+
+
+def test_forgotten_keys_are_removed_from_disk_too(open_index, clock):
+    first = open_index()
+    first.check_and_add(KEYS)
+    first.forget(KEYS)
+    assert first.check_and_add(KEYS) is None
+    first.forget(KEYS)
+    first.close()
+
+    assert open_index().check_and_add(KEYS) is None
+
+
+@pytest.mark.parametrize('shared, duplicate', [(True, 'number:42'), (False, None)])
+def test_shared_index_sees_keys_of_other_processes(open_index, clock, shared, duplicate):
+    first = open_index(shared=shared)
+    second = open_index(shared=shared)
+    assert first.check_and_add(KEYS) is None
+    # Во втором процессе ключа нет в памяти: общий индекс находит его в таблице
+    assert second.check_and_add(KEYS) == duplicate
+    if shared:
+        clock.advance(60)
+        assert second.check_and_add(KEYS) is None
+
+
+def test_failed_outbox_write_releases_the_keys(offline_bot, monkeypatch):
+    bot = offline_bot
+    data = {'application_number': '42', 'phone': '79001234567', 'contact_method': 'whatsapp', 'tenant': 'default'}
+
+    def failing_add(key, data, steps):
+        future = Future()
+        future.set_exception(OSError('disk I/O error'))
+        return future
+
+    with monkeypatch.context() as patch:
+        patch.setattr(bot.outbox, 'add', failing_add)
+        assert isinstance(bot.accept_application(dict(data)).exception(), OSError)
+    assert not bot.dedup.entries
+    assert bot.stats.snapshot()['errors'] == 1
+
+    # Повторно полученная заявка принимается, а не отбрасывается как дубль
+    assert bot.accept_application(dict(data)).result(5) is True
+    assert [args[1:3] for args in bot.submitted] == [(bot.application_key(data), 'message')]
+    assert bot.accept_application(dict(data)).result(5) is False
@@ -0,0 +1,180 @@
+"""HTTPClient клиентов Pyrus и Green API против заглушки: keep-alive, повторы и таймауты"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from autoresponder_bot import AsyncHTTPClient, GreenAPI, HTTPClient, PyrusAPI
+
+
+@pytest.fixture
+def api(fake_servers):
+    """(адрес заглушки API, ее состояние); настройки заглушки возвращаются после теста"""
+    _, api_port, state = fake_servers
+    yield f"http://127.0.0.1:{api_port}", state
+    with state.lock:
+        state.api_delay = 0.0
+        state.pyrus_down = False
+        state.pyrus_error_rate = 0.0
+        state.green_error_rate = 0.0
+        state.green_error_status = 500
+        state.auth_delay = 0.0
+
+
+def client(name: str, **options) -> HTTPClient:
+    options.setdefault('backoff_base', 0.01)
+    return HTTPClient(name, pool_size=2, **options)
+
+
+def test_requests_reuse_pooled_connections(api):
+    url, state = api
+    pyrus = PyrusAPI('bot', 'key', http=client('pyrus'), base_url=url)
+    green = GreenAPI('1101', 'token', http=client('green-api'), api_url=url)
+    before = state.api_connections
+
+    for index in range(20):
+        assert pyrus.create_task(1, {'Телефон': f"7900000{index:04d}"})
+        assert green.send_message(f"7900100{index:04d}", "Здравствуйте!")
+
+    # Одно keep-alive соединение на клиента: токен Pyrus и все запросы идут по нему
+    assert state.api_connections - before == 2
+
+
+def test_parallel_calls_share_one_token_request(api):
+    url, state = api
+    pyrus = PyrusAPI('bot', 'key', http=client('pyrus'), base_url=url)
+    # Пока идет /auth, остальные вызовы успевают дойти до get_token()
+    state.auth_delay = 0.2
+    before = state.auth_calls
+
+    with ThreadPoolExecutor(10) as pool:
+        task_ids = list(pool.map(lambda index: pyrus.create_task(1, {'Телефон': f"7900500{index:04d}"}), range(10)))
+
+    assert all(task_ids)
+    assert state.auth_calls - before == 1
+
+
+def test_rejected_token_is_refreshed_once(api):
+    url, state = api
+    pyrus = PyrusAPI('bot', 'key', http=client('pyrus'), base_url=url)
+    assert pyrus.create_task(1, {'Телефон': '79006000000'})
+    stale = pyrus.auth_token
+    with state.lock:
+        state.revoked_tokens = state.auth_calls
+    state.auth_delay = 0.2
+    before = state.auth_calls
+
+    # Все вызовы получили 401 со старым токеном; новый запрашивается один раз на всех
+    with ThreadPoolExecutor(10) as pool:
+        task_ids = list(pool.map(lambda index: pyrus.create_task(1, {'Телефон': f"7900600{index:04d}"}), range(10)))
+
+    assert all(task_ids)
+    assert state.auth_calls - before == 1
+    assert pyrus.auth_token != stale
+
+
+def test_async_create_task_refreshes_a_rejected_token(api):
+    url, state = api
+    http = AsyncHTTPClient('pyrus', pool_size=2, backoff_base=0.01)
+    pyrus = PyrusAPI('bot', 'key', http=http, base_url=url)
+
+    async def create(count: int):
+        try:
+            return await asyncio.gather(*(pyrus.acreate_task(1, {'Телефон': f"7900700{index:04d}"})
+                                          for index in range(count)))
+        finally:
+            await http.aclose()
+
+    assert pyrus.get_token()
+    with state.lock:
+        state.revoked_tokens = state.auth_calls
+    before = state.auth_calls
+
+    assert all(asyncio.run(create(10)))
+    assert state.auth_calls - before == 1
+
+
+def test_retries_unavailable_responses_then_gives_up(api):
+    url, state = api
+    pyrus = PyrusAPI('bot', 'key', http=client('pyrus', max_retries=2), base_url=url)
+    assert pyrus.get_token()
+    state.pyrus_down = True
+    rejected = state.pyrus_rejected
+
+    assert pyrus.create_task(1, {'Телефон': '79002000000'}) is None
+    # 503 повторяется: первая попытка и два повтора
+    assert state.pyrus_rejected - rejected == 3
+
+    state.pyrus_down = False
+    assert pyrus.create_task(1, {'Телефон': '79002000001'})
+
+
+def test_server_errors_are_not_retried(api):
+    url, state = api
+    green = GreenAPI('1101', 'token', http=client('green-api', max_retries=3), api_url=url)
+    state.green_error_rate = 1.0
+    injected = state.injected_errors
+
+    assert not green.send_message('79003000000', "Здравствуйте!")
+    # Сервер мог выполнить запрос: повтор 500 отправил бы клиенту второе сообщение
+    assert state.injected_errors - injected == 1
+
+
+@pytest.mark.parametrize('status', [502, 504, 0])
+def test_gateway_errors_and_dropped_connections_are_not_retried(api, status):
+    url, state = api
+    green = GreenAPI('1101', 'token', http=client('green-api', max_retries=3), api_url=url)
+    state.green_error_status = status
+    state.green_error_rate = 1.0
+    injected = state.injected_errors
+
+    # 502/504 и обрыв после отправки: сервер мог доставить сообщение
+    assert not green.send_message('79003100000', "Здравствуйте!")
+    assert state.injected_errors - injected == 1
+
+
+@pytest.mark.parametrize('status', [502, 504, 0])
+def test_async_client_follows_the_same_retry_rules(api, status):
+    url, state = api
+    http = AsyncHTTPClient('green-api', pool_size=2, max_retries=3, backoff_base=0.01)
+    green = GreenAPI('1101', 'token', http=http, api_url=url)
+    state.green_error_status = status
+    state.green_error_rate = 1.0
+    injected = state.injected_errors
+
+    async def send():
+        try:
+            return await green.asend_message('79003200000', "Здравствуйте!")
+        finally:
+            await http.aclose()
+
+    assert not asyncio.run(send())
+    assert state.injected_errors - injected == 1
+
+
+def test_refused_connection_is_retried():
+    http = client('green-api', max_retries=2)
+    attempts = []
+    with pytest.raises(requests.ConnectionError):
+        # Порт 9 (discard) на localhost закрыт: запрос не был отправлен, повтор безопасен
+        http.post('sendMessage', 'http://127.0.0.1:9/sendMessage', json={},
+                  observer=lambda status, elapsed: attempts.append(status))
+    assert attempts == [None, None, None]
+
+
+def test_read_timeout_bounds_a_slow_send(api):
+    url, state = api
+    green = GreenAPI('1101', 'token', http=client('green-api', read_timeout=0.3, max_retries=3), api_url=url)
+    state.api_delay = 1.0
+
+    started = time.monotonic()
+    assert not green.send_message('79004000000', "Здравствуйте!")
+    elapsed = time.monotonic() - started
+    assert elapsed < 0.9
+
+    # Отправка не идемпотентна: после таймаута чтения запрос не повторяется
+    time.sleep(1.2)
+    assert state.reply_counts.get('79004000000') == 1
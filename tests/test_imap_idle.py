@@ -0,0 +1,96 @@
+"""IMAPIdleListener против заглушки IMAP: доставка по IDLE и переподключение после обрыва"""
+
+import threading
+import time
+from email.mime.text import MIMEText
+
+from autoresponder_bot import IMAPIdleListener
+
+
+def lead(number: int) -> bytes:
+    message = MIMEText(f"Новая заявка № {number}\nТелефон: +7 900 000-00-{number:02d}", 'plain', 'utf-8')
+    message['Subject'] = f"Lead {number}"
+    return message.as_bytes()
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+class Collector:
+    """on_new_mail: забирает непрочитанные письма и помечает их прочитанными"""
+
+    def __init__(self):
+        self.subjects = []
+        self.calls = 0
+
+    def __call__(self, imap):
+        self.calls += 1
+        _, data = imap.uid('SEARCH', None, 'UNSEEN')
+        for uid in data[0].split():
+            _, fetched = imap.uid('FETCH', uid, '(BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+            self.subjects.append(fetched[0][1].decode().split(':', 1)[1].strip())
+            imap.uid('STORE', uid, '+FLAGS', '(\\Seen)')
+
+
+def start_listener(imap_port: int, username: str, collector: Collector) -> (IMAPIdleListener, threading.Thread):
+    listener = IMAPIdleListener('127.0.0.1', username, 'secret', collector, port=imap_port, use_ssl=False,
+                                idle_timeout=30)
+    thread = threading.Thread(target=listener.run, daemon=True)
+    thread.start()
+    assert wait_until(lambda: listener.imap is not None)
+    return listener, thread
+
+
+def test_idle_delivers_new_mail_without_polling(fake_servers):
+    imap_port, _, state = fake_servers
+    username = 'idle@example.com'
+    state.mailbox(username).append(lead(1))
+    collector = Collector()
+    listener, thread = start_listener(imap_port, username, collector)
+    try:
+        # Письмо, пришедшее до подключения, забирается сразу после входа
+        assert wait_until(lambda: collector.subjects == ["Lead 1"])
+        assert listener.supports_idle
+
+        started = time.monotonic()
+        state.mailbox(username).append(lead(2))
+        assert wait_until(lambda: len(collector.subjects) == 2, timeout=2.0)
+        # EXISTS приходит во время IDLE: без ожидания интервала опроса
+        assert time.monotonic() - started < 1.0
+        assert collector.subjects[-1] == "Lead 2"
+    finally:
+        listener.stop()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert listener.imap is None
+
+
+def test_reconnects_after_server_drops_session(fake_servers):
+    imap_port, _, state = fake_servers
+    username = 'reconnect@example.com'
+    collector = Collector()
+    listener, thread = start_listener(imap_port, username, collector)
+    try:
+        first_session = listener.imap
+        assert wait_until(lambda: collector.calls >= 1)
+
+        state.drop_imap_sessions()
+        # Письмо приходит, пока соединения нет: его заберет новая сессия
+        state.mailbox(username).append(lead(3))
+        assert wait_until(lambda: listener.imap is not None and listener.imap is not first_session, timeout=5.0)
+        assert wait_until(lambda: collector.subjects == ["Lead 3"])
+        assert listener.last_error is None
+
+        # Новая сессия снова ждет в IDLE
+        state.mailbox(username).append(lead(4))
+        assert wait_until(lambda: len(collector.subjects) == 2, timeout=2.0)
+    finally:
+        listener.stop()
+        thread.join(5)
+    assert not thread.is_alive()
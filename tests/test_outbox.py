@@ -0,0 +1,48 @@
+"""ApplicationOutbox: групповая фиксация и изоляция ошибочной операции"""
+
+from concurrent.futures import Future
+
+import pytest
+
+from autoresponder_bot import ApplicationOutbox
+
+STEPS = {'crm': 'pending', 'message': 'pending'}
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = ApplicationOutbox(str(tmp_path / 'outbox.db'))
+    yield outbox
+    outbox.close()
+
+
+def outbox_row(key: str) -> tuple:
+    """Строка для операции add в обход ApplicationOutbox.add()"""
+    return key, '{}', 'pending', 'pending', 0, 0.0, 0.0, ''
+
+
+def test_add_and_complete_steps(outbox):
+    assert outbox.add('key-1', {'phone': '79000000001'}, STEPS).result(5) is True
+    assert outbox.add('key-1', {'phone': '79000000001'}, STEPS).result(5) is False
+    assert outbox.complete_step('key-1', 'crm', {}, True).result(5) == 0
+    assert outbox.complete_step('key-1', 'message', {}, True).result(5) == 1
+    assert outbox.status('key-1') == 1
+
+
+def test_failing_operation_does_not_fail_its_batch(outbox):
+    connection = outbox._connect()
+    batch = [
+        ('add', outbox_row('key-a'), Future()),
+        # Неверное число параметров: транзакция пачки откатывается
+        ('add', ('key-broken',), Future()),
+        ('add', outbox_row('key-b'), Future()),
+    ]
+    outbox._commit(connection, batch)
+    connection.close()
+
+    assert batch[0][2].result(0) is True
+    assert batch[1][2].exception(0) is not None
+    assert batch[2][2].result(0) is True
+    assert outbox.status('key-a') == 0
+    assert outbox.status('key-b') == 0
+    assert outbox.status('key-broken') is None
@@ -0,0 +1,81 @@
+"""SendRateLimiter: асинхронные ожидающие получают слот без опроса"""
+
+import asyncio
+import threading
+import time
+
+from autoresponder_bot import Priority, SendRateLimiter
+
+
+def test_async_handoffs_do_not_poll():
+    limiter = SendRateLimiter('handoff', rate=0, max_concurrency=1)
+    order = []
+
+    async def send(index: int):
+        assert await limiter.aacquire()
+        order.append(index)
+        await asyncio.sleep(0)
+        limiter.release()
+
+    async def main():
+        await asyncio.gather(*(send(index) for index in range(200)))
+
+    started = time.monotonic()
+    asyncio.run(main())
+    # Опрос раз в 20 мс дал бы до 4 с на 200 передач слота
+    assert time.monotonic() - started < 1.0
+    assert order == list(range(200))
+    assert limiter.active == 0 and not limiter._waiters and not limiter._async_waiters
+
+
+def test_slot_released_from_another_thread_wakes_async_waiters_by_priority():
+    limiter = SendRateLimiter('priority', rate=0, max_concurrency=1)
+    assert limiter.acquire()
+    order = []
+
+    async def send(priority: int):
+        assert await limiter.aacquire(priority)
+        order.append(priority)
+        limiter.release()
+
+    async def main():
+        tasks = [asyncio.create_task(send(priority)) for priority in (Priority.BULK, Priority.NORMAL, Priority.HIGH)]
+        while len(limiter._async_waiters) < 3:
+            await asyncio.sleep(0.001)
+        # Слот освобождает поток синхронной отправки
+        threading.Timer(0.05, limiter.release).start()
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+
+    asyncio.run(main())
+    assert order == [Priority.HIGH, Priority.NORMAL, Priority.BULK]
+
+
+def test_cancelled_waiter_passes_the_slot_on():
+    limiter = SendRateLimiter('cancel', rate=0, max_concurrency=1)
+
+    async def main():
+        assert await limiter.aacquire()
+        first = asyncio.create_task(limiter.aacquire(Priority.HIGH))
+        second = asyncio.create_task(limiter.aacquire(Priority.NORMAL))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        limiter.release()
+        assert await asyncio.wait_for(second, 1)
+        limiter.release()
+
+    asyncio.run(main())
+    assert limiter.active == 0 and not limiter._waiters
+
+
+def test_token_refill_is_still_timed():
+    limiter = SendRateLimiter('rate', rate=20, burst=1, max_concurrency=4)
+
+    async def main():
+        for _ in range(5):
+            assert await limiter.aacquire()
+            limiter.release()
+
+    started = time.monotonic()
+    asyncio.run(main())
+    # Первый токен есть сразу, еще четыре - по 50 мс
+    assert 0.15 < time.monotonic() - started < 0.5
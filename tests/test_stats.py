@@ -0,0 +1,96 @@
+"""StatsCore под нагрузкой: точные суммы при записи из многих потоков и без роста числа ячеек"""
+
+import threading
+import time
+
+from autoresponder_bot import StatsCore
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_many_threads_sum_exactly_while_being_read():
+    core = StatsCore(('sent', 'errors'))
+    stop = threading.Event()
+    observed = []
+    decreases = []
+
+    def reader():
+        # Чтение во время записи и вливания ячеек: сумма не теряет и не задваивает ячейки
+        previous = 0
+        while not stop.is_set():
+            value = core.total('sent')
+            if value < previous:
+                decreases.append((previous, value))
+            previous = value
+            observed.append(value)
+
+    def writer(count: int):
+        for _ in range(count):
+            core.inc('sent')
+        core.inc('errors', 2)
+
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    for thread in readers:
+        thread.start()
+    # Волны короткоживущих потоков, как потоки HTTP-запросов и приема
+    for _ in range(20):
+        writers = [threading.Thread(target=writer, args=(500,)) for _ in range(25)]
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    assert core.total('sent') == 20 * 25 * 500
+    assert core.total('errors') == 20 * 25 * 2
+    assert core.window('sent', '1m') == 20 * 25 * 500
+    assert core.window('errors', '24h') == 20 * 25 * 2
+    assert core.snapshot() == {'sent': 250000, 'errors': 1000}
+    assert observed and not decreases
+
+
+def test_cells_of_finished_threads_are_folded():
+    core = StatsCore(('sent',))
+    core.inc('sent')
+    threads = [threading.Thread(target=core.inc, args=('sent',)) for _ in range(1000)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+
+    # Осталась только ячейка текущего потока
+    assert wait_until(lambda: len(core._cells) == 1)
+    assert core.total('sent') == 1001
+    assert core.window('sent', '1h') == 1001
+
+
+def test_live_threads_keep_their_cells():
+    core = StatsCore(('sent',))
+    release = threading.Event()
+    written = threading.Barrier(11)
+
+    def worker():
+        core.inc('sent', 3)
+        written.wait()
+        release.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    written.wait()
+    assert len(core._cells) == 10
+    assert core.total('sent') == 30
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert wait_until(lambda: not core._cells)
+    assert core.total('sent') == 30
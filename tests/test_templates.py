@@ -0,0 +1,29 @@
+"""MessageTemplate: подстановки и условные фрагменты [[...]]"""
+
+import pytest
+
+from autoresponder_bot import MessageTemplate
+
+
+def render(source: str, data: dict) -> str:
+    template = MessageTemplate('test', source)
+    return template.render(template.variant(data))
+
+
+@pytest.mark.parametrize('source, text', [
+    ('[[Привет!]] текст', 'Привет! текст'),
+    ('A [[b]] c', 'A b c'),
+    ('Без подстановок', 'Без подстановок'),
+    ('', ''),
+])
+def test_sections_without_fields_are_plain_text(source, text):
+    template = MessageTemplate('test', source)
+    assert template.fields == ()
+    assert render(source, {}) == text
+
+
+def test_section_is_shown_only_when_its_fields_are_filled():
+    source = "Здравствуйте[[, {name}]]! [[Площадь: {area}.]] [[{{ok}}]]"
+    assert render(source, {'name': 'Анна', 'area': '120 м²'}) == "Здравствуйте, Анна! Площадь: 120 м². {ok}"
+    assert render(source, {'name': 'Анна'}) == "Здравствуйте, Анна!  {ok}"
+    assert render(source, {}) == "Здравствуйте!  {ok}"
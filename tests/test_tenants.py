@@ -0,0 +1,40 @@
+"""Описание арендатора из TENANTS_FILE: подстановка ${VAR} из окружения"""
+
+import pytest
+
+from autoresponder_bot import AutoResponderBot
+
+
+@pytest.fixture
+def bot():
+    # create_tenant без Pyrus и Green API обращается только к config
+    bot = object.__new__(AutoResponderBot)
+    bot.config = {}
+    return bot
+
+
+def tenant_item(password: str) -> dict:
+    return {
+        'id': 'spb',
+        'mailboxes': [{'imap_server': 'imap.example.com', 'username': 'spb@example.com', 'password': password}]
+    }
+
+
+def test_password_with_quotes_and_backslashes(bot, monkeypatch):
+    monkeypatch.setenv('SPB_EMAIL_PASSWORD', 'p"a\\ss${x}')
+    tenant = bot.create_tenant(tenant_item('${SPB_EMAIL_PASSWORD}'))
+    assert tenant.mailboxes[0]['password'] == 'p"a\\ss${x}'
+
+
+def test_only_string_values_are_substituted(monkeypatch):
+    monkeypatch.setenv('SPB_TOKEN', 'token')
+    item = {'token': 'Bearer ${SPB_TOKEN}', 'port': 993, 'use_ssl': True, 'ids': ['${SPB_TOKEN}', 1], 'raw': '$SPB_TOKEN'}
+    assert AutoResponderBot.expand_env(item, 'spb') == {
+        'token': 'Bearer token', 'port': 993, 'use_ssl': True, 'ids': ['token', 1], 'raw': '$SPB_TOKEN'
+    }
+
+
+def test_unset_variable_is_an_error(bot, monkeypatch):
+    monkeypatch.delenv('SPB_EMAIL_PASSWORD', raising=False)
+    with pytest.raises(ValueError, match='SPB_EMAIL_PASSWORD'):
+        bot.create_tenant(tenant_item('${SPB_EMAIL_PASSWORD}'))